@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
 import abc
+import contextlib
+import copy
 import datetime
+import functools
 import sys
+import time
 
 # Python 2/3 compatible `range` function
 if sys.version_info < (3, 0):
@@ -9,35 +13,163 @@ if sys.version_info < (3, 0):
 else:
     range_func = range
 
+from .bucketing import LOCAL, UTC, bucket, bucket_array, bucket_many
+
 # Helper functions to convert between timestamps and datetimeobjects
 timestamp_to_time = lambda t: datetime.datetime.fromtimestamp(t)
-time_to_timestamp = lambda t: int(t.strftime('%s'))
+time_to_timestamp = lambda t: int(time.mktime(t.timetuple()))
 # Helper function to get base minute and hour from second-level timestamps
-timestamp_minute = lambda t: time_to_timestamp(timestamp_to_time(t)
-                        .replace(second=0, microsecond=0))
-timestamp_hour = lambda t: time_to_timestamp(timestamp_to_time(t)
-                        .replace(minute=0, second=0, microsecond=0))
+timestamp_minute = lambda t: bucket(t, 60)
+timestamp_hour = lambda t: bucket(t, 60**2)
+# Truncate a timestamp to the start of its `step`-second bucket
+timestamp_bucket = bucket
+
+from .archives import (Archive, DEFAULT_ARCHIVES, format_archives,
+                       parse_archives)
+
+from .summary import EMPTY_SUMMARY, Summary, WindowSummary
+
+from .resampling import resample
+
+from .stats import OPERATIONS, Stats
+
+# The series used when no series name is given
+DEFAULT_SERIES = 'default'
+
+# How long `buffered()` holds a value before the next save writes it (in
+# seconds), and how many values it holds at most
+BUFFER_MAX_DELAY = 60
+BUFFER_MAX_POINTS = 10000
+
+# How many entries `iter_query()` reads at a time
+CHUNK_ROWS = 4096
 
 class RoundRobinDb(object):
     """ An abstract RoundRobinDb that can be implemented with a backing subclass.
 
     Subclasses implement the usual CRUD methods to support writing and reading data
     from any backing format (e.g. SQLite, JSON, RDBMS, etc.)
+
+    A database has a list of archives (tables, `DEFAULT_ARCHIVES` unless
+    configured otherwise), each an `archives.Archive` with its own step, number
+    of entries and consolidation function. Subclasses set `self.archives`.
+
+    A database can hold many named series, each with its own copy of every
+    archive. A RoundRobinDb object reads and writes one series (`DEFAULT_SERIES`
+    unless another is selected with `select()`).
+
+    Values are bucketed according to the `timezone` alignment policy: `LOCAL`
+    (the default) aligns e.g. daily entries to local midnight, `UTC` to UTC
+    midnight. See `bucketing` for the details. The policy must not change once
+    values have been saved.
     """
     # Since this is an abstract base class, use ABCMeta to have useful abstract decorators
     __metaclass__ = abc.ABCMeta
-    
+
+    series = DEFAULT_SERIES
+    archives = DEFAULT_ARCHIVES
+    timezone = LOCAL
+    # The `stats.Stats` of the database, if instrumentation is enabled
+    stats = None
+    # The saves collected by `buffered()`, shared with the objects `select()`
+    # returns while it is in effect
+    _save_buffer = None
+
+    def select(self, series):
+        """Return a RoundRobinDb for the named series in the same database.
+
+        The returned object shares this object's connection to the database,
+        and its stats.
+        """
+        db = copy.copy(self)
+        db.series = series
+        db._select_series()
+        if db.stats is not None:
+            db._instrument()
+        return db
+
+    def enable_stats(self, stats=None, trace=None):
+        """Time this object's operations and count its calls to the backend.
+
+        Keyword arguments:
+        stats -- the `stats.Stats` to record them in (default: a new one)
+        trace -- a text file-like object to write a line to for each timed
+                 call, if a new `Stats` is made
+
+        Returns:
+        the `stats.Stats`
+        """
+        if self.stats is None:
+            self.stats = stats or Stats(trace)
+            self._instrument()
+            self._instrument_backend()
+        return self.stats
+
+    # Internal method
+    def _instrument(self):
+        """Replace the methods in `stats.OPERATIONS` with timed wrappers, for
+        this object only."""
+        for operation, name in OPERATIONS:
+            method = functools.partial(getattr(type(self), name), self)
+            self.__dict__[name] = self.stats.timed(operation, method, self.series)
+
+    def _instrument_backend(self):
+        """Start counting calls to the backend in `self.stats`.
+
+        Subclasses should override this, e.g. to count statements or round
+        trips.
+        """
+        pass
+
+    def _select_series(self):
+        """Called when a copy of the object is made for another series.
+
+        Subclasses should override this to reset any per-series state.
+        """
+        pass
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """A context in which all saves (to any series) are written together.
+
+        Subclasses should override this to defer their commits until the end
+        of the outermost transaction, and discard the writes on an exception.
+        """
+        yield self
+
+    @contextlib.contextmanager
+    def read_transaction(self):
+        """A context in which all reads see the same state of the database,
+        even if another process saves meanwhile.
+
+        Subclasses whose backing is shared between processes should override
+        this.
+        """
+        yield self
+
     def _validate_tablename(self, name):
-        """A shared method to validate the tablename is either `Minutes` or `Hours`."""
-        assert(name.lower() == "minutes" or name.lower() == "hours"), \
-                "Table name must be 'Minutes' or 'Hours'"
+        """A shared method to validate the tablename is one of the archives."""
+        assert(name.lower() in [archive.name for archive in self.archives]), \
+                "Table name must be one of %s" % ", ".join(
+                        archive.name for archive in self.archives)
+
+    def archive(self, table):
+        """The `Archive` for the specified table.
+
+        Throws ValueError if there is no such archive.
+        """
+        for archive in self.archives:
+            if archive.name == table.lower():
+                return archive
+        raise ValueError("Table must be one of %s" % ", ".join(
+                        archive.name for archive in self.archives))
 
     @abc.abstractmethod
     def read_all(self, table):
         """Read all values from the specified table.
 
         Keyword arguments:
-        table -- One of 'minutes' or 'hours'
+        table -- The name of one of the archives, e.g. 'minutes' or 'hours'
 
         Returns:
         a list of (timestamp, value) tuples representing the state of the table
@@ -63,16 +195,30 @@ class RoundRobinDb(object):
         Returns `None` if the timestamp is not in the database."""
         self._validate_tablename(table)
 
+    @abc.abstractmethod
+    def get_head_count(self, table):
+        """The number of values consolidated into the table's latest entry.
+
+        Returns 0 if the table is empty."""
+        self._validate_tablename(table)
+
     @abc.abstractmethod
     def save_timestamps(self, data):
         """Add timestamps and values to the database.
 
-        Subclasses should override this method to use their own storage.
+        Subclasses should override this method to use their own storage, and
+        should write all of `data` in a single transaction where possible.
         
         Keyword Arguments:
-        data -- a dictionary with two entries, 'minutes' and 'hours'
-                each entry's value is a list of tuples of format 
-                [(timestamp, value),..] in ascending timestamp order
+        data -- a dictionary with an entry for each archive name (e.g.
+                'minutes' and 'hours'), each entry's value is a list of
+                tuples of format [(timestamp, value),..] in ascending
+                timestamp order
+                An 'updates' entry maps archive names to a (timestamp, value)
+                tuple that replaces the value of the latest existing entry,
+                and is applied before the new entries.
+                A 'counts' entry maps archive names to the new value of
+                `get_head_count()` for the archive.
         """
         return NotImplemented
 
@@ -83,6 +229,8 @@ class RoundRobinDb(object):
         Throws ValueError if the timestamp is not found.
         """
         self._validate_tablename(table)
+        # The summary is worked out again the next time it is needed
+        self.__dict__.get('_windows', {}).pop((self.series, table.lower()), None)
 
     @property
     def last_hour_timestamp(self):
@@ -91,120 +239,572 @@ class RoundRobinDb(object):
         # If the last timestamp is `None` (new database), do not try to find the hour
         if self.last_timestamp is None:
             return None
-        return timestamp_hour(self.last_timestamp)
+        return bucket(self.last_timestamp, 60**2, self.timezone)
+
+    def last_archive_timestamp(self, table):
+        """The most recent timestamp in the specified table."""
+        if self.last_timestamp is None:
+            return None
+        return bucket(self.last_timestamp, self.archive(table).step, self.timezone)
 
     @property
     def minutes(self):
         """An ordered list of all `minutes` entries in our RRD."""
-        values = self.read_all('minutes')
+        return self.query('minutes')
+
+    @property
+    def hours(self):
+        """An ordered list of all `hours` entries in our RRD."""
+        return self.query('hours')
+
+    def summary(self, table):
+        """The count, sum, minimum, maximum and average of the specified table.
+
+        The summary is worked out from the table's entries the first time it
+        is needed, and then kept up to date as values are saved through this
+        object, so polling it costs O(1) rather than a read of the whole table.
+        It is only kept in this object's memory, not in the database: every
+        new object (e.g. each `rrd query` process) reads the whole table for
+        its first summary, and it is worked out again whenever the database
+        has been written to by anything else, such as another process.
+        Long-running programs like `rrd serve` get the O(1) polling.
+
+        Returns:
+        a `Summary` named tuple, with `None` for the minimum, maximum and
+        average of a table without values
+        """
+        archive = self.archive(table)
+        windows = self.__dict__.setdefault('_windows', {})
+        key = (self.series, archive.name)
+        token = self._summary_token()
+        if key not in windows or windows[key][0] != token:
+            values = (value for ts, value in self.iter_query(archive.name))
+            windows[key] = (token, WindowSummary(archive.rows, values))
+        return windows[key][1].summary
+
+    # Internal method
+    def _summary_token(self):
+        """A value that changes whenever a value is saved in the series."""
+        generation = self.generation
+        if generation is not None:
+            return generation
+        return (self.last_timestamp, self.get_head_count(self.archives[0].name))
+
+    # Internal method
+    def _update_summaries(self, token, data):
+        """Apply `data`, just written by `save_timestamps`, to the summaries
+        that were up to date with `token` before the write."""
+        windows = self.__dict__.get('_windows')
+        keys = [(self.series, archive.name) for archive in self.archives]
+        if not windows or not any(key in windows for key in keys):
+            return
+        new_token = self._summary_token()
+        for archive, key in zip(self.archives, keys):
+            cached_token, window = windows.pop(key, (None, None))
+            if cached_token != token:
+                continue
+            if archive.name in data['updates']:
+                window.replace(data['updates'][archive.name][1])
+            for ts, value in data[archive.name]:
+                window.push(value)
+            windows[key] = (new_token, window)
+
+    def series_names(self):
+        """The names of the series in the database that hold values, sorted.
+
+        Subclasses that can hold more than one series should override this.
+        """
+        return [self.series] if self.last_timestamp is not None else []
+
+    def close(self):
+        """Release any resources held by the database.
+
+        Subclasses should override this if they hold connections or files,
+        and write the values collected by `buffered()` first.
+        """
+        self.flush_buffer()
+
+    def query(self, table, start=None, end=None, limit=None):
+        """The entries of the specified table, oldest first.
+
+        Keyword arguments:
+        table -- the name of one of the archives
+        start -- leave out entries before this timestamp
+        end   -- leave out entries after this timestamp
+        limit -- return at most this many of the most recent entries
+
+        Without a `start`, `end` or `limit`, all of the table's entries are
+        returned, with `(None, None)` for those not yet written, and the result
+        is cached until the series is next written to. Otherwise only the
+        entries in the range that have been written are returned, and only
+        they are read from the backend.
+        """
+        archive = self.archive(table)
+        if start is None and end is None and limit is None:
+            rows = self.cached('query:' + archive.name, lambda: self._rotate(archive.name))
+            return [tuple(row) for row in rows]
+        with self.read_transaction():
+            self._refresh()
+            return self._query_range(archive, start, end, limit)
+
+    # Internal method
+    def _refresh(self):
+        """Bring this object's view of the series up to date with writes made
+        by anything else. Backends do this whenever `generation` is read."""
+        return self.generation
+
+    # Internal method
+    def _range_offsets(self, archive, last, start, end, limit):
+        """Work out which entries of a table a range query needs.
+
+        Keyword arguments:
+        archive -- the `Archive` of the table
+        last    -- the timestamp of the table's latest entry
+        start, end, limit -- as for `query()`
+
+        Returns:
+        the (offset, count) of the entries for `read_range()`, or `None` if
+        the range holds no entries
+        """
+        newest = 0 if end is None else max(0, -((end - last) // archive.step))
+        oldest = archive.rows - 1
+        if start is not None:
+            oldest = min(oldest, (last - start) // archive.step)
+        if limit is not None:
+            oldest = min(oldest, newest + limit - 1)
+        if oldest < newest:
+            return None
+        return newest, oldest - newest + 1
+
+    def iter_query(self, table, start=None, end=None, limit=None, chunk_size=CHUNK_ROWS):
+        """Generate the written entries of the specified table, oldest first.
+
+        The table is read `chunk_size` entries at a time, from the oldest
+        entry in the range to the newest, so the memory used doesn't depend on
+        the size of the table. The entries are the same as those `query()`
+        returns with a range, and are read in a single `read_transaction()`,
+        which lasts until the generator is exhausted or closed.
+
+        Keyword arguments:
+        table, start, end, limit -- as for `query()`
+        chunk_size -- the number of entries read at a time
+        """
+        archive = self.archive(table)
+        with self.read_transaction():
+            self._refresh()
+            for row in self._iter_range(archive, start, end, limit, chunk_size):
+                yield row
+
+    def resample(self, table, step, cf='average', start=None, end=None, limit=None, tz=None):
+        """The written entries of the specified table, combined into entries
+        of a larger step (see `resampling.resample()`), oldest first.
+
+        Keyword arguments:
+        table -- the name of one of the archives
+        step  -- the step of the result in seconds, a multiple of the table's
+        cf    -- how the values of each new entry are combined: one of
+                 `archives.CONSOLIDATION_FUNCTIONS`, or an alias such as avg
+        start, end, limit -- only resample the table's entries in this range
+                 (see `query()`)
+        tz    -- the alignment policy of the new entries (default: the
+                 database's `timezone`)
+
+        The resampled whole table is cached until the series is next written
+        to, like `query()`.
+
+        Throws ValueError if there is no such table, or the step or
+        consolidation function is not valid.
+        """
+        archive = self.archive(table)
+        if step < archive.step or step % archive.step:
+            raise ValueError("Step must be a multiple of the %s archive's step (%ds)"
+                             % (archive.name, archive.step))
+        tz = self.timezone if tz is None else tz
+        resample_rows = lambda: resample(list(self.iter_query(archive.name, start, end, limit)),
+                                         step, cf, tz)
+        if start is None and end is None and limit is None:
+            key = "resample:%s:%d:%s:%s" % (archive.name, step, cf, tz)
+            return [tuple(row) for row in self.cached(key, resample_rows)]
+        return resample_rows()
+
+    # Internal method
+    def _query_range(self, archive, start, end, limit):
+        """The written entries of a table in a range (see `query()`)."""
+        return list(self._iter_range(archive, start, end, limit))
+
+    # Internal method
+    def _iter_range(self, archive, start, end, limit, chunk_size=None):
+        """Generate the written entries of a table in a range, reading
+        `chunk_size` entries at a time (default: all at once)."""
+        last = self.last_archive_timestamp(archive.name)
+        if last is None:
+            return
+        offsets = self._range_offsets(archive, last, start, end, limit)
+        if offsets is None:
+            return
+        read = lambda offset, count: self.read_range(archive.name, offset, count)
+        for row in self._read_chunks(archive, last, offsets, chunk_size, read):
+            yield row
+
+    # Internal method
+    def _read_chunks(self, archive, last, offsets, chunk_size, read):
+        """Generate the written entries of a range of a table, oldest first.
+
+        Keyword arguments:
+        archive -- the `Archive` of the table
+        last    -- the timestamp of the table's latest entry
+        offsets -- the (offset, count) of the range, from `_range_offsets()`
+        chunk_size -- the number of entries read at a time, or `None`
+        read    -- a function reading (offset, count) entries, like
+                   `read_range()`
+        """
+        offset, count = offsets
+        chunk_size = chunk_size or count
+        # From the oldest entry of the range to the newest
+        for newer in range_func(count, 0, -chunk_size):
+            chunk = (offset + max(0, newer - chunk_size), min(chunk_size, newer))
+            for row in self._check_range(archive, last, chunk, read(*chunk)):
+                yield row
+
+    # Internal method
+    def _check_range(self, archive, last, offsets, entries):
+        """Leave out the entries of a range that have not been written, which
+        still hold older timestamps (or none)."""
+        offset, count = offsets
+        first = last - (offset + count - 1) * archive.step
+        return [(ts, value) for ix, (ts, value) in enumerate(entries)
+                if ts == first + ix * archive.step]
+
+    def read_range(self, table, offset, count):
+        """Read some of the most recent entries of a table.
+
+        Subclasses should override this to read only those entries from their
+        storage. By default the whole table is read.
+
+        Keyword arguments:
+        table  -- the name of one of the archives
+        offset -- the number of entries between the newest entry read and the
+                  table's latest entry
+        count  -- the number of entries to read
+
+        Returns:
+        a list of `count` (timestamp, value) tuples, oldest first, with
+        (None, None) for entries not yet written
+        """
+        archive = self.archive(table)
+        head = self.get_timestamp_index(self.last_archive_timestamp(table), table)
+        if head is None:
+            return [(None, None)] * count
+        rows = self.read_all(table)
+        return [rows[(head - back) % archive.rows]
+                for back in range_func(offset + count - 1, offset - 1, -1)]
+
+    # Internal method
+    def _rotate(self, table):
+        """Read the table, and put its entries in timestamp order."""
+        values = self.read_all(table)
         # Get the index of the last entered timestamp in the respective table.
         # The next position in the round-robin database will be the oldest.
-        last_entry_index = self.get_timestamp_index(self.last_timestamp,
-                                                    'minutes', default=0)
+        last_entry_index = self.get_timestamp_index(
+                self.last_archive_timestamp(table), table, default=0)
 
         # Our entries are in order, but the last_entry should be at the end
         # of the list so join two splices of the list around the last_entry
         return values[(last_entry_index + 1):] + values[:(last_entry_index+1)]
 
     @property
-    def hours(self):
-        """An ordered list of all `hours` entries in our RRD."""
-        values = self.read_all('hours')
-        # Reorder as in the minutes() property, but looking at the hours values
-        last_entry_index = self.get_timestamp_index(self.last_hour_timestamp,
-                                                    'hours', default=0)
-        return values[(last_entry_index + 1):] + values[:(last_entry_index+1)]
+    def generation(self):
+        """A counter that changes whenever the selected series is written to.
 
-    def query(self, table):
-        return getattr(self,table) # `table` must be 'hours' or 'minutes'
+        Subclasses should override this if they keep such a counter. Returns
+        `None` if they don't, in which case nothing is cached.
+        """
+        return None
+
+    def cached(self, key, func):
+        """The result of `func()`, cached until the series is next written to.
+
+        Keyword arguments:
+        key  -- a string naming the result, unique within the series
+        func -- a function computing the result. Backends that share their
+                cache between processes store the result as JSON, so it must
+                be made of lists, dicts, strings, numbers and `None`.
+        """
+        generation = self.generation
+        if generation is None:
+            return func()
+        cached = self._load_cached(key)
+        if cached is not None and cached[0] == generation:
+            if self.stats is not None:
+                self.stats.count('cache_hits')
+            return cached[1]
+        if self.stats is not None:
+            self.stats.count('cache_misses')
+        value = func()
+        self._store_cached(key, generation, value)
+        return value
+
+    # Internal method
+    def _load_cached(self, key):
+        """The (generation, value) cached for `key`, or `None`.
+
+        Subclasses should override this and `_store_cached()` to share the
+        cache between processes. By default results are cached in the process.
+        """
+        return self.__dict__.get('_cache', {}).get((self.series, key))
+
+    # Internal method
+    def _store_cached(self, key, generation, value):
+        self.__dict__.setdefault('_cache', {})[(self.series, key)] = (generation, value)
 
     def save(self, timestamp, value):
         # First let's truncate our timestamp to the nearest "minute" value, as 
         # noted in the `Design Consideration` section of the README
-        minute_ts = timestamp_minute(timestamp)
-        hour_ts = timestamp_hour(timestamp)
-
-        if self.last_timestamp is not None and minute_ts < self.last_timestamp:
-            raise ValueError("Timestamp must be greater than %s" % self.last_timestamp)
-        elif minute_ts == self.last_timestamp:
+        ts_bucket = bucket(timestamp, self.archives[0].step, self.timezone)
+        if self._save_buffer is not None and self._save_buffer['open']:
+            self._buffer_point(ts_bucket, timestamp, value)
+            return
+        if ts_bucket == self.last_timestamp:
             # This is essentially an update to the recently-added value. Technically
             # it's allowed according to the Design Considerations, but is probably
             # not what the user wants (if they're calling the ``rrd save`` command
             # more than once per minute, this situation may occur). 
             print("Warning: updating existing timestamp with new value!")
-            # Update record to be the min of this value and the saved value
-            self.update_timestamp('Minutes', minute_ts, min(
-                        self.get_timestamp_value('Minutes', minute_ts), value))
-            self.update_timestamp('Hours', hour_ts, min(
-                        self.get_timestamp_value('Hours', hour_ts), value))
+        self.save_many([(timestamp, value)])
+
+    def save_many(self, points):
+        """Save a batch of values in a single write to the backing storage.
+
+        The gaps, new entries and consolidated values of every archive for the
+        whole batch are worked out in memory, and the result is handed to
+        `save_timestamps` once, so backends can write it in a single transaction.
+        Each value is folded into each archive's running consolidation state, so
+        the cost of a save does not depend on the size of the archives.
+
+        Keyword arguments:
+        points -- an iterable of (timestamp, value) tuples in ascending
+                  timestamp order
+
+        Throws ValueError if a timestamp is older than the one before it.
+        """
+        # Values collected by `buffered()` are older, so they are saved first
+        self.flush_buffer()
+        archives = self.archives
+        points = list(points)
+        timestamps = [timestamp for timestamp, value in points]
+        buckets = [bucket_many(timestamps, archive.step, self.timezone)
+                   for archive in archives]
+        last_buckets = [self.last_archive_timestamp(archive.name) for archive in archives]
+        data = dict((archive.name, []) for archive in archives)
+        updates, counts = {}, {}
+
+        for point_ix, (timestamp, value) in enumerate(points):
+            for ix, archive in enumerate(archives):
+                ts_bucket = buckets[ix][point_ix]
+                if ix == 0 and last_buckets[0] is not None and ts_bucket < last_buckets[0]:
+                    raise ValueError("Timestamp must be greater than %s" % last_buckets[0])
+                self._fold_value(archive, data[archive.name], updates, counts,
+                                 last_buckets[ix], ts_bucket, value)
+                last_buckets[ix] = ts_bucket
+
+        if not counts:
+            return # Nothing to save
+
+        # Only the most recent entries of each table survive the write, so don't
+        # send the backend more rows than the round-robin table can hold
+        for archive in archives:
+            data[archive.name] = data[archive.name][-archive.rows:]
+        data['updates'] = updates
+        data['counts'] = counts
+        token = self._summary_token() if self.__dict__.get('_windows') else None
+        self.save_timestamps(data)
+        self._update_summaries(token, data)
+
+    @contextlib.contextmanager
+    def buffered(self, max_delay=BUFFER_MAX_DELAY, max_points=BUFFER_MAX_POINTS):
+        """A context in which `save()` collects values in memory, and writes
+        them in batches, for sources that save many values per minute.
+
+        Values are folded into the database's entries as they are written, so
+        the result is the same as saving each of them, but a database that is
+        sent a value every second is written to once a minute. The collected
+        values are written (for every series, in a single transaction):
+
+        - when a value arrives for a later entry of the first archive than
+          those collected, e.g. in the next minute
+        - when a value arrives after the first value collected has been held
+          for `max_delay` seconds, or `max_points` values are held
+        - on `flush_buffer()`, `save_many()`, `save_series()` or `close()`,
+          and when the context ends
+
+        Nothing is written in the background (the database's connection
+        belongs to the thread saving to it), so the delay is only checked as
+        values arrive: values collected before a source goes quiet are held
+        until the next save or `flush_buffer()`. While values keep arriving,
+        a crash loses at most those saved in the last `max_delay` seconds, and
+        within the current entry of the first archive. Queries don't see the
+        collected values until they are written.
+
+        Saves to the objects `select()` returns from this object within the
+        context are collected too.
+        """
+        if self._save_buffer is not None and self._save_buffer['open']:
+            yield self
+            return
+        self._save_buffer = {'open': True, 'series': {}, 'length': 0, 'bucket': None,
+                             'since': None, 'max_delay': max_delay, 'max_points': max_points}
+        try:
+            yield self
+        finally:
+            try:
+                self.flush_buffer()
+            finally:
+                self._save_buffer['open'] = False
+                self._save_buffer = None
+
+    # Internal method
+    def _buffer_point(self, ts_bucket, timestamp, value):
+        """Collect a value saved in `buffered()`, writing the values collected
+        before it if they are due."""
+        buffer = self._save_buffer
+        if buffer['bucket'] is not None and ts_bucket > buffer['bucket']:
+            # The entries of the values collected so far are complete
+            self.flush_buffer()
+        if self.series in buffer['series']:
+            points = buffer['series'][self.series][1]
+            last = bucket(points[-1][0], self.archives[0].step, self.timezone)
         else:
-            # Data object to be passed to the backing storage implementation
-            data={}
-            
-            # Find out how many seconds have elapsed since the previous entry, and create
-            # a list of up to 59 previous entries with `None` values to correspond to
-            # entries that have been missed
-            if self.last_timestamp:
-                elapsed_secs = minute_ts - self.last_timestamp
-            else:
-                # New database
-                elapsed_secs = 0
-
-            elapsed_values = [(minute_ts - t, None) for t in 
-                    range_func(60, min(elapsed_secs,60**2), 60)]
-            # The above list comprehension returns the values in descending order, so 
-            # let's reverse the list
-            elapsed_values.reverse()
-
-            # Add our elapsed values and the latest value (list size is max 60)
-            data['minutes'] = elapsed_values + [(minute_ts, value)]
-
-            # If current timestamp's hour > last_saved_hour,
-            # add a new hour entry with value set to value being saved.
-            # if there are intermediate hourly values, create those too with
-            # `None` value. If there are none, then update the hour value to
-            # be the minimum of its current value and the new value.
-
-            if self.last_hour_timestamp is not None:
-                elapsed_secs = minute_ts - self.last_hour_timestamp
-            else:
-                # New database
-                elapsed_secs = 0
-
-            elapsed_hour_values = [(hour_ts - t, None) for t in
-                    range_func(60**2, min(elapsed_secs, 24*60**2), 60**2)]
-            elapsed_hour_values.reverse()
-
-            if hour_ts == self.last_hour_timestamp:
-                # just update the hours value without adding new hours.
-                # We don't need to read from the DB, because we can only add
-                # one timestamp at a time and each save will update this value
-                # as appropriate.
-                self.update_timestamp('Hours', hour_ts, min(
-                        self.get_timestamp_value('Hours', hour_ts), value))
-                data['hours'] = []
+            points, last = [], self.last_timestamp
+        # Check now rather than when the values are written, so the error is
+        # raised by the save that caused it
+        if last is not None and ts_bucket < last:
+            raise ValueError("Timestamp must be greater than %s" % last)
+
+        points.append((timestamp, value))
+        buffer['series'][self.series] = (self, points)
+        buffer['length'] += 1
+        buffer['bucket'] = max(ts_bucket, buffer['bucket'] or ts_bucket)
+        if buffer['since'] is None:
+            buffer['since'] = time.time()
+        if (buffer['length'] >= buffer['max_points']
+                or time.time() - buffer['since'] >= buffer['max_delay']):
+            self.flush_buffer()
+
+    def flush_buffer(self):
+        """Write the values collected by `buffered()`, if any."""
+        buffer = self._save_buffer
+        if buffer is None or not buffer['series']:
+            return
+        # Taken out of the buffer first, so the saves below aren't collected
+        pending = buffer['series']
+        buffer.update(series={}, length=0, bucket=None, since=None)
+        if self.stats is not None:
+            self.stats.count('buffer_flushes')
+        with self.transaction():
+            for db, points in pending.values():
+                db.save_many(points)
+
+    def save_series(self, points_by_series):
+        """Save batches of values for many series in a single transaction.
+
+        Keyword arguments:
+        points_by_series -- a dictionary mapping series names to iterables of
+                            (timestamp, value) tuples in ascending timestamp order
+
+        Throws ValueError if a timestamp is older than the one before it, in
+        which case backends that support transactions save nothing.
+        """
+        with self.transaction():
+            for series, points in points_by_series.items():
+                db = self if series == self.series else self.select(series)
+                db.save_many(points)
+
+    def _fold_value(self, archive, rows, updates, counts, last_ts, ts, value):
+        """Fold a single value into the pending rows for one archive.
+
+        A value for the same timestamp as the previous one is consolidated with
+        it - either in the pending rows, or as an update to the entry already
+        in the database. A newer timestamp adds up to `archive.rows` entries,
+        with `None` values for any timestamps that were skipped.
+        """
+        name = archive.name
+        if ts == last_ts:
+            if rows:
+                rows[-1] = (ts, archive.consolidate(rows[-1][1], counts[name], value))
             else:
-                data['hours'] = elapsed_hour_values + [(hour_ts, value)]
-            self.save_timestamps(data)
+                if name not in updates:
+                    updates[name] = (ts, self.get_timestamp_value(name, ts))
+                    counts[name] = self.get_head_count(name)
+                updates[name] = (ts, archive.consolidate(updates[name][1],
+                                                         counts[name], value))
+            counts[name] += 1
+        else:
+            if last_ts is not None:
+                # Only the most recent `archive.rows` entries can be stored
+                first_ts = max(last_ts + archive.step, ts - (archive.rows - 1) * archive.step)
+                rows.extend((t, None) for t in range_func(first_ts, ts, archive.step))
+            rows.append((ts, archive.consolidate(None, 0, value)))
+            counts[name] = 1
 
-def open_database(backing):
+def parse_point(line, series=DEFAULT_SERIES):
+    """Parse a `[series] timestamp value` line, with fields separated by
+    whitespace or commas.
+
+    Returns:
+    a (series, timestamp, value) tuple, with `series` for lines without a
+    series name, or `None` for a blank line
+
+    Throws ValueError if the line is not valid.
+    """
+    fields = line.replace(",", " ").split()
+    if not fields:
+        return None
+    try:
+        if len(fields) == 3:
+            series = fields.pop(0)
+        return series, int(fields[0]), float(fields[1])
+    except (ValueError, IndexError):
+        raise ValueError("expected '[series] timestamp value', got %r" % line.strip())
+
+def open_database(backing, archives=None):
     """ Open a connection to a Round Robin Database.
 
     Keyword arguments:
     backing --  A tuple of the format (engine, uri)
-                Presently only the `SQLite` engine is supported.
-                The uri is the argument passed to `sqlite3.connect()`.
+                For the `SQLite` engine, the uri is the argument passed to
+                `sqlite3.connect()`.
+                For the `Redis` engine, the uri is a `host:port` string, or
+                a `redis.StrictRedis` client to use.
+                For the `Memory` engine, the uri is an optional snapshot file
+                to load from and save to on `close()`.
+                For the `MMap` engine, the uri is the path of the RRD file,
+                optionally followed by `?flush=<save|close|never>`.
+    archives -- The archives of a new database, as a list of `Archive` objects
+                or a string for `parse_archives()`. Defaults to the archives
+                the database was created with, or `DEFAULT_ARCHIVES`.
 
     Returns:
     A RoundRobinDb object.
+
+    Throws ValueError if `archives` differs from the archives of an existing
+    database.
     """
     engine,db_path = backing
-    assert (engine.lower() in ["sqlite","redis"]),"Only SQLite and Redis backings supported."
+    if isinstance(archives, str):
+        archives = parse_archives(archives)
+    assert (engine.lower() in ["sqlite","redis","memory","mmap"]), \
+            "Only SQLite, Redis, Memory and MMap backings supported."
 
     if engine.lower() == "sqlite":
         # We only support SQLite3 at the moment, defined in the db.py module
         from . import db
-        return db.SqliteRoundRobinDb(db_path)
-    elif engine == "redis":
+        return db.SqliteRoundRobinDb(db_path, archives)
+    elif engine.lower() == "redis":
         from . import redisdb
-        return redisdb.RedisRoundRobinDb(db_path)
+        return redisdb.RedisRoundRobinDb(db_path, archives)
+    elif engine.lower() == "memory":
+        from . import memorydb
+        return memorydb.MemoryRoundRobinDb(db_path, archives)
+    elif engine.lower() == "mmap":
+        from . import mmapdb
+        return mmapdb.MmapRoundRobinDb(db_path, archives=archives)
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+import re
+
+"""Declarative definitions of the archives (tables) held by a RoundRobinDb.
+
+An archive is written as `[name=]<step>:<rows>[:<cf>]`, for example `1m:1440`
+or `peak=1h:720:max`, and a list of archives is separated by commas:
+
+    1m:1440, 1h:720:average, 1d:365
+
+step -- the width of each entry, a number followed by one of s, m, h, d or w
+rows -- the number of entries kept
+cf   -- the consolidation function used to combine all values saved in the
+        same entry: min (the default), max, average, last or count
+name -- the name the archive is queried by. Archives with a step of one
+        second, minute, hour, day or week default to `seconds`, `minutes`,
+        `hours`, `days` or `weeks`, others to the step itself (e.g. `5m`).
+
+The archives must be listed in ascending step order, and each step must be a
+multiple of the first one.
+"""
+STEP_UNITS = {'s': 1, 'm': 60, 'h': 60**2, 'd': 24 * 60**2, 'w': 7 * 24 * 60**2}
+STEP_NAMES = {1: 'seconds', 60: 'minutes', 60**2: 'hours',
+              24 * 60**2: 'days', 7 * 24 * 60**2: 'weeks'}
+CONSOLIDATION_FUNCTIONS = ('min', 'max', 'average', 'last', 'count')
+CF_ALIASES = {'avg': 'average', 'mean': 'average'}
+
+ARCHIVE_PATTERN = re.compile(r'^(?:(\w+)=)?(\d+)([smhdw]):(\d+)(?::(\w+))?$')
+
+
+class Archive(object):
+    """A single round-robin archive.
+
+    Arguments:
+        name    The name the archive is queried by
+        step    The width of each entry, in seconds
+        rows    The number of entries kept
+        cf      The consolidation function (one of CONSOLIDATION_FUNCTIONS)
+
+    Throws:
+        ValueError  If any of the arguments is invalid
+    """
+    def __init__(self, name, step, rows, cf='min'):
+        cf = CF_ALIASES.get(cf, cf)
+        if not re.match(r'^\w+$', name):
+            raise ValueError("Archive name %r must be alphanumeric" % name)
+        if step < 1 or rows < 1:
+            raise ValueError("Archive %s must have a positive step and rows" % name)
+        if cf not in CONSOLIDATION_FUNCTIONS:
+            raise ValueError("Consolidation function must be one of %s"
+                             % ", ".join(CONSOLIDATION_FUNCTIONS))
+        self.name = name.lower()
+        self.step = step
+        self.rows = rows
+        self.cf = cf
+
+    def __eq__(self, other):
+        return isinstance(other, Archive) and self.spec == other.spec
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "Archive(%r, %d, %d, %r)" % (self.name, self.step, self.rows, self.cf)
+
+    @property
+    def spec(self):
+        """The archive in `name=<step>:<rows>:<cf>` form."""
+        return "%s=%ds:%d:%s" % (self.name, self.step, self.rows, self.cf)
+
+    def consolidate(self, value, count, sample):
+        """Fold a new sample into an entry's value.
+
+        Keyword arguments:
+        value  -- the entry's current value (ignored if count is 0)
+        count  -- the number of samples already folded into the entry
+        sample -- the new sample
+
+        Returns the entry's new value.
+        """
+        if self.cf == 'count':
+            return count + 1
+        elif count == 0 or value is None or self.cf == 'last':
+            return sample
+        elif self.cf == 'min':
+            return min(value, sample)
+        elif self.cf == 'max':
+            return max(value, sample)
+        else:
+            # Running mean, so the sum of the samples doesn't need to be kept
+            return value + (sample - value) / float(count + 1)
+
+
+def parse_archives(spec):
+    """Parse a comma-separated list of archives.
+
+    Returns:
+    a list of Archive objects
+
+    Throws ValueError if the list is not valid.
+    """
+    archives = []
+    for item in spec.split(','):
+        match = ARCHIVE_PATTERN.match(item.strip())
+        if match is None:
+            raise ValueError("Archive %r must be of the form [name=]<step>:<rows>[:<cf>]"
+                             % item.strip())
+        name, step, unit, rows, cf = match.groups()
+        step = int(step) * STEP_UNITS[unit]
+        archives.append(Archive(name or STEP_NAMES.get(step, match.group(2) + unit),
+                                step, int(rows), cf or 'min'))
+    validate_archives(archives)
+    return archives
+
+
+def format_archives(archives):
+    """The inverse of `parse_archives()`."""
+    return ", ".join(archive.spec for archive in archives)
+
+
+def validate_archives(archives):
+    """Check a list of archives can be used together.
+
+    Throws ValueError if not.
+    """
+    if not archives:
+        raise ValueError("At least one archive is required")
+    names = [archive.name for archive in archives]
+    if len(set(names)) != len(names):
+        raise ValueError("Archive names must be unique: %s" % ", ".join(names))
+    for previous, archive in zip(archives, archives[1:]):
+        if archive.step < previous.step:
+            raise ValueError("Archives must be in ascending step order")
+    for archive in archives:
+        if archive.step % archives[0].step:
+            raise ValueError("Archive steps must be multiples of %ds" % archives[0].step)
+
+
+# The archives used by databases created without an explicit list
+DEFAULT_ARCHIVES = parse_archives('1m:60:min, 1h:24:min')
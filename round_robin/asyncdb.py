@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import concurrent.futures
+
+from . import open_database
+
+"""Using a round-robin database from asyncio programs.
+
+`AsyncRoundRobinDb` runs the calls of a RoundRobinDb on threads of its own, so
+they never block the event loop:
+
+    rrd = AsyncRoundRobinDb(('SQLite', 'rrd-data.db'))
+    await rrd.save(timestamp, value)
+    rows = await rrd.query('minutes', limit=60)
+    await rrd.close()
+
+Saves are made one at a time by a single writer thread, in the order they were
+called, by the database object opened on that thread. Queries and summaries are
+spread over a few reader threads, each with a database object of its own (a
+SQLite connection, a mapping of the MMap file, or a Redis client sharing the
+writer's connection pool), so they run alongside saves and each other. A
+Memory database only exists in the object that opened it, so its reads are
+made by the writer thread too.
+
+A read waits for the saves called before it, so it always sees them.
+Concurrent calls of the same read (e.g. many requests for the same archive)
+are then answered by a single call.
+"""
+# The number of reader threads
+DEFAULT_READERS = 4
+
+
+class _Worker(object):
+    """A thread, and the RoundRobinDb used by the calls it runs."""
+    def __init__(self, name):
+        self.executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix=name)
+        self.rrd = None
+        # The RoundRobinDb of each series selected on the thread
+        self.series = {}
+        # The number of calls submitted and not yet finished
+        self.pending = 0
+
+    def open(self, opener):
+        self.rrd = opener()
+        self.series[self.rrd.series] = self.rrd
+        return self.rrd
+
+    def call(self, series, operation, args, refresh=False):
+        """Run an operation of the series' RoundRobinDb. With `refresh`, the
+        object first catches up with the saves made by other threads' objects,
+        and the operation reads from a single state of the database."""
+        if series not in self.series:
+            self.series[series] = self.rrd.select(series)
+        rrd = self.series[series]
+        if not refresh:
+            return self._run(rrd, operation, args)
+        with rrd.read_transaction():
+            rrd._refresh()
+            return self._run(rrd, operation, args)
+
+    @staticmethod
+    def _run(rrd, operation, args):
+        if operation == 'last_timestamp':
+            return rrd.last_timestamp
+        return getattr(rrd, operation)(*args)
+
+    def close(self):
+        if self.rrd is not None:
+            self.rrd.close()
+            self.rrd = None
+        self.series = {}
+
+
+class AsyncRoundRobinDb(object):
+    """A RoundRobinDb whose operations are coroutines.
+
+    The database is opened (blocking) when the object is made, with the same
+    arguments as `open_database()`.
+
+    Arguments:
+        backing     The (engine, uri) of the database, as for `open_database()`
+        archives    The archives of a new database, as for `open_database()`
+        readers     The number of reader threads (0 to read on the writer
+                    thread)
+    """
+    def __init__(self, backing, archives=None, readers=DEFAULT_READERS):
+        engine, uri = backing
+        self._writer = _Worker('rrd-writer')
+        rrd = self._writer.executor.submit(
+                self._writer.open, lambda: open_database(backing, archives)).result()
+        if engine.lower() == 'memory':
+            readers = 0
+        elif engine.lower() == 'redis':
+            # The client, and so its connection pool, is thread-safe
+            backing = (engine, rrd.db)
+        self._readers = []
+        for ix in range(readers):
+            reader = _Worker('rrd-reader-%d' % ix)
+            reader.executor.submit(reader.open, lambda: open_database(backing)).result()
+            self._readers.append(reader)
+        # Shared with the objects returned by `select()`
+        self._shared = {'inflight': {}, 'write': None, 'closed': False}
+        self.series = rrd.series
+        self.archives = rrd.archives
+
+    def select(self, series):
+        """Return an AsyncRoundRobinDb for the named series, sharing this
+        object's threads and database objects."""
+        db = object.__new__(type(self))
+        db.__dict__.update(self.__dict__)
+        db.series = series
+        return db
+
+    # Internal method
+    def _submit(self, worker, operation, args, refresh=False):
+        worker.pending += 1
+        future = asyncio.get_running_loop().run_in_executor(
+                worker.executor, worker.call, self.series, operation, args, refresh)
+        def finished(future):
+            worker.pending -= 1
+        future.add_done_callback(finished)
+        return future
+
+    # Internal method
+    async def _write(self, operation, *args):
+        if self._shared['closed']:
+            raise ValueError("The database is closed")
+        # Reads already in progress may not see this write, so later reads
+        # must not share their results
+        self._shared['inflight'].clear()
+        future = self._shared['write'] = self._submit(self._writer, operation, args)
+        return await future
+
+    # Internal method
+    async def _read(self, operation, *args):
+        if self._shared['closed']:
+            raise ValueError("The database is closed")
+        write = self._shared['write']
+        if write is not None and not write.done():
+            # Reads run on other threads, so they wait for the saves called
+            # before them to be made (whether or not they succeed)
+            await asyncio.wait([write])
+        key = (self.series, operation) + args
+        inflight = self._shared['inflight']
+        future = inflight.get(key)
+        if future is None:
+            if self._readers:
+                worker = min(self._readers, key=lambda reader: reader.pending)
+            else:
+                worker = self._writer
+            # A reader's database object hasn't seen the writer's saves, while
+            # the writer's has
+            future = inflight[key] = self._submit(worker, operation, args,
+                                                  refresh=worker is not self._writer)
+            def finished(future):
+                if inflight.get(key) is future:
+                    del inflight[key]
+            future.add_done_callback(finished)
+        result = await asyncio.shield(future)
+        # Each caller gets a list of its own
+        return list(result) if isinstance(result, list) else result
+
+    async def save(self, timestamp, value):
+        """Save a value (see `RoundRobinDb.save()`)."""
+        return await self._write('save', timestamp, value)
+
+    async def save_many(self, points):
+        """Save a batch of values (see `RoundRobinDb.save_many()`)."""
+        return await self._write('save_many', list(points))
+
+    async def save_series(self, points_by_series):
+        """Save batches of values for many series in a single transaction
+        (see `RoundRobinDb.save_series()`)."""
+        return await self._write('save_series', dict(
+                (series, list(points)) for series, points in points_by_series.items()))
+
+    async def query(self, table, start=None, end=None, limit=None):
+        """The entries of a table (see `RoundRobinDb.query()`)."""
+        return await self._read('query', table, start, end, limit)
+
+    async def summary(self, table):
+        """The summary of a table (see `RoundRobinDb.summary()`)."""
+        return await self._read('summary', table)
+
+    async def read_all(self, table):
+        """The entries of a table in storage order (see
+        `RoundRobinDb.read_all()`)."""
+        return await self._read('read_all', table)
+
+    async def last_timestamp(self):
+        """The timestamp of the latest value saved in the series."""
+        return await self._read('last_timestamp')
+
+    async def close(self):
+        """Wait for the calls in progress, and close the database objects and
+        threads. Closes the objects returned by `select()` too."""
+        if self._shared['closed']:
+            return
+        self._shared['closed'] = True
+        loop = asyncio.get_running_loop()
+        for worker in self._readers + [self._writer]:
+            await loop.run_in_executor(worker.executor, worker.close)
+            worker.executor.shutdown()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from . import bucket, format_archives, open_database, parse_archives, range_func
+
+"""Benchmarks of saving and querying, for each backend and retention size.
+
+Run with `python -m round_robin.bench`. Each case is timed one operation at a
+time on a database whose archives have already been filled, and the results
+are written as JSON, e.g. to store as a baseline:
+
+    python -m round_robin.bench --output baseline.json
+
+and later compared against it, listing the cases that got slower:
+
+    python -m round_robin.bench --baseline baseline.json
+
+The cases are:
+
+    save                a save one minute after the last
+    update              a save in the same minute as the last
+    gap_<n>             a save after <n> minutes without values
+    hour_rollover       a save in the first minute of an hour
+    query_<archive>     a query of the whole archive just after a save
+    cached_<archive>    a query of the whole archive again
+    cli_save, cli_query `rrd save` and `rrd query` in a new process (for
+                        backends stored in a file)
+
+Redis is benchmarked against a server given with `--redis`, or else against
+fakeredis if it is installed.
+"""
+BACKENDS = ('sqlite', 'memory', 'mmap', 'redis')
+# The default archives, and a day of minutes with a month of hours
+RETENTIONS = ('1m:60, 1h:24', '1m:1440, 1h:720')
+GAPS = (1, 59, 61)
+
+# How many times each case is timed, and each CLI case (which start a process)
+NUMBER = 200
+CLI_NUMBER = 10
+
+# A result this many times slower than the baseline is a regression
+THRESHOLD = 1.25
+
+# The first timestamp saved
+START = 1483966800
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def statistics(times):
+    """The summary statistics of a list of timings (in seconds), in
+    microseconds."""
+    times = sorted(times)
+    mean = sum(times) / len(times)
+    return {'number': len(times),
+            'mean_us': mean * 1e6,
+            'median_us': times[len(times) // 2] * 1e6,
+            'min_us': times[0] * 1e6,
+            'p95_us': times[min(len(times) - 1, int(len(times) * 0.95))] * 1e6,
+            'ops_per_sec': 1 / mean if mean else None}
+
+
+class Bench(object):
+    """Times the cases for one database.
+
+    Arguments:
+        rrd     The RoundRobinDb to time, which is filled before the cases
+        number  How many times each case is timed
+    """
+    def __init__(self, rrd, number=NUMBER):
+        self.rrd = rrd
+        self.number = number
+        # Fill every archive, so saves overwrite old entries as they would
+        # in a database that has been in use for a while
+        longest = max(archive.step * archive.rows for archive in rrd.archives)
+        step = rrd.archives[0].step
+        points = [(ts, float(ts % 97)) for ts in range_func(START, START + longest, step)]
+        for ix in range_func(0, len(points), 10000):
+            rrd.save_many(points[ix:ix + 10000])
+        self.last = points[-1][0]
+
+    def _save(self, timestamp):
+        self.rrd.save_many([(timestamp, float(timestamp % 97))])
+        self.last = timestamp
+
+    def time(self, operation, prepare=None):
+        """Time `operation()` `number` times, calling `prepare()` (untimed)
+        before each."""
+        times = []
+        for ix in range_func(self.number):
+            if prepare is not None:
+                prepare()
+            start = timer()
+            operation()
+            times.append(timer() - start)
+        return times
+
+    def save(self):
+        return self.time(lambda: self._save(self.last + 60))
+
+    def update(self):
+        return self.time(lambda: self._save(self.last))
+
+    def gap(self, minutes):
+        return self.time(lambda: self._save(self.last + (minutes + 1) * 60))
+
+    def hour_rollover(self):
+        def prepare():
+            # Save in the last minute of the hour
+            self._save(bucket(self.last, 3600, self.rrd.timezone) + 3600 - 60)
+        return self.time(lambda: self._save(self.last + 60), prepare)
+
+    def query(self, table, cached=False):
+        if cached:
+            self.rrd.query(table)
+            return self.time(lambda: self.rrd.query(table))
+        return self.time(lambda: self.rrd.query(table), lambda: self._save(self.last + 60))
+
+    def run(self):
+        """Time every in-process case. Returns a {case: statistics} dict."""
+        results = {'save': self.save(), 'update': self.update()}
+        for minutes in GAPS:
+            results['gap_%d' % minutes] = self.gap(minutes)
+        results['hour_rollover'] = self.hour_rollover()
+        for archive in self.rrd.archives:
+            results['query_' + archive.name] = self.query(archive.name)
+            results['cached_' + archive.name] = self.query(archive.name, cached=True)
+        return dict((case, statistics(times)) for case, times in results.items())
+
+
+def rrd_script():
+    """The path of rrd.py, or `None` if the package was installed without it."""
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        'rrd.py')
+    return path if os.path.exists(path) else None
+
+
+def time_cli(backing, last, number=CLI_NUMBER):
+    """Time `rrd save` and `rrd query` processes for a database.
+
+    Keyword arguments:
+    backing -- the `RRD_DATABASE` of the database
+    last    -- the last timestamp saved in the database
+    """
+    script = rrd_script()
+    if script is None:
+        return {}
+    env = dict(os.environ, RRD_DATABASE=backing,
+               # Make sure no `rrd serve` answers the queries
+               RRD_SOCKET=os.path.join(tempfile.gettempdir(), 'rrd-bench-%d.sock' % os.getpid()))
+    results = {'cli_save': [], 'cli_query': []}
+    with open(os.devnull, 'w') as devnull:
+        for ix in range_func(number):
+            last += 60
+            for case, args in [('cli_save', ['save', str(last), '1.0']),
+                               ('cli_query', ['query', 'minutes'])]:
+                start = timer()
+                subprocess.check_call([sys.executable, script] + args, env=env, stdout=devnull)
+                results[case].append(timer() - start)
+    return dict((case, statistics(times)) for case, times in results.items())
+
+
+def open_redis(redis_url):
+    """A Redis client for a benchmark, with its database emptied.
+
+    Keyword arguments:
+    redis_url -- a `host:port[/db]` server, or `None` for fakeredis
+
+    Returns `None` if there is no server and fakeredis is not installed.
+    """
+    if redis_url is None:
+        try:
+            import fakeredis
+        except ImportError:
+            return None
+        return fakeredis.FakeStrictRedis(server=fakeredis.FakeServer())
+    import redis
+    address, _, db = redis_url.partition('/')
+    host, port = address.split(':')
+    client = redis.StrictRedis(host=host, port=int(port), db=int(db or 0))
+    client.flushdb()
+    return client
+
+
+def run(backends=BACKENDS, retentions=RETENTIONS, number=NUMBER, cli_number=CLI_NUMBER,
+        redis_url=None, log=None):
+    """Benchmark each backend with each retention size.
+
+    Keyword arguments:
+    backends   -- the backends to benchmark, from BACKENDS
+    retentions -- the archives of the databases, as `parse_archives()` strings
+    number     -- how many times each case is timed
+    cli_number -- how many times each CLI case is timed (0 to skip them)
+    redis_url  -- the `host:port[/db]` of a Redis server, whose database is
+                  emptied (default: fakeredis)
+    log        -- a function called with a line of progress for each result
+
+    Returns:
+    the report, a dict with the environment and a list of results
+    """
+    results = []
+    directory = tempfile.mkdtemp(prefix='rrd-bench-')
+    try:
+        for retention in retentions:
+            archives = parse_archives(retention)
+            for backend in backends:
+                path = os.path.join(directory, '%s-%d.rrd' % (backend, len(results)))
+                if backend == 'redis':
+                    client = open_redis(redis_url)
+                    if client is None:
+                        if log:
+                            log("redis: skipped, fakeredis is not installed")
+                        continue
+                    backing = ('Redis', client)
+                elif backend == 'memory':
+                    backing = ('Memory', '')
+                else:
+                    backing = ({'sqlite': 'SQLite', 'mmap': 'MMap'}[backend], path)
+
+                rrd = open_database(backing, archives)
+                bench = Bench(rrd, number)
+                cases = bench.run()
+                rrd.close()
+                if backend in ('sqlite', 'mmap') and cli_number:
+                    cases.update(time_cli(':/'.join(backing), bench.last, cli_number))
+                if backend == 'redis' and redis_url is not None:
+                    client.flushdb()
+
+                for case in sorted(cases):
+                    result = dict(cases[case], backend=backend,
+                                  archives=format_archives(archives), case=case)
+                    results.append(result)
+                    if log:
+                        log("%-7s %-26s %-16s %10.1f us (median)" % (
+                                backend, result['archives'], case, result['median_us']))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': int(time.time()),
+            'number': number,
+            'results': results}
+
+
+def compare(report, baseline, threshold=THRESHOLD):
+    """Compare the median times of a report with those of a baseline report.
+
+    Returns:
+    a list of (backend, archives, case, ratio) tuples for the cases in both,
+    with the ratio of the new median to the baseline's, for the cases whose
+    ratio is above `threshold`
+    """
+    key = lambda result: (result['backend'], result['archives'], result['case'])
+    baseline = dict((key(result), result) for result in baseline['results'])
+    regressions = []
+    for result in report['results']:
+        old = baseline.get(key(result))
+        if old is None or not old['median_us']:
+            continue
+        ratio = result['median_us'] / old['median_us']
+        if ratio > threshold:
+            regressions.append(key(result) + (ratio,))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m round_robin.bench',
+                                     description="Benchmark saves and queries")
+    parser.add_argument('--backends', default=','.join(BACKENDS),
+                        help="comma-separated backends (default: %(default)s)")
+    parser.add_argument('--archives', action='append',
+                        help="the archives of a database, as for RRD_ARCHIVES "
+                             "(repeat for several; default: %s)" % " and ".join(RETENTIONS))
+    parser.add_argument('--number', type=int, default=NUMBER,
+                        help="how many times each case is timed")
+    parser.add_argument('--cli-number', type=int, default=CLI_NUMBER,
+                        help="how many times each CLI case is timed (0 to skip)")
+    parser.add_argument('--redis', metavar='HOST:PORT[/DB]',
+                        help="a Redis server to use instead of fakeredis. "
+                             "Its database is emptied.")
+    parser.add_argument('--output', help="write the JSON report to a file "
+                                         "instead of standard output")
+    parser.add_argument('--baseline', help="a report to compare the results with")
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help="the slowdown counted as a regression (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    backends = [backend.strip().lower() for backend in args.backends.split(',')]
+    for backend in backends:
+        if backend not in BACKENDS:
+            parser.error("unknown backend %r" % backend)
+    log = lambda line: print(line, file=sys.stderr)
+    report = run(backends, args.archives or RETENTIONS, args.number, args.cli_number,
+                 args.redis, log)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        for backend, archives, case, ratio in regressions:
+            log("slower: %s %s %s, %.2fx the baseline" % (backend, archives, case, ratio))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import calendar
+import time
+
+"""Truncating timestamps to the start of their bucket with integer arithmetic.
+
+A bucket is `step` seconds wide. Where buckets start depends on the alignment
+policy (the `tz` argument):
+
+    LOCAL   buckets are aligned to local time, so e.g. hourly buckets start on
+            the local hour and daily buckets at local midnight (the default)
+    UTC     buckets are aligned to UTC, so they never depend on the machine's
+            time zone
+    an int  buckets are aligned to a fixed offset, in seconds east of UTC
+
+Every UTC offset in use is a multiple of 15 minutes, so buckets of a step that
+divides 15 minutes (e.g. minutes) are the same under every policy, and are
+worked out without looking up the offset at all.
+
+Entries are always exactly `step` seconds apart, so on the day of a daylight
+saving time change, buckets longer than the change (e.g. days) are aligned to
+the offset in effect at each timestamp rather than to local midnight.
+
+`bucket_array()` buckets a whole NumPy array of timestamps at once, for bulk
+ingest. NumPy is only imported when it is called.
+"""
+LOCAL = 'local'
+UTC = 'utc'
+
+# Every UTC offset is a multiple of this
+OFFSET_GRANULARITY = 15 * 60
+
+# Batches at least this long are bucketed with NumPy, if it is installed
+BULK_THRESHOLD = 256
+
+# The quarter hour whose local offset was looked up last, and that offset.
+# Consecutive saves nearly always fall in the same quarter hour.
+_last_local_offset = (None, 0)
+
+
+def utc_offset(t, tz=LOCAL):
+    """The offset from UTC, in seconds east, that timestamp `t` is aligned to."""
+    global _last_local_offset
+    if tz == LOCAL:
+        quarter = t // OFFSET_GRANULARITY
+        cached = _last_local_offset
+        if cached[0] != quarter:
+            cached = (quarter, calendar.timegm(time.localtime(t)) - int(t))
+            _last_local_offset = cached
+        return cached[1]
+    elif tz == UTC:
+        return 0
+    elif isinstance(tz, int):
+        return tz
+    raise ValueError("Alignment must be '%s', '%s' or an offset in seconds"
+                     % (LOCAL, UTC))
+
+
+def bucket(t, step, tz=LOCAL):
+    """Truncate timestamp `t` to the start of its `step`-second bucket."""
+    if OFFSET_GRANULARITY % step == 0:
+        return t - t % step
+    return t - (t + utc_offset(t, tz)) % step
+
+
+def bucket_array(timestamps, step, tz=LOCAL):
+    """Truncate an array of timestamps to the start of their buckets.
+
+    Keyword arguments:
+    timestamps -- a NumPy array (or anything `numpy.asarray()` accepts) of
+                  integer timestamps
+    step       -- the width of each bucket in seconds
+    tz         -- the alignment policy
+
+    Returns:
+    an int64 NumPy array of the same shape
+
+    Throws ImportError if NumPy is not installed.
+    """
+    import numpy
+
+    timestamps = numpy.asarray(timestamps, dtype=numpy.int64)
+    if OFFSET_GRANULARITY % step == 0:
+        offsets = 0
+    elif tz == LOCAL:
+        # The offset can only change on a quarter hour, so look it up once
+        # per distinct quarter hour rather than once per timestamp
+        quarters, inverse = numpy.unique(timestamps // OFFSET_GRANULARITY,
+                                         return_inverse=True)
+        offsets = numpy.array([utc_offset(int(q) * OFFSET_GRANULARITY, tz)
+                               for q in quarters], dtype=numpy.int64)[inverse]
+        offsets = offsets.reshape(timestamps.shape)
+    else:
+        offsets = utc_offset(0, tz)
+    return timestamps - (timestamps + offsets) % step
+
+
+def bucket_many(timestamps, step, tz=LOCAL):
+    """Truncate a list of timestamps to the start of their buckets.
+
+    Long lists are bucketed with `bucket_array()` if NumPy is installed.
+
+    Returns:
+    a list of bucket timestamps, in the same order
+    """
+    if len(timestamps) >= BULK_THRESHOLD:
+        try:
+            return bucket_array(timestamps, step, tz).tolist()
+        except ImportError:
+            pass
+    return [bucket(t, step, tz) for t in timestamps]
+
+
+if __name__ == '__main__':
+    # A micro-benchmark of bucketing a timestamp to the hour, as every save
+    # does, compared with the datetime/strftime implementation it replaced
+    import datetime
+    import timeit
+
+    def strftime_hour(t):
+        return int(datetime.datetime.fromtimestamp(t)
+                   .replace(minute=0, second=0, microsecond=0).strftime('%s'))
+
+    number = 100000
+    for name, func in [('strftime', strftime_hour),
+                       ('local', lambda t: bucket(t, 3600)),
+                       ('utc', lambda t: bucket(t, 3600, UTC)),
+                       ('minute', lambda t: bucket(t, 60))]:
+        seconds = min(timeit.repeat(lambda: func(1483967112), number=number, repeat=3))
+        print("%-8s %8.3f us/call" % (name, seconds / number * 1e6))
+
+    try:
+        import numpy
+    except ImportError:
+        pass
+    else:
+        timestamps = numpy.arange(1483967112, 1483967112 + 60 * 10**6, 60)
+        seconds = min(timeit.repeat(lambda: bucket_array(timestamps, 3600),
+                                    number=1, repeat=3))
+        print("%-8s %8.3f us/call (%d timestamps)"
+              % ('array', seconds / len(timestamps) * 1e6, len(timestamps)))
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import json
+import socket
+
+try:
+    import http.client as httplib
+    from urllib.parse import urlencode
+except ImportError:
+    import httplib
+    from urllib import urlencode
+
+from .output import TEXT_FORMATS
+
+"""A client for the server started by `rrd serve` (see `server`)."""
+
+# How long to wait for the server before giving up, in seconds
+TIMEOUT = 5.0
+
+
+class ServerUnavailable(Exception):
+    """No server is listening on the socket."""
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    """An HTTP connection over a Unix socket."""
+    def __init__(self, socket_path, timeout=TIMEOUT):
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class RrdClient(object):
+    """Makes requests to a server listening on a Unix socket.
+
+    Arguments:
+        socket_path     The path of the server's socket
+    """
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self._connection = None
+
+    def _request(self, method, path, params, body=None):
+        """Make a request. Returns (status, body as bytes).
+
+        Throws ServerUnavailable if the server can't be reached.
+        """
+        url = path + '?' + urlencode(sorted(params.items()))
+        try:
+            if self._connection is None:
+                self._connection = UnixHTTPConnection(self.socket_path)
+            self._connection.request(method, url, body)
+            response = self._connection.getresponse()
+            return response.status, response.read()
+        except (socket.error, httplib.HTTPException):
+            self.close()
+            raise ServerUnavailable("No RRD server at %s" % self.socket_path)
+
+    def query(self, archive, series, fmt='text', summary_only=False, start=None, end=None,
+              limit=None, step=None, cf='average'):
+        """The rendered output of a query (see `output.render()`), as a
+        string for text formats and as bytes for binary formats.
+
+        Throws ValueError if the server rejects the query, and
+        ServerUnavailable if it can't be reached.
+        """
+        params = {'archive': archive, 'series': series, 'format': fmt}
+        if summary_only:
+            params['summary_only'] = '1'
+        for name, value in (('since', start), ('until', end), ('last', limit), ('step', step)):
+            if value is not None:
+                params[name] = str(value)
+        if step is not None:
+            params['cf'] = cf
+        status, body = self._request('GET', '/query', params)
+        if status != 200:
+            raise ValueError(body.decode('utf-8').strip())
+        return body.decode('utf-8') if fmt in TEXT_FORMATS else body
+
+    def save(self, lines, series):
+        """Save `[series] timestamp value` lines. Returns the number saved.
+
+        Throws ValueError if the server rejects the lines, and
+        ServerUnavailable if it can't be reached.
+        """
+        status, body = self._request('POST', '/save', {'series': series},
+                                     "".join(line + "\n" for line in lines))
+        if status != 200:
+            raise ValueError(body.decode('utf-8').strip())
+        return json.loads(body.decode('utf-8'))['saved']
+
+    def stats(self, fmt='text'):
+        """The server's stats, as text in one of 'text', 'json' or
+        'prometheus' format.
+
+        Throws ValueError if the server rejects the format, and
+        ServerUnavailable if it can't be reached.
+        """
+        status, body = self._request('GET', '/stats', {'format': fmt})
+        if status != 200:
+            raise ValueError(body.decode('utf-8').strip())
+        return body.decode('utf-8')
+
+    def info(self):
+        """The database the server answers for, as a dict of its 'database'
+        name, default 'series' and 'archives' (see `server`).
+
+        Throws ValueError if the server doesn't report it, and
+        ServerUnavailable if it can't be reached.
+        """
+        status, body = self._request('GET', '/info', {})
+        if status != 200:
+            raise ValueError(body.decode('utf-8').strip())
+        return json.loads(body.decode('utf-8'))
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
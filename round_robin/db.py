@@ -1,39 +1,184 @@
 # -*- coding: utf-8 -*-
+import contextlib
+import json
 import sqlite3
-from . import RoundRobinDb, range_func
+import sys
+from array import array
+try:
+    from urllib.request import pathname2url
+except ImportError:
+    from urllib import pathname2url
+
+from . import (RoundRobinDb, Archive, DEFAULT_ARCHIVES, DEFAULT_SERIES,
+               format_archives, timestamp_hour)
 
 """The interface between the python logic and the SQLite database.
 
 The database structure is as follows:
 
+TABLE Archives:
+    position   name   step   rows   cf
+
 TABLE Meta:
-    name   value
-    
-TABLE Minutes:
-    id   timestamp   value
+    series   name   value
+
+    last_timestamp  the most recent timestamp in the first archive
+    <name>_head     the slot of the most recent entry in the archive's ring
+    <name>_count    the number of values consolidated into that entry
+    <name>_length   the number of slots written (at most the archive's rows)
+    generation      incremented by every write to the series
+
+TABLE Cache:
+    series   name   generation   value
+
+    Query results (as JSON), valid while the series' generation matches.
+    A read writes its results once its snapshot is released, in a short
+    transaction of its own, and keeps them in the process too.
+
+TABLE Rings:
+    series   archive   data
 
-TABLE Hours:
-    id   timestamp   value
+    The values of one archive of one series, as a BLOB of `rows` packed
+    little-endian float64s (NaN for NULL), the value of slot `id` at byte
+    `8 * id`
 
+Archives table lists the archives the database was created with.
 Meta table stores persistent state information (last timestamp entered, etc)
-The Minutes and Hours tables store the data. This class ensures that only 
-the first 60 entries in Minutes and 24 in Hours are actually used.
+Cache table lets every process reading the database share query results
+Rings table stores the data, one row per archive of each series, so reading a
+whole archive is a single row fetch whose values are used without copying, and
+reading a range reads just its bytes with `substr()`. Saves write the new
+values into the BLOB in place, with incremental BLOB I/O where the sqlite3
+module supports it (Python 3.11 and later).
+
+Since the entries behind each ring head are always one step apart, the
+timestamp of every slot is worked out from the Meta values rather than stored.
+
+The schema version is kept in `PRAGMA user_version` (SCHEMA_VERSION). Version
+1 databases, which had a table per archive with a row per entry
+(series, id, timestamp, value), are migrated to the Rings table when opened.
+
+The database is opened in WAL mode, so queries never block (or are blocked by)
+a save in another process. Saves run in `BEGIN IMMEDIATE` transactions that
+re-read the Meta values first, so concurrent savers are serialized, waiting up
+to the busy timeout for each other. Queries read the Meta values and the
+archive from a single snapshot of the database.
 """
+# How long to wait for another connection's write transaction, in seconds
+DEFAULT_TIMEOUT = 5.0
+
+# The version of the database layout, kept in `PRAGMA user_version`
+SCHEMA_VERSION = 2
+
+NAN = float('nan')
+
+def table_name(archive):
+    """The (quoted) name of the version 1 table that held the named archive."""
+    return '"%s"' % archive.capitalize()
+
+def meta_defaults(archives):
+    """The Meta values of a series that has not been saved to."""
+    meta = {'last_timestamp': None, 'generation': 0}
+    for archive in archives:
+        meta[archive.name + '_head'] = None
+        meta[archive.name + '_count'] = None
+        meta[archive.name + '_length'] = None
+    return meta
+
+def pack_values(values):
+    """The BLOB of a list or array of values, with NaN for `None`."""
+    values = array('d', [NAN if value is None else value for value in values])
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values.tobytes()
+
+def unpack_values(data):
+    """The float64 values of a BLOB, with NaN for NULL. On little-endian
+    machines this is a view of the BLOB rather than a copy."""
+    if sys.byteorder == 'little':
+        return memoryview(data).cast('d')
+    values = array('d')
+    values.frombytes(data)
+    values.byteswap()
+    return values
+
+# Each schema is a list of single statements, so they can be run with
+# `execute()` inside a transaction (`executescript()` would commit it first)
+CACHE_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS Cache(Series TEXT, Name TEXT, Generation INTEGER,
+                                         Value TEXT, PRIMARY KEY(Series, Name)) WITHOUT ROWID;
+        """
+
+# Incremental BLOB I/O needs a rowid, so unlike the other tables this is not
+# WITHOUT ROWID
+RINGS_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS Rings(Series TEXT, Archive TEXT, Data BLOB,
+                                         UNIQUE(Series, Archive));
+        """
+
+COMMON_SCHEMA = ["""
+        CREATE TABLE IF NOT EXISTS Meta(Series TEXT, Name TEXT, Value INTEGER,
+                                        PRIMARY KEY(Series, Name)) WITHOUT ROWID;
+        """, """
+        CREATE TABLE IF NOT EXISTS Archives(Position INTEGER PRIMARY KEY, Name TEXT,
+                                            Step INTEGER, Rows INTEGER, Cf TEXT);
+        """, CACHE_SCHEMA]
+
+def schema():
+    """The statements creating any missing tables of a database. The
+    archives' values are all kept in the Rings table, so it doesn't depend on
+    them."""
+    return COMMON_SCHEMA + [RINGS_SCHEMA]
+
+def v1_schema(archives):
+    """The statements creating any missing tables of a version 1 database,
+    with a table per archive, for migrating older databases."""
+    return COMMON_SCHEMA + ["""
+        CREATE TABLE IF NOT EXISTS %s(Series TEXT, Id INTEGER, Timestamp INTEGER,
+                                      Value REAL, PRIMARY KEY(Series, Id)) WITHOUT ROWID;
+        """ % table_name(archive.name) for archive in archives]
+
 class SqliteRoundRobinDb(RoundRobinDb):
     """Creates and manages connection to the SQLite database.
 
     Arguments:
-        sqlite_db   A string filename to the database file
+        sqlite_db   A string filename to the database file, optionally
+                    followed by `?timeout=<seconds>`
+        archives    The list of archives of a new database (default:
+                    DEFAULT_ARCHIVES)
+        timeout     How long to wait for other connections' writes, in seconds
+                    (default: DEFAULT_TIMEOUT)
+        read_only   Open an existing database file without ever writing to it:
+                    it isn't created or upgraded, and saves fail
     
     Throws:
-        SQLite.Error    If database initialization fails
+        SQLite.Error    If database initialization fails, or a `read_only`
+                        file can't be opened
+        ValueError      If `archives` differs from the database's archives, or
+                        a `read_only` database doesn't have the current schema
 
     """
-    def __init__(self, sqlite_db):
-        self.connection = sqlite3.connect(sqlite_db)
+    def __init__(self, sqlite_db, archives=None, timeout=DEFAULT_TIMEOUT, read_only=False):
+        if '?timeout=' in sqlite_db:
+            sqlite_db, timeout = sqlite_db.split('?timeout=')
+            timeout = float(timeout)
+        self.read_only = read_only
+        if read_only:
+            # The file is opened with SQLite's read-only flag, so nothing can
+            # create or change it
+            sqlite_db = 'file:%s?mode=ro' % pathname2url(sqlite_db)
+        # Transactions are begun explicitly, as writes or snapshots
+        self.connection = sqlite3.connect(sqlite_db, timeout=timeout,
+                                          isolation_level=None, uri=read_only)
+        # Shared with the objects returned by `select()`
+        self._transaction = {'depth': 0, 'cache': []}
+        self._timeout = timeout
+        # The rowid of each (series, archive) in Rings, for BLOB I/O
+        self._ring_rowids = {}
         
         # Check if the database has been initialized, and create it if not
-        self._check_and_init_db()
+        self._check_and_init_db(archives)
+        self._load_meta()
 
     # Our class can cause exceptions, so provide __enter__ and __exit__ methods
     # to allow Python to automatically clean up after itself when exceptions occur.
@@ -43,90 +188,442 @@ class SqliteRoundRobinDb(RoundRobinDb):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
         if self.connection:
-            self.connection.close()        
+            self.flush_buffer()
+            self.connection.close()
+            self.connection = None
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Commit all saves made in the context in a single transaction.
+
+        The transaction takes the database's write lock as it begins (waiting
+        up to the busy timeout for other writers), so nothing else can write
+        between a save's reads and writes.
+        """
+        if self._transaction['depth'] == 0:
+            if self.connection.in_transaction:
+                # A read transaction can't become a write transaction
+                self.connection.commit()
+            self.connection.execute("BEGIN IMMEDIATE;")
+        self._transaction['depth'] += 1
+        try:
+            yield self
+        except:
+            self._transaction['depth'] -= 1
+            if self._transaction['depth'] == 0:
+                self.connection.rollback()
+                self._load_meta() # discard our view of the rolled back saves
+                self._ring_rowids.clear() # rings inserted by the saves are gone
+            raise
+        else:
+            self._transaction['depth'] -= 1
+            self._commit()
+
+    @contextlib.contextmanager
+    def read_transaction(self):
+        """Make all reads in the context from a single state of the database."""
+        if self.connection.in_transaction:
+            yield self # already in a read or write transaction
+            return
+        self.connection.execute("BEGIN;")
+        try:
+            yield self
+        finally:
+            # The transaction only read, so this just releases its snapshot
+            if self.connection.in_transaction:
+                self.connection.commit()
+            self._write_cache()
+
+    # Subclass method
+    def save_many(self, points):
+        with self.transaction():
+            self._refresh_meta()
+            super(SqliteRoundRobinDb, self).save_many(points)
+
+    # Subclass method
+    def query(self, table, start=None, end=None, limit=None):
+        with self.read_transaction():
+            return super(SqliteRoundRobinDb, self).query(table, start, end, limit)
+
+    # Internal method
+    def _commit(self):
+        """Commit, unless we are inside a `transaction()`."""
+        if self._transaction['depth'] == 0 and self.connection.in_transaction:
+            self.connection.commit()
+            if self.stats is not None:
+                self.stats.count('commits')
 
     # Internal method
-    def _check_and_init_db(self):
+    def _check_and_init_db(self, archives=None):
         """ Check if database is initalized, and initializes if not.
 
-        Throws SQLite.Error if database initialization fails.
+        A database with the current SCHEMA_VERSION only has its archives read,
+        so opening it costs two statements. Otherwise the database is created
+        or upgraded in a single write transaction, so a failed upgrade leaves
+        it as it was, and connections opening it meanwhile wait for the
+        upgrade and then find it done.
+
+        A `read_only` database is never created or upgraded.
+
+        Throws SQLite.Error if database initialization fails, and ValueError
+        if a `read_only` database doesn't have the current schema.
         """
         cur = self.connection.cursor()
-        initialized = True
-        try:
-            cur.execute("SELECT * FROM Hours LIMIT 1;")
-        except sqlite3.OperationalError:
-            initialized = False
+        cur.execute("PRAGMA user_version;")
+        version = cur.fetchone()[0]
+        if version != SCHEMA_VERSION and self.read_only:
+            if version == 0:
+                raise ValueError("Not a round robin database")
+            raise ValueError("Database has schema version %d rather than %d; open it for "
+                             "writing to upgrade it" % (version, SCHEMA_VERSION))
+        if version != SCHEMA_VERSION:
+            try:
+                # The journal mode is kept in the database file, so this is
+                # only needed when it is created or upgraded. It can't be
+                # changed inside a transaction.
+                self.connection.execute("PRAGMA journal_mode=WAL;")
+            except sqlite3.OperationalError:
+                pass # e.g. a read-only database, which keeps its journal mode
+            cur.execute("BEGIN IMMEDIATE;")
+            try:
+                # Another connection may have upgraded the database while we
+                # waited for the write lock
+                cur.execute("PRAGMA user_version;")
+                if cur.fetchone()[0] != SCHEMA_VERSION:
+                    self._upgrade_db(archives)
+                    cur.execute("PRAGMA user_version=%d;" % SCHEMA_VERSION)
+                self.connection.commit()
+            except:
+                self.connection.rollback()
+                raise
+        self._load_archives(archives)
 
-        if initialized and len(cur.fetchall()) > 0:
-            # assume that since we didn't error, and have some Meta items 
-            # configured, our database is in a sane format
+    # Internal method
+    def _upgrade_db(self, archives=None):
+        """Create the tables of a new database, or bring an older one up to
+        the current schema, inside the caller's transaction."""
+        cur = self.connection.cursor()
+        cur.execute("SELECT name FROM sqlite_master WHERE type='table';")
+        tables = set(row[0] for row in cur.fetchall())
+
+        if 'Archives' not in tables and 'Minutes' in tables and 'Hours' in tables:
+            # Database created before archives were configurable
+            cur.execute("PRAGMA table_info(Minutes);")
+            if 'Series' not in [row[1] for row in cur.fetchall()]:
+                # Database created before series were supported
+                self._migrate_single_series()
+            else:
+                self._create_archives(DEFAULT_ARCHIVES, v1_schema(DEFAULT_ARCHIVES))
+            tables.add('Archives')
+
+        if 'Archives' in tables:
+            # Database created before query results were cached
+            cur.execute(CACHE_SCHEMA)
+            self._load_archives()
+            if 'Rings' not in tables:
+                # Database created with a row per entry
+                self._migrate_to_rings()
             return
-        
+
         # Set up our empty RRD database
-        cur.executescript("""
-            DROP TABLE IF EXISTS Minutes;
-            DROP TABLE IF EXISTS Hours;
-            CREATE TABLE Minutes(Id INTEGER PRIMARY KEY, Timestamp INTEGER, Value REAL);
-            CREATE TABLE Hours(Id INTEGER PRIMARY KEY, Timestamp INTEGER, Value REAL);
-            """)
-
-        # Create empty entries for our RRD
-        mins = [(i, None, None) for i in range_func(60)]
-        hours = [(i, None, None) for i in range_func(24)]
-
-        cur.executemany("INSERT INTO Minutes VALUES(?, ?, ?);", mins)
-        cur.executemany("INSERT INTO Hours VALUES(?, ?, ?);", hours)
-        
-        self.connection.commit()
+        self._create_archives(archives or DEFAULT_ARCHIVES)
+
+    # Internal method
+    def _load_archives(self, archives=None):
+        """Read the archives the database was created with.
+
+        Throws ValueError if `archives` is given and differs from them.
+        """
+        cur = self.connection.cursor()
+        cur.execute("SELECT Name, Step, Rows, Cf FROM Archives ORDER BY Position;")
+        self.archives = [Archive(*row) for row in cur.fetchall()]
+        if archives is not None and archives != self.archives:
+            raise ValueError("Database was created with archives %s"
+                             % format_archives(self.archives))
+
+    # Internal method
+    def _create_archives(self, archives, statements=None):
+        """Create the tables for the archives (with `schema()`, unless other
+        statements are given), and record them in Archives."""
+        self.archives = archives
+        cur = self.connection.cursor()
+        for statement in statements or schema():
+            cur.execute(statement)
+        cur.executemany("INSERT INTO Archives VALUES(?, ?, ?, ?, ?);",
+                        [(ix, archive.name, archive.step, archive.rows, archive.cf)
+                         for ix, archive in enumerate(archives)])
+
+    # Internal method
+    def _migrate_single_series(self):
+        """Move the data of a single-series database into the default series.
+
+        Databases created before the Meta table existed have their ring heads
+        found with a (one-off) scan of the Minutes and Hours tables.
+        """
+        cur = self.connection.cursor()
+        cur.execute("SELECT name FROM sqlite_master WHERE name='Meta';")
+        if cur.fetchone():
+            cur.execute("SELECT Name, Value FROM Meta;")
+            meta = dict(cur.fetchall())
+        else:
+            cur.execute("SELECT Id, Timestamp FROM Minutes ORDER BY Timestamp DESC LIMIT 1;")
+            minutes_head, last_ts = cur.fetchone() or (None, None)
+            hours_head = None
+            if last_ts is not None:
+                cur.execute("SELECT Id FROM Hours WHERE Timestamp=?;",
+                            (timestamp_hour(last_ts),))
+                hours_head = (cur.fetchone() or (None,))[0]
+            else:
+                minutes_head = None
+            meta = {'last_timestamp': last_ts,
+                    'minutes_head': minutes_head,
+                    'hours_head': hours_head}
+
+        cur.execute("ALTER TABLE Minutes RENAME TO OldMinutes;")
+        cur.execute("ALTER TABLE Hours RENAME TO OldHours;")
+        cur.execute("DROP TABLE IF EXISTS Meta;")
+        self._create_archives(DEFAULT_ARCHIVES, v1_schema(DEFAULT_ARCHIVES))
+        for table in ('Minutes', 'Hours'):
+            cur.execute("INSERT INTO %s SELECT ?, Id, Timestamp, Value FROM Old%s "
+                        "WHERE Timestamp IS NOT NULL;" % (table, table), (DEFAULT_SERIES,))
+            cur.execute("DROP TABLE Old%s;" % table)
+        cur.executemany("INSERT INTO Meta VALUES(?, ?, ?);",
+                        [(DEFAULT_SERIES, name, meta[name]) for name in meta])
+
+    # Internal method
+    def _migrate_to_rings(self):
+        """Pack the rows of each version 1 archive table into the Rings table."""
+        cur = self.connection.cursor()
+        cur.execute(RINGS_SCHEMA)
+        for archive in self.archives:
+            # Entries only had rows once they had been written
+            rings, lengths = {}, {}
+            cur.execute("SELECT Series, Id, Value FROM "+table_name(archive.name)+
+                        " WHERE Timestamp IS NOT NULL AND Id < ?;", (archive.rows,))
+            for series, id, value in cur.fetchall():
+                if series not in rings:
+                    rings[series] = [None] * archive.rows
+                    lengths[series] = 0
+                rings[series][id] = value
+                lengths[series] += 1
+            cur.executemany("INSERT INTO Rings VALUES(?, ?, ?);",
+                            [(series, archive.name, pack_values(ring))
+                             for series, ring in rings.items()])
+            cur.executemany("INSERT OR REPLACE INTO Meta VALUES(?, ?, ?);",
+                            [(series, archive.name + '_length', length)
+                             for series, length in lengths.items()])
+            cur.execute("DROP TABLE "+table_name(archive.name)+";")
+
+    # Internal method
+    def _load_meta(self):
+        """Load the Meta values for the selected series."""
+        if self.stats is not None:
+            self.stats.count('meta_loads')
+        cur = self.connection.cursor()
+        cur.execute("SELECT Name, Value FROM Meta WHERE Series=?;", (self.series,))
+        self._meta = meta_defaults(self.archives)
+        self._meta.update(cur.fetchall())
+
+    # Subclass method
+    def _select_series(self):
+        self._load_meta()
+
+    # Subclass method
+    def series_names(self):
+        cur = self.connection.cursor()
+        cur.execute("SELECT Series FROM Meta WHERE Name='last_timestamp' AND Value IS NOT NULL "
+                    "ORDER BY Series;")
+        return [row[0] for row in cur.fetchall()]
+
+    # Subclass method
+    def _instrument_backend(self):
+        stats = self.stats
+        # Read transactions end with a COMMIT too, so commits are counted by
+        # `_commit()` instead
+        self.connection.set_trace_callback(lambda statement: stats.count('sql_statements'))
+
+    # Internal method
+    def _refresh_meta(self):
+        """Load the Meta values again if another connection has written to
+        the series since they were loaded. Returns the generation."""
+        cur = self.connection.cursor()
+        cur.execute("SELECT Value FROM Meta WHERE Series=? AND Name='generation';",
+                    (self.series,))
+        generation = (cur.fetchone() or (0,))[0]
+        if generation != self._meta['generation']:
+            self._load_meta()
+        return generation
+
+    @property
+    def generation(self):
+        return self._refresh_meta()
+
+    # Subclass method
+    def _load_cached(self, key):
+        cached = super(SqliteRoundRobinDb, self)._load_cached(key)
+        if cached is not None and cached[0] == self._meta['generation']:
+            return cached
+        cur = self.connection.cursor()
+        cur.execute("SELECT Generation, Value FROM Cache WHERE Series=? AND Name=?;",
+                    (self.series, key))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        cached = (row[0], json.loads(row[1]))
+        if cached[0] == self._meta['generation']:
+            # Stored by another process, and kept here so it isn't read again
+            super(SqliteRoundRobinDb, self)._store_cached(key, *cached)
+        return cached
+
+    # Subclass method
+    def _store_cached(self, key, generation, value):
+        super(SqliteRoundRobinDb, self)._store_cached(key, generation, value)
+        entry = (self.series, key, generation, json.dumps(value))
+        if self._transaction['depth']:
+            # A write transaction already holds the lock
+            self.connection.execute("INSERT OR REPLACE INTO Cache VALUES(?, ?, ?, ?);", entry)
+            return
+        # Writing inside a read transaction would end its snapshot, so the
+        # entry is written once the read is over
+        self._transaction['cache'].append(entry)
+        if not self.connection.in_transaction:
+            self._write_cache()
+
+    # Internal method
+    def _write_cache(self):
+        """Write the cache entries stored by reads, in a short transaction of
+        their own, so other processes share them.
+
+        The write doesn't wait for the write lock: the cache is only an
+        optimisation, so the entries are dropped when another connection is
+        writing, or the database is read-only.
+        """
+        entries = self._transaction['cache']
+        if not entries or self.connection.in_transaction:
+            return
+        self._transaction['cache'] = []
+        self.connection.execute("PRAGMA busy_timeout=0;")
+        try:
+            with self.transaction():
+                self.connection.executemany("INSERT OR REPLACE INTO Cache VALUES(?, ?, ?, ?);",
+                                            entries)
+        except sqlite3.OperationalError:
+            pass
+        finally:
+            self.connection.execute("PRAGMA busy_timeout=%d;" % (self._timeout * 1000))
 
     # Internal method
-    def _update_table_row(self, table, id, timestamp, value):
+    def _ring_rowid(self, archive, create=False):
+        """The rowid of the archive's ring in Rings, inserting an empty ring
+        if `create` is set and the series has none. Returns `None` otherwise."""
+        key = (self.series, archive.name)
+        if key not in self._ring_rowids:
+            cur = self.connection.cursor()
+            cur.execute("SELECT rowid FROM Rings WHERE Series=? AND Archive=?;", key)
+            row = cur.fetchone()
+            if row is None:
+                if not create:
+                    return None
+                cur.execute("INSERT INTO Rings VALUES(?, ?, ?);",
+                            key + (pack_values([None] * archive.rows),))
+                row = (cur.lastrowid,)
+            self._ring_rowids[key] = row[0]
+        return self._ring_rowids[key]
+
+    # Internal method
+    def _write_slots(self, archive, index, values):
+        """Write consecutive slots of the archive's ring, starting at `index`
+        and wrapping around its end."""
+        data = pack_values(values)
+        first = min(len(values), archive.rows - index)
+        rowid = self._ring_rowid(archive, create=True)
+        self._write_blob(rowid, index * 8, data[:first * 8])
+        if first < len(values):
+            self._write_blob(rowid, 0, data[first * 8:])
+
+    # Internal method
+    def _write_blob(self, rowid, offset, data):
+        if hasattr(self.connection, 'blobopen'):
+            with self.connection.blobopen('Rings', 'Data', rowid) as blob:
+                blob.seek(offset)
+                blob.write(data)
+            return
+        # Without incremental BLOB I/O, the whole BLOB is written again
         cur = self.connection.cursor()
-        cur.execute("UPDATE "+table+" SET Timestamp=?, Value=? WHERE Id=?;", 
-                (timestamp, value, id))
+        cur.execute("SELECT Data FROM Rings WHERE rowid=?;", (rowid,))
+        blob = bytearray(cur.fetchone()[0])
+        blob[offset:offset + len(data)] = data
+        cur.execute("UPDATE Rings SET Data=? WHERE rowid=?;", (bytes(blob), rowid))
+
+    # Internal method
+    def _slot_rows(self, archive, first, values):
+        """The (timestamp, value) rows of consecutive slots of the archive's
+        ring, starting at slot `first`, given their values."""
+        head = self._meta[archive.name + '_head']
+        length = self._meta[archive.name + '_length'] or 0
+        if head is None or not length:
+            return [(None, None)] * len(values)
+        last = self.last_archive_timestamp(archive.name)
+        # How far behind the head each slot is; slots that far back have
+        # only been written if that is less than the length
+        offset = (head - first) % archive.rows
+        rows = []
+        for value in values:
+            if offset < length:
+                rows.append((last - offset * archive.step, None if value != value else value))
+            else:
+                rows.append((None, None))
+            offset = offset - 1 if offset else archive.rows - 1
+        return rows
 
     # Subclass method
     def read_all(self, table):
         """Read all values from the specified table.
 
         Keyword arguments:
-        table -- One of 'minutes' or 'hours'
+        table -- The name of one of the archives, e.g. 'minutes' or 'hours'
 
         Returns:
         a list of (timestamp, value) tuples representing the state of the table
-        ordered by timestamp value ascending."""
-        # use the table parameter to query the appropriate table
-        # simple sanity check to make sure the user isn't passing in garbage 
-        if table.lower() == "minutes":
-            tablename = "Minutes"
-        elif table.lower() == "hours":
-            tablename = "Hours"
-        else:
-            raise ValueError("Table must be one of 'hours' or 'minutes'")
-
-        ## We could use SQL ORDER BY (which would be more efficient than Python
-        ## sorting if we were only selecting a small subset of data and the db 
-        ## was large), but since we want everything, it's easier to just do our 
-        ## own array splicing in memory.
+        ordered by index."""
+        archive = self.archive(table)
+        cur = self.connection.cursor()
+        cur.execute("SELECT Data FROM Rings WHERE Series=? AND Archive=?;",
+                    (self.series, archive.name))
+        row = cur.fetchone()
+        if row is None:
+            return [(None, None)] * archive.rows
+        return self._slot_rows(archive, 0, unpack_values(row[0]).tolist())
 
+    # Subclass method
+    def read_range(self, table, offset, count):
+        archive = self.archive(table)
+        head = self._meta[archive.name + '_head']
+        if head is None:
+            return [(None, None)] * count
+
+        # The entries are a run of slots, which may wrap around the end of the
+        # ring, so just their bytes are read, in at most two pieces
+        first = (head - offset - count + 1) % archive.rows
+        wrapped = max(0, first + count - archive.rows)
         cur = self.connection.cursor()
-        cur.execute("SELECT timestamp, value FROM (SELECT * FROM "+tablename+
-                    " ORDER BY id);") # discard the id value
-        return cur.fetchall()
+        cur.execute("SELECT substr(Data, ?, ?), substr(Data, 1, ?) FROM Rings "
+                    "WHERE Series=? AND Archive=?;",
+                    (first * 8 + 1, (count - wrapped) * 8, wrapped * 8,
+                     self.series, archive.name))
+        row = cur.fetchone()
+        if row is None:
+            return [(None, None)] * count
+        return self._slot_rows(archive, first, unpack_values(row[0] + row[1]).tolist())
 
     @property
     def last_timestamp(self):
-        if hasattr(self, '_last_timestamp') and self._last_timestamp is not None:
-            return self._last_timestamp # use memoization to save a DB call
-
-        cur = self.connection.cursor()
-        cur.execute("SELECT timestamp FROM Minutes ORDER BY timestamp DESC LIMIT 1;")
-        last_ts = cur.fetchone()[0]
-        self._last_timestamp = last_ts
-
-        return self._last_timestamp
+        # The Meta table is loaded on open and kept up to date on every save
+        return self._meta['last_timestamp']
 
     # Subclass method
     def get_timestamp_index(self, timestamp, table, default=None):
@@ -134,14 +631,19 @@ class SqliteRoundRobinDb(RoundRobinDb):
         # Call superclass for things like parameter sanitizing, etc.
         super(self.__class__, self).get_timestamp_index(timestamp, table)
 
-        cur = self.connection.cursor()
-        cur.execute("SELECT id FROM "+table+" WHERE timestamp=?;", (timestamp,))
-        index = cur.fetchone()
-        if index is None:
+        if timestamp is None or self.last_timestamp is None:
             # means this is a new database, so start storing at index 0.
             return default
-        else:
-            return index[0]
+
+        # Work out how many entries behind the ring head the timestamp is
+        archive = self.archive(table)
+        head = self._meta[archive.name + '_head']
+        offset, remainder = divmod(self.last_archive_timestamp(table) - timestamp,
+                                   archive.step)
+        if head is None or remainder or \
+                not 0 <= offset < (self._meta[archive.name + '_length'] or 0):
+            return default
+        return (head - offset) % archive.rows
 
     # Subclass method
     def get_timestamp_value(self, table, timestamp):
@@ -149,13 +651,35 @@ class SqliteRoundRobinDb(RoundRobinDb):
         # Call superclass for things like parameter sanitizing, etc.
         super(self.__class__, self).get_timestamp_value(table, timestamp)
 
+        ts_index = self.get_timestamp_index(timestamp, table)
+        if ts_index is None:
+            return None
+
         cur = self.connection.cursor()
-        cur.execute("SELECT value FROM "+table+" WHERE Timestamp=?;", (timestamp,))
-        value = cur.fetchone()
-        return value[0]
+        cur.execute("SELECT substr(Data, ?, 8) FROM Rings WHERE Series=? AND Archive=?;",
+                    (ts_index * 8 + 1, self.series, self.archive(table).name))
+        value = unpack_values(cur.fetchone()[0])[0]
+        return None if value != value else value
+
+    # Subclass method
+    def get_head_count(self, table):
+        super(self.__class__, self).get_head_count(table)
+        archive = self.archive(table)
+        if self._meta[archive.name + '_head'] is None:
+            return 0
+        # Databases created before archives were configurable don't record
+        # the count, but only ever consolidated with `min`
+        count = self._meta[archive.name + '_count']
+        return 1 if count is None else count
 
     # Subclass method
     def update_timestamp(self, table, timestamp, value):
+        with self.transaction():
+            self._refresh_meta()
+            self._update_timestamp(table, timestamp, value)
+
+    # Internal method
+    def _update_timestamp(self, table, timestamp, value):
         # Call superclass for things like parameter sanitizing, etc.
         super(self.__class__, self).update_timestamp(table, timestamp, value)
 
@@ -164,25 +688,44 @@ class SqliteRoundRobinDb(RoundRobinDb):
         if ts_index is None:
             raise ValueError("Timestamp does not exist in the database.")
         else:
-            self._update_table_row(table, ts_index, timestamp, value)
-            self.connection.commit()
+            self._write_slots(self.archive(table), ts_index, [value])
+            self._meta['generation'] += 1
+            self.connection.execute("INSERT OR REPLACE INTO Meta VALUES(?, 'generation', ?);",
+                                    (self.series, self._meta['generation']))
+            self._commit()
 
     # Subclass method
     def save_timestamps(self, data):
-        # Update values in the `Minute` table
-        start_index = self.get_timestamp_index(self.last_timestamp, 'Minutes', -1) + 1
-        for ix in range_func(len(data['minutes'])):
-            ts, value = data['minutes'][ix]
-            self._update_table_row('Minutes', (ix + start_index) % 60, ts, value)
-            
-
-        # Update values in the `Hour` table 
-        start_index = self.get_timestamp_index(self.last_hour_timestamp, 'Hours', -1) + 1
-        for ix in range_func(len(data['hours'])):
-            ts, value = data['hours'][ix]
-            self._update_table_row('Hours', (ix + start_index) % 24, ts, value)
-
-        self.connection.commit()
-
-        # Invalidate memoized last timestamp, as it is no longer valid.
-        self._last_timestamp = None
+        # Replace the latest entries first, while their timestamps still resolve
+        for table, (ts, value) in data.get('updates', {}).items():
+            ts_index = self.get_timestamp_index(ts, table)
+            if ts_index is None:
+                raise ValueError("Timestamp does not exist in the database.")
+            self._write_slots(self.archive(table), ts_index, [value])
+
+        meta = dict(self._meta)
+        for archive in self.archives:
+            # Only the most recent `rows` entries can be stored
+            rows = data[archive.name][-archive.rows:]
+            if not rows:
+                continue
+            head = self._meta[archive.name + '_head']
+            start_index = ((-1 if head is None else head) + 1) % archive.rows
+            # The archive's new entries are written in (at most) two pieces
+            self._write_slots(archive, start_index, [value for ts, value in rows])
+            meta[archive.name + '_head'] = (start_index + len(rows) - 1) % archive.rows
+            meta[archive.name + '_length'] = min((meta[archive.name + '_length'] or 0)
+                                                 + len(rows), archive.rows)
+        for table, count in data['counts'].items():
+            meta[table + '_count'] = count
+        if data[self.archives[0].name]:
+            meta['last_timestamp'] = data[self.archives[0].name][-1][0]
+        meta['generation'] += 1
+
+        # Advance the ring heads in the same transaction as the new entries
+        cur = self.connection.cursor()
+        cur.executemany("INSERT OR REPLACE INTO Meta VALUES(?, ?, ?);",
+                        [(self.series, name, value) for name, value in meta.items()
+                         if value != self._meta[name]])
+        self._commit()
+        self._meta = meta
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+import glob
+import json
+import multiprocessing
+import os
+
+from . import DEFAULT_SERIES, open_database
+from .summary import RunningSummary
+
+"""Querying the same archive of many databases at once, e.g. one per host.
+
+`query_many()` opens each database file in a pool of worker processes, which
+read the archive in parallel, and returns the rows of each file. Since each
+file is read by a process of its own, the time taken shrinks with the number
+of cores rather than growing with the number of files:
+
+    results = query_many(expand_paths('hosts/'), 'minutes')
+    for ts, summary in aggregate(results):
+        print(ts, summary.min, summary.average, summary.max)
+
+`aggregate()` combines the rows of every file into the `Summary` of the values
+of each timestamp, and `write_results()` writes either for `rrd query-many`.
+"""
+# The formats `write_results()` supports
+FORMATS = ('text', 'csv', 'json', 'ndjson')
+
+
+def expand_paths(pattern):
+    """The database files named by a glob pattern, or the `*.db` files in a
+    directory, sorted."""
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*.db')
+    return sorted(path for path in glob.glob(pattern) if os.path.isfile(path))
+
+
+def _query_file(args):
+    """Query one file, in a worker process. Returns (path, rows, error).
+
+    SQLite files are opened read-only, so a file that isn't a database of the
+    current schema is reported rather than created or upgraded.
+    """
+    path, engine, table, series, start, end, limit = args
+    try:
+        if engine.lower() == 'sqlite':
+            from .db import SqliteRoundRobinDb
+            rrd = SqliteRoundRobinDb(path, read_only=True)
+        else:
+            rrd = open_database((engine, path))
+        try:
+            db = rrd if series == rrd.series else rrd.select(series)
+            return path, list(db.iter_query(table, start, end, limit)), None
+        finally:
+            rrd.close()
+    except Exception as e:
+        # Reported with the file's name, rather than failing the whole query
+        return path, None, str(e) or type(e).__name__
+
+
+def query_many(paths, table, series=DEFAULT_SERIES, engine='SQLite', start=None,
+               end=None, limit=None, processes=None):
+    """Query the same table of many databases in parallel.
+
+    Keyword arguments:
+    paths     -- the database files
+    table     -- the name of one of the archives, e.g. 'minutes'
+    series    -- the series to read from each file
+    engine    -- the engine of the files, as for `open_database()`
+    start, end, limit -- only read the entries in this range (see
+                 `RoundRobinDb.query()`)
+    processes -- the number of worker processes (default: the number of
+                 cores, and no more than the number of files)
+
+    Returns:
+    a list of (path, rows, error) tuples in the order of `paths`, with the
+    (timestamp, value) rows of each file, or `None` rows and the error message
+    of a file that could not be read
+    """
+    jobs = [(path, engine, table, series, start, end, limit) for path in paths]
+    processes = min(processes or multiprocessing.cpu_count(), len(jobs))
+    if processes <= 1:
+        return [_query_file(job) for job in jobs]
+    pool = multiprocessing.Pool(processes)
+    try:
+        # Files are handed out a few at a time, so a slow file doesn't hold
+        # up the rest
+        return pool.map(_query_file, jobs, chunksize=max(1, len(jobs) // (processes * 4)))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def aggregate(results):
+    """Combine the rows of many files.
+
+    Returns:
+    a list of (timestamp, Summary) tuples, oldest first, summarizing the values
+    the files hold for each timestamp (a count of 0 if they are all NULL)
+    """
+    summaries = {}
+    for path, rows, error in results:
+        for ts, value in rows or ():
+            if ts not in summaries:
+                summaries[ts] = RunningSummary()
+            summaries[ts].add(value)
+    return [(ts, summaries[ts].summary) for ts in sorted(summaries)]
+
+
+def write_results(writer, table, results, combined=False):
+    """Write the results of `query_many()` to an `output.OutputWriter`.
+
+    Keyword arguments:
+    writer   -- an OutputWriter in one of FORMATS
+    table    -- the name of the archive that was queried
+    results  -- the results of `query_many()`
+    combined -- write the `aggregate()` of the files rather than the rows of
+                each file
+
+    Throws ValueError if the writer's format is not one of FORMATS.
+    """
+    fmt = writer.fmt
+    if fmt not in FORMATS:
+        raise ValueError("Format must be one of %s" % ", ".join(FORMATS))
+    if combined:
+        rows = aggregate(results)
+        if fmt == 'text':
+            for ts, summary in rows:
+                if summary.count:
+                    writer.write("%d, min: %.2f, avg: %.2f, max: %.2f (%d)\n" % (
+                            ts, summary.min, summary.average, summary.max, summary.count))
+                else:
+                    writer.write("%d, NULL\n" % ts)
+        elif fmt == 'csv':
+            writer.write("timestamp,count,min,avg,max\n")
+            for ts, summary in rows:
+                writer.write("%d,%d,%s,%s,%s\n" % ((ts, summary.count) + tuple(
+                        "" if v is None else repr(v)
+                        for v in (summary.min, summary.average, summary.max))))
+        elif fmt == 'json':
+            writer.write(json.dumps({'archive': table, 'files': len(results), 'rows': [
+                    dict(summary._asdict(), timestamp=ts) for ts, summary in rows]}) + "\n")
+        else:
+            for ts, summary in rows:
+                writer.write(json.dumps(dict(summary._asdict(), timestamp=ts)) + "\n")
+        return
+
+    results = [(path, rows) for path, rows, error in results if rows is not None]
+    if fmt == 'text':
+        for path, rows in results:
+            for ts, value in rows:
+                writer.write("%s, %d, %s\n" % (path, ts, "NULL" if value is None
+                                                else "%.2f" % value))
+    elif fmt == 'csv':
+        writer.write("file,timestamp,value\n")
+        for path, rows in results:
+            for ts, value in rows:
+                writer.write("%s,%d,%s\n" % (path, ts, "" if value is None else repr(value)))
+    elif fmt == 'json':
+        writer.write(json.dumps({'archive': table, 'files': dict(
+                (path, [list(row) for row in rows]) for path, rows in results)}) + "\n")
+    else:
+        for path, rows in results:
+            for ts, value in rows:
+                writer.write(json.dumps({'file': path, 'timestamp': ts, 'value': value}) + "\n")
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+import itertools
+import os
+import struct
+import sys
+from array import array
+
+from . import (RoundRobinDb, DEFAULT_ARCHIVES, DEFAULT_SERIES, format_archives,
+               parse_archives, range_func)
+
+"""An in-process RoundRobinDb that keeps each table in a fixed-size array.
+
+Each table is an `array('d')` of values, with NaN standing in for NULL, an
+integer head pointing at the most recent entry, a count of the entries that
+have been written so far, and a count of the values consolidated into the head
+entry. Since the entries behind the head are always one step apart, their
+timestamps are worked out from the last timestamp rather than stored.
+
+The database can optionally be snapshotted to, and loaded from, a file on disk.
+The snapshot format is a fixed header followed by each series' state and the
+packed little-endian values of each of its tables:
+
+    magic (4 bytes)  version (uint16)
+    archives length (uint16)  archives (utf-8, as given to `parse_archives()`)
+    number of series (uint32)
+    for each series:
+        name length (uint16)  name (utf-8)  last_timestamp (int64, -1 if empty)
+        for each table:  head (int32, -1 if empty)  count (int32)
+                         head count (int64)
+        for each table:  values (float64 * rows)
+
+Version 2 snapshots have no archives or head counts, and hold the default
+archives. Version 1 snapshots also hold a single series, without the number of
+series or the series name.
+"""
+SNAPSHOT_MAGIC = b'RRDM'
+SNAPSHOT_VERSION = 3
+SNAPSHOT_HEADER = struct.Struct('<4sH')
+SNAPSHOT_LENGTH = struct.Struct('<H')
+SNAPSHOT_SERIES_COUNT = struct.Struct('<I')
+SNAPSHOT_TIMESTAMP = struct.Struct('<q')
+SNAPSHOT_TABLE_HEADER = struct.Struct('<iiq')
+SNAPSHOT_V2_TABLE_HEADER = struct.Struct('<ii')
+
+NAN = float('nan')
+
+# The generation of every write to any memory database in the process, so a
+# series never reuses the generation of a state it replaced (e.g. by `load()`)
+GENERATIONS = itertools.count(1)
+
+
+class MemoryRoundRobinDb(RoundRobinDb):
+    """Keeps the round-robin tables in memory.
+
+    Arguments:
+        snapshot_path   An optional filename. If the file exists the database
+                        is loaded from it, and it is written back on `close()`
+                        or by calling `snapshot()`.
+        archives        The list of archives of a new database (default:
+                        DEFAULT_ARCHIVES)
+
+    Throws:
+        ValueError      If the snapshot file is not in a supported format, or
+                        `archives` differs from the snapshot's archives
+    """
+    def __init__(self, snapshot_path=None, archives=None):
+        self.snapshot_path = snapshot_path or None
+        self.archives = archives or DEFAULT_ARCHIVES
+        # The state of every series, shared with the objects returned by `select()`
+        self._store = {}
+        self._select_series()
+
+        if self.snapshot_path and os.path.isfile(self.snapshot_path):
+            self.load(self.snapshot_path)
+            if archives is not None and archives != self.archives:
+                raise ValueError("Snapshot was created with archives %s"
+                                 % format_archives(self.archives))
+
+    # Subclass method
+    def _select_series(self):
+        if self.series not in self._store:
+            self._store[self.series] = self._new_state()
+        self._state = self._store[self.series]
+        self._values = self._state['values']
+        self._heads = self._state['heads']
+        self._counts = self._state['counts']
+        self._head_counts = self._state['head_counts']
+
+    # Internal method
+    def _new_state(self):
+        """The state of a series that has not been saved to."""
+        return {'last_timestamp': None, 'generation': next(GENERATIONS),
+                'values': dict((a.name, array('d', [NAN]) * a.rows) for a in self.archives),
+                'heads': dict((a.name, -1) for a in self.archives),
+                'counts': dict((a.name, 0) for a in self.archives),
+                'head_counts': dict((a.name, 0) for a in self.archives)}
+
+    # Subclass method
+    def series_names(self):
+        return sorted(series for series, state in self._store.items()
+                      if state['last_timestamp'] is not None)
+
+    @property
+    def _last_timestamp(self):
+        return self._state['last_timestamp']
+
+    @_last_timestamp.setter
+    def _last_timestamp(self, timestamp):
+        self._state['last_timestamp'] = timestamp
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Write a snapshot to disk, if a snapshot path was given."""
+        self.flush_buffer()
+        if self.snapshot_path:
+            self.snapshot()
+
+    def snapshot(self, path=None):
+        """Write the state of the database to `path` (default: snapshot_path).
+
+        The snapshot is written to a temporary file first and then renamed, so
+        a reader never sees a partially-written snapshot.
+        """
+        path = path or self.snapshot_path
+        with open(path + '.tmp', 'wb') as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION))
+            archives = format_archives(self.archives).encode('utf-8')
+            f.write(SNAPSHOT_LENGTH.pack(len(archives)) + archives)
+            f.write(SNAPSHOT_SERIES_COUNT.pack(len(self._store)))
+            for series, state in sorted(self._store.items()):
+                name = series.encode('utf-8')
+                f.write(SNAPSHOT_LENGTH.pack(len(name)) + name)
+                f.write(SNAPSHOT_TIMESTAMP.pack(-1 if state['last_timestamp'] is None
+                                                else state['last_timestamp']))
+                for archive in self.archives:
+                    f.write(SNAPSHOT_TABLE_HEADER.pack(state['heads'][archive.name],
+                                                       state['counts'][archive.name],
+                                                       state['head_counts'][archive.name]))
+
+                for archive in self.archives:
+                    values = state['values'][archive.name]
+                    if sys.byteorder != 'little':
+                        values = array('d', values)
+                        values.byteswap()
+                    f.write(values.tobytes())
+        os.rename(path + '.tmp', path)
+
+    def load(self, path):
+        """Replace the state of the database with a snapshot read from `path`."""
+        with open(path, 'rb') as f:
+            header = f.read(SNAPSHOT_HEADER.size)
+            if len(header) < SNAPSHOT_HEADER.size or \
+                    SNAPSHOT_HEADER.unpack(header)[0] != SNAPSHOT_MAGIC:
+                raise ValueError("%s is not a round-robin snapshot" % path)
+            version = SNAPSHOT_HEADER.unpack(header)[1]
+            if version not in (1, 2, SNAPSHOT_VERSION):
+                raise ValueError("Unsupported snapshot version %d" % version)
+
+            try:
+                archives = DEFAULT_ARCHIVES
+                if version >= 3:
+                    archives = parse_archives(self._read_string(f))
+
+                store = {}
+                if version == 1:
+                    store[DEFAULT_SERIES] = self._read_series_state(f, archives, version)
+                else:
+                    count = SNAPSHOT_SERIES_COUNT.unpack(f.read(SNAPSHOT_SERIES_COUNT.size))[0]
+                    for ix in range_func(count):
+                        series = self._read_string(f)
+                        store[series] = self._read_series_state(f, archives, version)
+            except (struct.error, EOFError):
+                raise ValueError("%s is a truncated round-robin snapshot" % path)
+
+        self.archives = archives
+        self._store.clear()
+        self._store.update(store)
+        self._select_series()
+
+    # Internal method
+    def _read_string(self, f):
+        length = SNAPSHOT_LENGTH.unpack(f.read(SNAPSHOT_LENGTH.size))[0]
+        return f.read(length).decode('utf-8')
+
+    # Internal method
+    def _read_series_state(self, f, archives, version):
+        last_ts = SNAPSHOT_TIMESTAMP.unpack(f.read(SNAPSHOT_TIMESTAMP.size))[0]
+        state = {'last_timestamp': None if last_ts == -1 else last_ts,
+                 'generation': next(GENERATIONS),
+                 'values': {}, 'heads': {}, 'counts': {}, 'head_counts': {}}
+        for archive in archives:
+            if version >= 3:
+                head, count, head_count = SNAPSHOT_TABLE_HEADER.unpack(
+                        f.read(SNAPSHOT_TABLE_HEADER.size))
+            else:
+                # Older snapshots only ever consolidated with `min`
+                head, count = SNAPSHOT_V2_TABLE_HEADER.unpack(
+                        f.read(SNAPSHOT_V2_TABLE_HEADER.size))
+                head_count = 1 if count else 0
+            state['heads'][archive.name] = head
+            state['counts'][archive.name] = count
+            state['head_counts'][archive.name] = head_count
+        for archive in archives:
+            state['values'][archive.name] = array('d')
+            state['values'][archive.name].fromfile(f, archive.rows)
+            if sys.byteorder != 'little':
+                state['values'][archive.name].byteswap()
+        return state
+
+    # Internal method
+    def _slot_rows(self, archive, first, values):
+        """The (timestamp, value) rows of consecutive slots of the archive's
+        array, starting at slot `first`, given their values."""
+        head = self._heads[archive.name]
+        count = self._counts[archive.name]
+        if not count:
+            return [(None, None)] * len(values)
+        last, step, size = self.last_archive_timestamp(archive.name), archive.step, archive.rows
+        # How far behind the head each slot is; slots that far back have
+        # only been written if that is less than the count
+        offset = (head - first) % size
+        rows = []
+        for value in values:
+            if offset < count:
+                rows.append((last - offset * step, None if value != value else value))
+            else:
+                rows.append((None, None))
+            offset = offset - 1 if offset else size - 1
+        return rows
+
+    # Subclass method
+    def read_all(self, table):
+        """Read all values from the specified table.
+
+        Keyword arguments:
+        table -- The name of one of the archives, e.g. 'minutes' or 'hours'
+
+        Returns:
+        a list of (timestamp, value) tuples representing the state of the table
+        ordered by index."""
+        archive = self.archive(table)
+        return self._slot_rows(archive, 0, self._values[archive.name])
+
+    # Subclass method
+    def read_range(self, table, offset, count):
+        archive = self.archive(table)
+        first, values = self._range_values(archive, offset, count)
+        return self._slot_rows(archive, first, values)
+
+    # Internal method
+    def _range_values(self, archive, offset, count):
+        """The first slot of a range of the archive's array, and the values
+        of its slots."""
+        values = self._values[archive.name]
+        first = (self._heads[archive.name] - offset - count + 1) % archive.rows
+        end = first + count
+        if end <= archive.rows:
+            return first, values[first:end]
+        # The range wraps around the end of the array
+        return first, list(values[first:]) + list(values[:end - archive.rows])
+
+    @property
+    def last_timestamp(self):
+        return self._last_timestamp
+
+    @property
+    def generation(self):
+        return self._state['generation']
+
+    # Subclass method
+    def get_timestamp_index(self, timestamp, table, default=None):
+        """Resolve timestamp to an index in the table's array."""
+        super(MemoryRoundRobinDb, self).get_timestamp_index(timestamp, table)
+        if timestamp is None or self._last_timestamp is None:
+            return default
+
+        archive = self.archive(table)
+        offset, remainder = divmod(self.last_archive_timestamp(table) - timestamp,
+                                   archive.step)
+        if remainder or not 0 <= offset < self._counts[archive.name]:
+            return default
+        return (self._heads[archive.name] - offset) % archive.rows
+
+    # Subclass method
+    def get_timestamp_value(self, table, timestamp):
+        """Look up the value for the specified timestamp."""
+        super(MemoryRoundRobinDb, self).get_timestamp_value(table, timestamp)
+        ts_index = self.get_timestamp_index(timestamp, table)
+        if ts_index is None:
+            return None
+        value = self._values[table.lower()][ts_index]
+        return None if value != value else value
+
+    # Subclass method
+    def get_head_count(self, table):
+        super(MemoryRoundRobinDb, self).get_head_count(table)
+        return self._head_counts[table.lower()]
+
+    # Subclass method
+    def update_timestamp(self, table, timestamp, value):
+        super(MemoryRoundRobinDb, self).update_timestamp(table, timestamp, value)
+        self._set_value(table, timestamp, value)
+
+    # Internal method
+    def _set_value(self, table, timestamp, value):
+        ts_index = self.get_timestamp_index(timestamp, table)
+        if ts_index is None:
+            raise ValueError("Timestamp does not exist in the database.")
+        self._values[table.lower()][ts_index] = NAN if value is None else value
+        self._state['generation'] = next(GENERATIONS)
+
+    # Subclass method
+    def save_timestamps(self, data):
+        for table, (ts, value) in data.get('updates', {}).items():
+            self._set_value(table, ts, value)
+
+        for archive in self.archives:
+            rows = data[archive.name]
+            values = self._values[archive.name]
+            start_index = self._heads[archive.name] + 1
+            for ix in range_func(len(rows)):
+                value = rows[ix][1]
+                values[(ix + start_index) % archive.rows] = NAN if value is None else value
+            if rows:
+                self._heads[archive.name] = (start_index + len(rows) - 1) % archive.rows
+                self._counts[archive.name] = min(self._counts[archive.name] + len(rows),
+                                                 archive.rows)
+        self._head_counts.update(data['counts'])
+        self._state['generation'] = next(GENERATIONS)
+
+        if data[self.archives[0].name]:
+            self._last_timestamp = data[self.archives[0].name][-1][0]
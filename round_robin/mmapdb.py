@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+import mmap
+import os
+import struct
+import sys
+
+from . import (DEFAULT_ARCHIVES, DEFAULT_SERIES, format_archives, parse_archives,
+               range_func)
+from .memorydb import MemoryRoundRobinDb, NAN
+
+"""A RoundRobinDb stored in a fixed-layout binary file accessed through `mmap`.
+
+The file is preallocated when it is created, and holds a header followed by
+the packed float64 values of each table (NaN standing in for NULL):
+
+    magic (4 bytes)  version (uint16)  byteorder (uint16)  generation (uint64)
+    last_timestamp (int64)  number of archives (uint32)  archives length (uint32)
+    archives (utf-8, as given to `parse_archives()`, padded to 8 bytes)
+    for each table:  head (int32, -1 if empty)  count (int32)  head count (int64)
+    for each table:  values (float64 * rows)
+
+The values are stored in the byte order of the machine that created the file,
+so they can be read as zero-copy slices of the mapped buffer.
+
+An RRD file holds a single series. Only one process may write to a file at a
+time, but any number of processes can read it at once, sharing the page cache.
+The generation counter is odd while a write is in progress, so readers retry
+any read that overlaps a write.
+"""
+FILE_MAGIC = b'RRDF'
+FILE_VERSION = 2
+BYTEORDER = {'little': 1, 'big': 2}[sys.byteorder]
+FILE_HEADER = struct.Struct('=4sHHQqII')
+TABLE_HEADER = struct.Struct('=iiq')
+GENERATION = struct.Struct('=Q')
+GENERATION_OFFSET = 8
+
+# When the mapped file is flushed to disk: after every save, only when the
+# database is closed, or never (leave it to the operating system)
+FLUSH_POLICIES = ('save', 'close', 'never')
+
+# How many times a reader retries a read that overlapped a write. A writer
+# that died part-way through a write leaves the generation odd, so readers
+# must eventually give up waiting and read the file as it is.
+READ_RETRIES = 1000
+
+
+class MmapRoundRobinDb(MemoryRoundRobinDb):
+    """Creates and manages a memory-mapped RRD file.
+
+    Arguments:
+        path        A string filename to the RRD file, optionally followed by
+                    `?flush=<policy>` where policy is one of FLUSH_POLICIES
+                    (default: close)
+        archives    The list of archives of a new file (default:
+                    DEFAULT_ARCHIVES)
+
+    Throws:
+        ValueError  If the file is not an RRD file in a supported format, or
+                    `archives` differs from the file's archives
+    """
+    def __init__(self, path, flush='close', archives=None):
+        if '?flush=' in path:
+            path, flush = path.split('?flush=')
+        if flush not in FLUSH_POLICIES:
+            raise ValueError("Flush policy must be one of %s" % ", ".join(FLUSH_POLICIES))
+        self.path = path
+        self.flush_policy = flush
+
+        if not os.path.isfile(path) or os.path.getsize(path) == 0:
+            self._create_file(archives or DEFAULT_ARCHIVES)
+        self._file = open(path, 'r+b')
+        self._mmap = mmap.mmap(self._file.fileno(), 0)
+        try:
+            file_archives = self._check_header()
+            if archives is not None and archives != file_archives:
+                raise ValueError("RRD file was created with archives %s"
+                                 % format_archives(file_archives))
+        except ValueError:
+            self._mmap.close()
+            self._file.close()
+            raise
+        super(MmapRoundRobinDb, self).__init__(archives=file_archives)
+
+        # Map each table's values straight onto the file
+        self._buffer = memoryview(self._mmap)
+        offset = self._values_offset
+        for archive in self.archives:
+            self._values[archive.name] = \
+                    self._buffer[offset:offset + archive.rows * 8].cast('d')
+            offset += archive.rows * 8
+        self._read_header()
+
+    # Subclass method
+    def _select_series(self):
+        if self.series != DEFAULT_SERIES:
+            raise ValueError("MMap databases only hold the '%s' series" % DEFAULT_SERIES)
+        super(MmapRoundRobinDb, self)._select_series()
+
+    # Internal method
+    def _layout(self, spec_length, archives):
+        """Work out the offsets of the table headers and values."""
+        self._tables_offset = FILE_HEADER.size + (spec_length + 7) // 8 * 8
+        self._values_offset = self._tables_offset + TABLE_HEADER.size * len(archives)
+        return self._values_offset + sum(archive.rows * 8 for archive in archives)
+
+    # Internal method
+    def _create_file(self, archives):
+        """Write an empty, preallocated RRD file."""
+        spec = format_archives(archives).encode('utf-8')
+        length = self._layout(len(spec), archives)
+
+        buf = bytearray(length)
+        FILE_HEADER.pack_into(buf, 0, FILE_MAGIC, FILE_VERSION, BYTEORDER, 0, 0,
+                              len(archives), len(spec))
+        buf[FILE_HEADER.size:FILE_HEADER.size + len(spec)] = spec
+        for ix in range_func(len(archives)):
+            TABLE_HEADER.pack_into(buf, self._tables_offset + ix * TABLE_HEADER.size,
+                                   -1, 0, 0)
+        offset = self._values_offset
+        for archive in archives:
+            struct.pack_into('=%dd' % archive.rows, buf, offset, *([NAN] * archive.rows))
+            offset += archive.rows * 8
+
+        with open(self.path + '.tmp', 'wb') as f:
+            f.write(buf)
+        os.rename(self.path + '.tmp', self.path)
+
+    # Internal method
+    def _check_header(self):
+        """Check the file is an RRD file we can read, and return its archives."""
+        if len(self._mmap) < FILE_HEADER.size or self._mmap[:4] != FILE_MAGIC:
+            raise ValueError("%s is not an RRD file" % self.path)
+
+        header = FILE_HEADER.unpack_from(self._mmap)
+        if header[1] != FILE_VERSION:
+            raise ValueError("Unsupported RRD file version %d" % header[1])
+        if header[2] != BYTEORDER:
+            raise ValueError("RRD file was created on a machine with a different byte order")
+
+        spec = self._mmap[FILE_HEADER.size:FILE_HEADER.size + header[6]]
+        archives = parse_archives(spec.decode('utf-8'))
+        if len(archives) != header[5] or \
+                len(self._mmap) != self._layout(header[6], archives):
+            raise ValueError("%s is a truncated RRD file" % self.path)
+        return archives
+
+    # Internal method
+    def _read_header(self):
+        """Load the head indexes and last timestamp from the file header."""
+        header = FILE_HEADER.unpack_from(self._mmap)
+        self._generation = header[3]
+        for ix, archive in enumerate(self.archives):
+            self._heads[archive.name], self._counts[archive.name], \
+                self._head_counts[archive.name] = TABLE_HEADER.unpack_from(
+                        self._mmap, self._tables_offset + ix * TABLE_HEADER.size)
+        self._last_timestamp = header[4] if self._counts[self.archives[0].name] else None
+        return self._generation
+
+    # Internal method
+    def _write_header(self):
+        GENERATION.pack_into(self._mmap, GENERATION_OFFSET, self._generation)
+        struct.pack_into('=q', self._mmap, GENERATION_OFFSET + GENERATION.size,
+                         self._last_timestamp or 0)
+        for ix, archive in enumerate(self.archives):
+            TABLE_HEADER.pack_into(self._mmap, self._tables_offset + ix * TABLE_HEADER.size,
+                                   self._heads[archive.name], self._counts[archive.name],
+                                   self._head_counts[archive.name])
+
+    # Internal method
+    def _write(self, write_func, *args):
+        """Call `write_func` between two generation counter increments."""
+        self._generation += 1 # odd: a write is in progress
+        GENERATION.pack_into(self._mmap, GENERATION_OFFSET, self._generation)
+        try:
+            write_func(*args)
+        finally:
+            self._generation += 1
+            self._write_header()
+        if self.flush_policy == 'save':
+            self._mmap.flush()
+
+    def close(self):
+        """Flush (according to the flush policy) and unmap the file."""
+        if getattr(self, '_mmap', None) is None:
+            return
+        self.flush_buffer()
+        if self.flush_policy != 'never':
+            self._mmap.flush()
+        # The mapping can only be closed once every view of it is released
+        for values in self._values.values():
+            values.release()
+        self._values.clear()
+        self._buffer.release()
+        self._mmap.close()
+        self._file.close()
+        self._mmap = None
+
+    def flush(self):
+        """Flush any changes to the mapped file to disk."""
+        self._mmap.flush()
+
+    # Internal method
+    def _consistent_read(self, read_func, *args):
+        # Retry until the read did not overlap with a write
+        for attempt in range_func(READ_RETRIES):
+            generation = self._read_header()
+            rows = read_func(*args)
+            if generation % 2 == 0 and GENERATION.unpack_from(
+                    self._mmap, GENERATION_OFFSET)[0] == generation:
+                break
+        return rows
+
+    # Subclass method
+    def read_all(self, table):
+        # Only the copy of the values is retried. The rows are built from the
+        # copy, and the header read with it, once the read has succeeded.
+        archive = self.archive(table)
+        values = self._consistent_read(self._values[archive.name].tolist)
+        return self._slot_rows(archive, 0, values)
+
+    # Subclass method
+    def read_range(self, table, offset, count):
+        archive = self.archive(table)
+        first, values = self._consistent_read(self._range_values, archive, offset, count)
+        return self._slot_rows(archive, first, values)
+
+    # Subclass method
+    def _range_values(self, archive, offset, count):
+        # Copied out of the mapping, so they can't change after the read
+        first, values = super(MmapRoundRobinDb, self)._range_values(archive, offset, count)
+        return first, values.tolist() if isinstance(values, memoryview) else values
+
+    @property
+    def generation(self):
+        # The file's generation changes with every write, by any process. It
+        # is odd while a write is in progress, when nothing should be cached.
+        generation = self._read_header()
+        return None if generation % 2 else generation
+
+    # Subclass method
+    def update_timestamp(self, table, timestamp, value):
+        self._write(super(MmapRoundRobinDb, self).update_timestamp, table, timestamp, value)
+
+    # Subclass method
+    def save_timestamps(self, data):
+        self._write(super(MmapRoundRobinDb, self).save_timestamps, data)
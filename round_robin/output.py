@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+import io
+import itertools
+import json
+import struct
+
+from .summary import RunningSummary
+
+"""Writing query results for `rrd query` and `rrd serve`.
+
+Every format writes the entries of one archive of one series, oldest first,
+followed by (or, with `summary_only`, just) the archive's summary:
+
+    text    `timestamp, value` lines and a `<archive>: min: ..` summary line,
+            as `rrd query` has always printed
+    csv     a `timestamp,value` header and lines, with an empty value for
+            NULL. The summary is a separate `archive,count,min,avg,max` table.
+    json    an object with the series, archive, rows (as [timestamp, value]
+            pairs) and summary
+    ndjson  a `{"timestamp": .., "value": ..}` object per line. The summary
+            is a single object.
+    raw     packed little-endian (int64 timestamp, float64 value) records,
+            with NaN for NULL, and no header. Load them with
+            `numpy.frombuffer(data, dtype=ROW_DTYPE)`. The summary is a
+            single (int64 count, float64 total, min, max, average) record.
+    npy     the raw records in a NumPy `.npy` file (format version 1.0) of
+            that structured dtype, for `numpy.load()`
+
+All output goes through an `OutputWriter`, which collects it in a buffer and
+writes it to the underlying stream in large blocks. Rows are streamed from the
+database to the output, so the memory used by a query doesn't depend on the
+size of the archive: text formats are written row by row, raw records are
+encoded in chunks of rows, and the summary is worked out from the same rows
+by a `RunningSummary`. Only npy output collects the rows first, since its
+header holds their number.
+"""
+FORMATS = ('text', 'csv', 'json', 'ndjson', 'raw', 'npy')
+# The formats whose output is text (utf-8) rather than binary
+TEXT_FORMATS = ('text', 'csv', 'json', 'ndjson')
+
+CONTENT_TYPES = {'text': 'text/plain; charset=utf-8',
+                 'csv': 'text/csv; charset=utf-8',
+                 'json': 'application/json',
+                 'ndjson': 'application/x-ndjson',
+                 'raw': 'application/octet-stream',
+                 'npy': 'application/octet-stream'}
+
+# The NumPy dtypes of the raw and npy records
+ROW_DTYPE = [('timestamp', '<i8'), ('value', '<f8')]
+SUMMARY_DTYPE = [('count', '<i8'), ('total', '<f8'), ('min', '<f8'), ('max', '<f8'),
+                 ('average', '<f8')]
+ROW_RECORD = struct.Struct('<qd')
+SUMMARY_RECORD = struct.Struct('<qdddd')
+
+NAN = float('nan')
+
+# How much output is collected before it is written to the stream
+BUFFER_SIZE = 64 * 1024
+# How many raw or npy records are encoded at a time
+TABLE_CHUNK = 4096
+
+
+def npy_header(dtype, length):
+    """The header of a version 1.0 `.npy` file of `length` records."""
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (dtype, length)
+    # The header is padded so the data starts on a 64 byte boundary
+    header += ' ' * (63 - (10 + len(header)) % 64) + '\n'
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin-1')
+
+
+class OutputWriter(object):
+    """Writes query results in one of FORMATS to a binary stream.
+
+    Arguments:
+        stream  A binary file-like object (e.g. `sys.stdout.buffer`)
+        fmt     One of FORMATS
+
+    Throws:
+        ValueError  If the format is not one of FORMATS
+    """
+    def __init__(self, stream, fmt='text'):
+        if fmt not in FORMATS:
+            raise ValueError("Format must be one of %s" % ", ".join(FORMATS))
+        self.stream = stream
+        self.fmt = fmt
+        self._buffer = bytearray()
+
+    def write(self, data):
+        """Write bytes (or text, encoded as utf-8) through the buffer."""
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        self._buffer += data
+        if len(self._buffer) >= BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Write everything in the buffer to the stream."""
+        if self._buffer:
+            self.stream.write(bytes(self._buffer))
+            del self._buffer[:]
+        if hasattr(self.stream, 'flush'):
+            self.stream.flush()
+
+    def write_query(self, db, table, summary_only=False, start=None, end=None, limit=None,
+                    step=None, cf='average'):
+        """Write the entries and summary of one of a RoundRobinDb's tables.
+
+        With a `start`, `end` or `limit` (see `RoundRobinDb.query()`), only the
+        entries in that range are written, and summarized. With a `step`, the
+        entries are resampled to that step with `cf` first (see
+        `RoundRobinDb.resample()`), and the summary is of the new entries.
+        Otherwise the entries are streamed from `RoundRobinDb.iter_query()` to
+        the output. The summary is worked out from the same stream, so only
+        the npy format (whose header holds the number of entries) keeps them
+        all in memory.
+
+        Throws ValueError if there is no such table, or the step or
+        consolidation function is not valid.
+        """
+        name = db.archive(table).name
+        ranged = (start, end, limit, step) != (None, None, None, None)
+        with db.read_transaction():
+            running = RunningSummary()
+            if step is not None:
+                rows = db.resample(name, step, cf, start, end, limit)
+            else:
+                rows = db.iter_query(name, start, end, limit)
+            rows = running.watch(rows)
+            if summary_only:
+                for row in rows:
+                    pass
+            elif self.fmt == 'json':
+                self.write('{"series": %s, "archive": %s, "rows": [' % (
+                        json.dumps(db.series), json.dumps(name)))
+                for ix, row in enumerate(rows):
+                    self.write((", " if ix else "") + json.dumps(list(row)))
+                self.write('], "summary": %s}\n' % json.dumps(dict(
+                        running.summary._asdict())))
+            elif self.fmt in ('raw', 'npy'):
+                self.write_table(rows)
+            else:
+                self.write_rows(rows)
+        if summary_only or self.fmt == 'text':
+            self.write_summary(db, name, running.summary)
+
+    def write_rows(self, rows):
+        """Write (timestamp, value) rows one at a time (the streaming path).
+
+        `rows` can be any iterable, e.g. a generator. The csv header is
+        written before the first row. Not supported by npy, whose header
+        needs the number of rows.
+        """
+        if self.fmt == 'text':
+            for ts, value in rows:
+                if value is not None:
+                    # Choosing 2 decimal place precision
+                    self.write("%d, %.2f\n" % (ts, value))
+                else:
+                    self.write("%d, NULL\n" % ts)
+        elif self.fmt == 'csv':
+            self.write("timestamp,value\n")
+            for ts, value in rows:
+                self.write("%d,%s\n" % (ts, "" if value is None else repr(value)))
+        elif self.fmt == 'ndjson':
+            for ts, value in rows:
+                self.write(json.dumps({'timestamp': ts, 'value': value}) + "\n")
+        elif self.fmt == 'raw':
+            for ts, value in rows:
+                self.write(ROW_RECORD.pack(ts, NAN if value is None else value))
+        else:
+            raise ValueError("Rows can't be streamed in %s format" % self.fmt)
+
+    def write_table(self, rows):
+        """Write (timestamp, value) rows in bulk. Raw and npy records are
+        encoded TABLE_CHUNK rows per call, and npy rows are first collected
+        in a list, for the header."""
+        if self.fmt not in ('raw', 'npy'):
+            self.write_rows(rows)
+            return
+        if self.fmt == 'npy':
+            rows = list(rows)
+            self.write(npy_header(ROW_DTYPE, len(rows)))
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, TABLE_CHUNK))
+            if not chunk:
+                break
+            self.write(struct.pack('<' + 'qd' * len(chunk), *itertools.chain.from_iterable(
+                    (ts, NAN if value is None else value) for ts, value in chunk)))
+
+    def write_summary(self, db, table, summary):
+        """Write the summary of a table."""
+        if self.fmt == 'text':
+            if summary.count == 0:
+                self.write("Database is empty. Please add some values.\n")
+            else:
+                self.write("%s: min: %r, avg: %.2f, max: %r\n" % (
+                        table, summary.min, summary.average, summary.max))
+        elif self.fmt == 'csv':
+            self.write("archive,count,min,avg,max\n")
+            self.write("%s,%d,%s,%s,%s\n" % ((table, summary.count) + tuple(
+                    "" if v is None else repr(v)
+                    for v in (summary.min, summary.average, summary.max))))
+        elif self.fmt == 'json':
+            self.write(json.dumps({'series': db.series, 'archive': table,
+                                   'summary': dict(summary._asdict())}) + "\n")
+        elif self.fmt == 'ndjson':
+            self.write(json.dumps(dict(summary._asdict())) + "\n")
+        else:
+            if self.fmt == 'npy':
+                self.write(npy_header(SUMMARY_DTYPE, 1))
+            self.write(SUMMARY_RECORD.pack(*[NAN if v is None else v for v in summary]))
+
+
+def render(db, table, fmt='text', summary_only=False, start=None, end=None, limit=None,
+           step=None, cf='average'):
+    """Render the entries and summary of a table.
+
+    Keyword arguments:
+    db           -- the RoundRobinDb of the series
+    table        -- the name of one of the archives
+    fmt          -- one of FORMATS
+    summary_only -- leave out the entries
+    start, end, limit -- only render the entries in this range (see
+                    `RoundRobinDb.query()`)
+    step, cf     -- render the entries resampled to this step (see
+                    `RoundRobinDb.resample()`)
+
+    Returns:
+    the output, as a string for TEXT_FORMATS and as bytes otherwise
+
+    Throws ValueError if the table or format is not valid.
+    """
+    out = io.BytesIO()
+    writer = OutputWriter(out, fmt)
+    writer.write_query(db, table, summary_only, start, end, limit, step, cf)
+    writer.flush()
+    return out.getvalue().decode('utf-8') if fmt in TEXT_FORMATS else out.getvalue()
@@ -1,115 +1,544 @@
+import contextlib
+import json
+import re
+import struct
 import redis
 from ast import literal_eval
 
-from . import RoundRobinDb, range_func
+from . import (RoundRobinDb, DEFAULT_ARCHIVES, DEFAULT_SERIES, bucket, format_archives,
+               parse_archives, range_func)
+
+"""Storing round-robin databases in Redis.
+
+Each archive of a series is a hash, `<prefix>archive:<name>`, mapping the
+index of each entry that has been written to its packed (timestamp, value)
+record, so a whole archive is read with one HGETALL. The index of its latest
+entry is kept in `<prefix><name>_head`, so a range of it can be read with one
+HMGET. Databases written before
+this layout kept each entry in its own `<keybase><index>` key, holding the repr
+of a (timestamp, value) tuple; they are converted when first opened.
+
+A client reads everything about a series in one round trip and keeps it until
+the series is written to by another client. Saves are worked out from that copy
+and applied by a Lua script (`SAVE_SCRIPT`) in one EVALSHA, which writes
+nothing if the series' generation has changed in the meantime. The save is then
+worked out again from a fresh copy, so concurrent savers can't interleave their
+writes to the ring.
+"""
+# The key prefixes of the archives of databases created before archives were
+# configurable. Other archives use their name.
+LEGACY_KEYBASES = {'minutes': 'min', 'hours': 'hour'}
+
+# An entry: a little-endian int64 timestamp and float64 value, NaN for NULL
+RECORD = struct.Struct('<qd')
+NAN = float('nan')
+
+# The version of the key layout, kept in the `format` key
+FORMAT = 2
+
+# How many times a save is retried after another client wrote to the series
+MAX_RETRIES = 10
+
+# Applies the writes of a save (or a transaction of saves to many series) if
+# none of the series has been written to since the writes were worked out.
+#
+# KEYS: for each series, its generation, last_timestamp, and each archive's
+#       hash, head count and head index key
+# ARGV: the number of archives and series, then the generation each series is
+#       expected to have, then for each series: the new last timestamp (or ''),
+#       and for each archive the new head count and head index (or ''), the
+#       number of entries written, and their index and packed record
+#
+# Returns the new generation of each series, or nil if any of them changed.
+SAVE_SCRIPT = """
+local archives = tonumber(ARGV[1])
+local series = tonumber(ARGV[2])
+local keys_per_series = 2 + 3 * archives
+for s = 1, series do
+    local generation = redis.call('GET', KEYS[(s - 1) * keys_per_series + 1]) or '0'
+    if generation ~= ARGV[2 + s] then
+        return nil
+    end
+end
+
+local arg = 3 + series
+local generations = {}
+for s = 1, series do
+    local key = (s - 1) * keys_per_series + 1
+    if ARGV[arg] ~= '' then
+        redis.call('SET', KEYS[key + 1], ARGV[arg])
+    end
+    arg = arg + 1
+    for a = 0, archives - 1 do
+        local hash = KEYS[key + 2 + 3 * a]
+        if ARGV[arg] ~= '' then
+            redis.call('SET', KEYS[key + 3 + 3 * a], ARGV[arg])
+        end
+        if ARGV[arg + 1] ~= '' then
+            redis.call('SET', KEYS[key + 4 + 3 * a], ARGV[arg + 1])
+        end
+        local entries = tonumber(ARGV[arg + 2])
+        arg = arg + 3
+        for e = 1, entries do
+            redis.call('HSET', hash, ARGV[arg], ARGV[arg + 1])
+            arg = arg + 2
+        end
+    end
+    generations[s] = redis.call('INCR', KEYS[key])
+end
+return generations
+"""
+
+
+class WriteConflict(ValueError):
+    """The series was written to by another client during a transaction."""
+
+def pack_entry(timestamp, value):
+    return RECORD.pack(timestamp, NAN if value is None else value)
+
+def unpack_entry(data):
+    timestamp, value = RECORD.unpack(data)
+    return timestamp, None if value != value else value
+
 
 class RedisRoundRobinDb(RoundRobinDb):
-    def __init__(self, redis_db):
-        server,port=redis_db.split(":")
-        port = int(port)
-        self.db = redis.StrictRedis(host=server, port=port, db=0)
-        self._init_db()
-        self._mins_cache = None
-        self._hours_cache = None
-
-    def _init_db(self):
-        if self.db.get("initialized"):
-            return # already initialized
-        self.db.set("initialized", True)
+    def __init__(self, redis_db, archives=None):
+        if isinstance(redis_db, str):
+            server,port=redis_db.split(":")
+            port = int(port)
+            self.db = redis.StrictRedis(host=server, port=port, db=0)
+        else:
+            # An existing client (e.g. a connection pool shared with the caller)
+            self.db = redis_db
+        # Shared with the objects returned by `select()`. During a transaction
+        # it holds the queued writes, the state of each series they leave, and
+        # the objects using those states.
+        self._transaction = {'depth': 0, 'pipe': None, 'states': None, 'dbs': None}
+        self._init_db(archives)
+        self._select_series()
+
+    def _init_db(self, archives):
+        spec = self.db.get("archives")
+        if spec is not None:
+            self.archives = parse_archives(spec.decode('utf-8')
+                                           if isinstance(spec, bytes) else spec)
+            if archives is not None and archives != self.archives:
+                raise ValueError("Database was created with archives %s"
+                                 % format_archives(self.archives))
+        elif self.db.get("initialized"):
+            # Created before archives were configurable
+            self.archives = DEFAULT_ARCHIVES
+            self.db.set("archives", format_archives(self.archives))
+        else:
+            self.archives = archives or DEFAULT_ARCHIVES
+            self.db.set("initialized", 1)
+            self.db.set("archives", format_archives(self.archives))
+            self.db.set("format", FORMAT)
+        if int(self.db.get("format") or 1) < FORMAT:
+            self._convert_legacy_keys()
+
+    # Internal method
+    def _convert_legacy_keys(self):
+        """Move the entries of every series from their own keys to the hash
+        of their archive."""
+        pipe = self.db.pipeline()
+        for archive in self.archives:
+            keybase = self._keybase(archive.name)
+            pattern = re.compile(r'^((?:series:.+:)?)%s(\d+)$' % re.escape(keybase))
+            for key in self.db.scan_iter(match='*%s*' % keybase):
+                match = pattern.match(key.decode('utf-8') if isinstance(key, bytes) else key)
+                if match is None:
+                    continue
+                data = self.db.get(key)
+                if data is not None:
+                    timestamp, value = literal_eval(
+                            data.decode('utf-8') if isinstance(data, bytes) else data)
+                    pipe.hset(match.group(1) + 'archive:' + archive.name,
+                              match.group(2), pack_entry(timestamp, value))
+                pipe.delete(key)
+        pipe.set("format", FORMAT)
+        pipe.execute()
+
+    def _keybase(self, table):
+        name = self.archive(table).name
+        return LEGACY_KEYBASES.get(name, name)
+
+    def _select_series(self):
+        # Every key of a series starts with its prefix. The default series uses
+        # the keys of databases created before series were supported.
+        if self.series == DEFAULT_SERIES:
+            self._prefix = ''
+        else:
+            self._prefix = 'series:%s:' % self.series
+        self._state = None
+
+    # Internal method
+    def _load_state(self):
+        """The generation, last timestamp, head counts and entries of the
+        series, read in a single MULTI/EXEC round trip and kept until the
+        series is written to by another client."""
+        if self._has_queued_writes():
+            # Written to earlier in the transaction, so later saves are worked
+            # out from the series as those writes leave it
+            state = self._transaction['states'][self._prefix]
+            if self._state is not state:
+                self._state = state
+                self._transaction['dbs'].append(self)
+            return state
+        if self._state is not None:
+            return self._state
+        if self.stats is not None:
+            self.stats.count('state_loads')
+        pipe = self.db.pipeline()
+        pipe.get(self._prefix + "generation")
+        pipe.get(self._prefix + "last_timestamp")
+        for archive in self.archives:
+            pipe.get(self._prefix + archive.name + '_count')
+            pipe.hgetall(self._archive_key(archive.name))
+        results = pipe.execute()
+
+        state = {'generation': int(results[0] or 0),
+                 'last_timestamp': None if results[1] is None else int(results[1]),
+                 'counts': {}, 'rows': {}, 'index': {}}
+        for ix, archive in enumerate(self.archives):
+            count, entries = results[2 + 2 * ix:4 + 2 * ix]
+            state['counts'][archive.name] = None if count is None else int(count)
+            # Entries are only stored once they have been written
+            state['rows'][archive.name] = rows = [(None, None)] * archive.rows
+            for entry_ix, data in entries.items():
+                rows[int(entry_ix)] = unpack_entry(data)
+            state['index'][archive.name] = dict(
+                    (ts, entry_ix) for entry_ix, (ts, value) in enumerate(rows)
+                    if ts is not None)
+        self._state = state
+        return state
+
+    def _instrument_backend(self):
+        # Every command is sent by `execute_command`, and every pipeline
+        # (including MULTI/EXEC transactions) by its `execute`
+        stats, client = self.stats, self.db
+        execute_command, pipeline = client.execute_command, client.pipeline
+        def counted_command(*args, **kwargs):
+            stats.count('redis_round_trips')
+            return execute_command(*args, **kwargs)
+        def counted_pipeline(*args, **kwargs):
+            pipe = pipeline(*args, **kwargs)
+            execute = pipe.execute
+            def counted_execute(*args, **kwargs):
+                stats.count('redis_round_trips')
+                return execute(*args, **kwargs)
+            pipe.execute = counted_execute
+            return pipe
+        client.execute_command = counted_command
+        client.pipeline = counted_pipeline
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Apply all saves made in the context with a single call of the save
+        script.
+
+        Throws WriteConflict (and saves nothing) if any of the series was
+        written to by another client during the transaction.
+        """
+        transaction = self._transaction
+        if transaction['depth'] == 0:
+            transaction.update(pipe=[], states={}, dbs=[])
+        transaction['depth'] += 1
+        try:
+            yield self
+        except:
+            transaction['depth'] -= 1
+            if transaction['depth'] == 0:
+                self._end_transaction(applied=False)
+            raise
+        else:
+            transaction['depth'] -= 1
+            if transaction['depth'] == 0:
+                writes = transaction['pipe']
+                applied = not writes or self._apply(writes)
+                self._end_transaction(applied)
+                if not applied:
+                    raise WriteConflict("The database was written to during the transaction")
+
+    # Internal method
+    def _end_transaction(self, applied):
+        """Forget the queued writes. Unless they were applied, the states
+        they were made to are discarded, to be read again."""
+        transaction = self._transaction
+        if not applied:
+            for db in transaction['dbs']:
+                db._state = None
+        transaction.update(pipe=None, states=None, dbs=None)
 
     def _clear_db(self):
-        for ix in range_func(24):
-            self.db.delete('min%d' % ix)
-            self.db.delete('hour%d' % ix)
-        for ix in range_func(24,60):
-            self.db.delete('min%d' % ix)
-
-        self.db.delete('last_timestamp')
-        self.db.delete('initialized')
-
-    def _get_key_as_tuple(self, key):
-        data = self.db.get(key)
-        if data is None:
-            return None
-        return literal_eval(data)
-
-    def _get_filtered_cache(self, base, length):
-        cache = {ts:(ix, val) for ix,(ts, val) in filter(
-            lambda i: i[1] is not None,
-            [(d, self._get_key_as_tuple(base+str(d))) for d in range_func(length)])}
-        return cache
-        
-    def _get_minutes(self):
-        if self._mins_cache is None:
-            self._mins_cache = self._get_filtered_cache('min', 60)
-            print("Minutes cache is %r" % self._mins_cache)
-        return self._mins_cache
-
-    def _get_hours(self):
-        if self._hours_cache is None:
-            self._hours_cache = self._get_filtered_cache('hour', 24)
-            print("Hours cache is %r" % self._hours_cache)
-        return self._hours_cache
+        for archive in self.archives:
+            self.db.delete(self._archive_key(archive.name))
+            self.db.delete(self._prefix + archive.name + '_count')
+            self.db.delete(self._prefix + archive.name + '_head')
+
+        self.db.delete(self._prefix + 'last_timestamp')
+        self.db.delete(self._prefix + 'generation')
+        for key in self.db.keys(self._prefix + 'cache:*'):
+            self.db.delete(key)
+        if self.series == DEFAULT_SERIES:
+            self.db.delete('initialized')
+            self.db.delete('archives')
+            self.db.delete('format')
+        self._state = None
+
+    # Subclass method
+    def series_names(self):
+        names = [DEFAULT_SERIES] if self.db.exists('last_timestamp') else []
+        pattern = re.compile(r'^series:(.+):last_timestamp$')
+        for key in self.db.scan_iter(match='series:*:last_timestamp'):
+            match = pattern.match(key.decode('utf-8') if isinstance(key, bytes) else key)
+            if match is not None:
+                names.append(match.group(1))
+        return sorted(names)
+
+    def _archive_key(self, table):
+        return self._prefix + 'archive:' + self.archive(table).name
 
     def read_all(self, table):
-        if table.lower() == 'minutes':
-            data = self._get_minutes()
-        elif table.lower() == 'hours':
-            data = self._get_hours()
-        else:
-            raise ValueError("Table must be one of 'hours' or 'minutes'")
-        return [(val[0],val[1][1]) for val in 
-                        sorted(data.items(), key=lambda i: i[1][0])]
+        return list(self._load_state()['rows'][self.archive(table).name])
 
+    # Subclass method
+    def read_range(self, table, offset, count):
+        # Read from this client's copy of the series, without copying it
+        archive = self.archive(table)
+        head = self.get_timestamp_index(self.last_archive_timestamp(table), table)
+        if head is None:
+            return [(None, None)] * count
+        rows = self._state['rows'][archive.name]
+        return [rows[(head - back) % archive.rows]
+                for back in range_func(offset + count - 1, offset - 1, -1)]
+
+    # Subclass method
+    def _iter_range(self, archive, start, end, limit, chunk_size=None):
+        if self._state is not None or self._has_queued_writes():
+            for row in super(RedisRoundRobinDb, self)._iter_range(
+                    archive, start, end, limit, chunk_size):
+                yield row
+            return
+
+        # Rather than reading the whole series, read where the archive's ring
+        # ends and then only the entries in the range
+        last, head = self.db.mget(self._prefix + "last_timestamp",
+                                  self._prefix + archive.name + '_head')
+        if last is None:
+            return
+        if head is None:
+            # Saved before head indexes were kept
+            for row in super(RedisRoundRobinDb, self)._iter_range(
+                    archive, start, end, limit, chunk_size):
+                yield row
+            return
+        last = bucket(int(last), archive.step, self.timezone)
+        offsets = self._range_offsets(archive, last, start, end, limit)
+        if offsets is None:
+            return
+        def read(offset, count):
+            first = int(head) - offset - count + 1
+            entries = self.db.hmget(self._archive_key(archive.name),
+                                    [(first + ix) % archive.rows for ix in range_func(count)])
+            return [(None, None) if data is None else unpack_entry(data) for data in entries]
+        for row in self._read_chunks(archive, last, offsets, chunk_size, read):
+            yield row
 
     @property
     def last_timestamp(self):
-        ts = self.db.get("last_timestamp")
-        return None if ts is None else int(ts)
+        return self._load_state()['last_timestamp']
+
+    # Internal method
+    def _has_queued_writes(self):
+        """Whether the transaction has writes to the series not yet applied."""
+        states = self._transaction['states']
+        return bool(states) and self._prefix in states
+
+    @property
+    def generation(self):
+        if self._has_queued_writes():
+            # Nothing is cached until the writes are applied
+            return None
+        generation = self.db.get(self._prefix + "generation")
+        generation = 0 if generation is None else int(generation)
+        if self._state is not None and generation != self._state['generation']:
+            # Another client has written to the series
+            self._state = None
+        return generation
+
+    def _load_cached(self, key):
+        # Cached query results are shared by every client of the server
+        cached = self.db.get(self._prefix + "cache:" + key)
+        if cached is None:
+            return None
+        generation, value = (cached.decode('utf-8') if isinstance(cached, bytes)
+                             else cached).split(" ", 1)
+        return int(generation), json.loads(value)
 
-    def get_timestamp_data(self, timestamp, table):
-        if table.lower() == 'minutes':
-            ts_data = self._get_minutes().get(timestamp)
-        elif table.lower() == 'hours':
-            ts_data = self._get_hours().get(timestamp)
-        return ts_data
+    def _store_cached(self, key, generation, value):
+        self.db.set(self._prefix + "cache:" + key, "%d %s" % (generation, json.dumps(value)))
 
     def get_timestamp_index(self, timestamp, table, default=None):
         super(self.__class__, self).get_timestamp_index(timestamp, table)
-        ts_data = self.get_timestamp_data(timestamp, table)
-        if ts_data is None:
-            return default
-        else:
-            return ts_data[0]
-
-    def _update(self, table, index, timestamp, value):
-        keybase = 'min' if table.lower() == 'minutes' else 'hour'
-        self.db.set(keybase+str(index), (timestamp, value))
+        return self._load_state()['index'][self.archive(table).name].get(timestamp, default)
 
     def get_timestamp_value(self, table, timestamp):
         super(self.__class__, self).get_timestamp_value(table, timestamp)
-        ts_data = self.get_timestamp_data(timestamp, table)
-        return None if ts_data is None else ts_data[1]
+        ts_index = self.get_timestamp_index(timestamp, table)
+        return None if ts_index is None else self._state['rows'][self.archive(table).name][ts_index][1]
+
+    def get_head_count(self, table):
+        super(self.__class__, self).get_head_count(table)
+        count = self._load_state()['counts'][self.archive(table).name]
+        if count is None:
+            # Databases created before head counts were kept only held `min`
+            return 1 if self.get_timestamp_index(
+                    self.last_archive_timestamp(table), table) is not None else 0
+        return int(count)
 
     def update_timestamp(self, table, timestamp, value):
-        super(self.__class__, self).update_timestamp(table, timestamp, value)
+        self._retry(self._update_timestamp, table, timestamp, value)
+
+    # Internal method
+    def _update_timestamp(self, table, timestamp, value):
+        super(RedisRoundRobinDb, self).update_timestamp(table, timestamp, value)
         ts_index = self.get_timestamp_index(timestamp, table)
         if ts_index is None:
             raise ValueError("Timestamp does not exist in the database.")
-        else:
-            self._update(table, ts_index, timestamp, value)
+        self._write({'entries': {self.archive(table).name: [(ts_index, timestamp, value)]}})
+
+    def save_many(self, points):
+        points = list(points)
+        return self._retry(super(RedisRoundRobinDb, self).save_many, points)
+
+    # Internal method
+    def _retry(self, operation, *args):
+        """Call a write operation until it doesn't conflict with other clients.
+
+        The writes are worked out from this client's copy of the series, so
+        if another client has written to the series since it was read, it is
+        read again and the writes worked out again.
+
+        Throws WriteConflict if the series was written to by other clients
+        during MAX_RETRIES attempts.
+        """
+        for attempt in range_func(MAX_RETRIES):
+            try:
+                return operation(*args)
+            except _Conflict:
+                continue
+        raise WriteConflict("The database was written to by other clients "
+                            "during %d attempts to save" % MAX_RETRIES)
 
     def save_timestamps(self, data):
-        start_index = self.get_timestamp_index(self.last_timestamp, 'Minutes', -1) + 1
-        for ix in range_func(len(data['minutes'])):
-            ts, value = data['minutes'][ix]
-            self._update('minutes', (ix + start_index) % 60, ts, value)
-
-        start_index = self.get_timestamp_index(self.last_hour_timestamp, 'hours', -1) + 1
-        for ix in range_func(len(data['hours'])):
-            ts, value = data['hours'][ix]
-            self._update('hours', (ix + start_index) % 24, ts, value)
-
-        self.db.set("last_timestamp", data['minutes'][-1][0])
-        self._mins_cache = None
-        self._hours_cache = None
+        entries = {}
+        for table, (ts, value) in data.get('updates', {}).items():
+            ts_index = self.get_timestamp_index(ts, table)
+            if ts_index is None:
+                raise ValueError("Timestamp does not exist in the database.")
+            entries[table] = [(ts_index, ts, value)]
+
+        for archive in self.archives:
+            rows = data[archive.name]
+            start_index = self.get_timestamp_index(
+                    self.last_archive_timestamp(archive.name), archive.name, -1) + 1
+            entries.setdefault(archive.name, []).extend(
+                    ((ix + start_index) % archive.rows, ts, value)
+                    for ix, (ts, value) in enumerate(rows))
+
+        heads = dict((table, table_entries[-1][0]) for table, table_entries in entries.items()
+                     if data[table])
+        first = data[self.archives[0].name]
+        self._write({'entries': entries, 'counts': data['counts'], 'heads': heads,
+                     'last_timestamp': first[-1][0] if first else None})
+
+    # Internal method
+    def _write(self, write):
+        """Apply the writes to the series, or queue them in the transaction.
+
+        Keyword arguments:
+        write -- a dict of the 'entries' of each archive, as lists of
+                 (index, timestamp, value) tuples in the order they are
+                 written, and optionally the new head 'counts', 'heads'
+                 (indexes) and 'last_timestamp'
+
+        Throws _Conflict if the series has been written to by another client.
+        """
+        state = self._load_state()
+        write['db'] = self
+        write['state'] = state
+        write['generation'] = state['generation']
+        if self._transaction['pipe'] is not None:
+            # The series' generation is only changed once the writes are
+            # applied, so the save script checks each write against the
+            # generation the transaction first read
+            self._update_state(state, write)
+            if self._prefix not in self._transaction['states']:
+                self._transaction['states'][self._prefix] = state
+                self._transaction['dbs'].append(self)
+            self._transaction['pipe'].append(write)
+        elif self._apply([write]):
+            self._update_state(state, write)
+        else:
+            raise _Conflict()
+
+    # Internal method
+    def _update_state(self, state, write):
+        """Make the writes to a copy of the series."""
+        if write.get('last_timestamp') is not None:
+            state['last_timestamp'] = write['last_timestamp']
+        state['counts'].update(write.get('counts', {}))
+        for table, entries in write['entries'].items():
+            rows, index = state['rows'][table], state['index'][table]
+            for ix, ts, value in entries:
+                if index.get(rows[ix][0]) == ix:
+                    del index[rows[ix][0]]
+                rows[ix] = (ts, value)
+                index[ts] = ix
+
+    # Internal method
+    def _apply(self, writes):
+        """Run the save script for a list of writes (see `_write()`).
+
+        Returns whether the writes were applied, in which case the generation
+        of each series' copy is updated. Otherwise the state of each series is
+        discarded, to be read again.
+        """
+        keys, args = [], [len(self.archives), len(writes)]
+        args.extend(write['generation'] for write in writes)
+        for write in writes:
+            db = write['db']
+            keys.extend([db._prefix + "generation", db._prefix + "last_timestamp"])
+            last_timestamp = write.get('last_timestamp')
+            args.append('' if last_timestamp is None else last_timestamp)
+            for archive in self.archives:
+                keys.extend([db._archive_key(archive.name),
+                             db._prefix + archive.name + '_count',
+                             db._prefix + archive.name + '_head'])
+                args.append(write.get('counts', {}).get(archive.name, ''))
+                args.append(write.get('heads', {}).get(archive.name, ''))
+                entries = write['entries'].get(archive.name, [])
+                args.append(len(entries))
+                for ix, ts, value in entries:
+                    args.extend([ix, pack_entry(ts, value)])
+
+        script = self.__dict__.get('_save_script')
+        if script is None:
+            script = self._save_script = self.db.register_script(SAVE_SCRIPT)
+        generations = script(keys=keys, args=args)
+        if generations is None:
+            for write in writes:
+                write['db']._state = None
+            return False
+
+        # Keep each series' copy up to date, so the next save doesn't need to
+        # read it again. A series written more than once gets the generation
+        # of its last write.
+        for write, generation in zip(writes, generations):
+            write['state']['generation'] = int(generation)
+        return True
+
+
+class _Conflict(Exception):
+    """A save found the series written to by another client."""
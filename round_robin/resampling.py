@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+from .archives import CF_ALIASES, CONSOLIDATION_FUNCTIONS
+from .bucketing import BULK_THRESHOLD, LOCAL, bucket, bucket_array
+
+"""Resampling the entries of an archive to a coarser step when it is read.
+
+`resample()` groups (timestamp, value) rows, oldest first, into buckets of a
+larger step (aligned with the same policies as the archives, see
+`bucketing`), and combines the values of each bucket with a consolidation
+function, ignoring NULL values:
+
+    min, max, average   of the bucket's values
+    last                the most recent of them
+    count               the number of them
+
+A bucket without any values is NULL. Only the rows given are combined, so the
+first and last buckets of a range may only hold some of their entries.
+
+Long lists of rows are resampled with NumPy, if it is installed, in a single
+pass over arrays of the timestamps and values (with NaN for NULL). NumPy is
+only imported when it is needed.
+"""
+NAN = float('nan')
+
+
+def resample(rows, step, cf='average', tz=LOCAL):
+    """Combine (timestamp, value) rows into buckets of `step` seconds.
+
+    Keyword arguments:
+    rows -- (timestamp, value) rows, oldest first, with `None` for NULL
+    step -- the width of each bucket in seconds
+    cf   -- one of `archives.CONSOLIDATION_FUNCTIONS` (or an alias, e.g. avg)
+    tz   -- the alignment policy of the buckets
+
+    Returns:
+    a list of (bucket timestamp, value) rows, oldest first
+
+    Throws ValueError if the step or consolidation function is not valid.
+    """
+    cf = CF_ALIASES.get(cf, cf)
+    if cf not in CONSOLIDATION_FUNCTIONS:
+        raise ValueError("Consolidation function must be one of %s"
+                         % ", ".join(CONSOLIDATION_FUNCTIONS))
+    if step < 1:
+        raise ValueError("Step must be positive")
+    if len(rows) >= BULK_THRESHOLD:
+        try:
+            return _resample_arrays(rows, step, cf, tz)
+        except ImportError:
+            pass
+    return _resample_rows(rows, step, cf, tz)
+
+
+def _resample_rows(rows, step, cf, tz):
+    resampled, values, current = [], [], None
+    for ts, value in rows:
+        ts_bucket = bucket(ts, step, tz)
+        if ts_bucket != current:
+            if current is not None:
+                resampled.append((current, _combine(values, cf)))
+            current, values = ts_bucket, []
+        if value is not None:
+            values.append(value)
+    if current is not None:
+        resampled.append((current, _combine(values, cf)))
+    return resampled
+
+
+def _combine(values, cf):
+    if not values:
+        return None
+    if cf == 'min':
+        return min(values)
+    elif cf == 'max':
+        return max(values)
+    elif cf == 'average':
+        return sum(values) / len(values)
+    elif cf == 'last':
+        return values[-1]
+    return float(len(values))
+
+
+def _resample_arrays(rows, step, cf, tz):
+    import numpy
+
+    timestamps = numpy.fromiter((ts for ts, value in rows), numpy.int64, len(rows))
+    values = numpy.fromiter((NAN if value is None else value for ts, value in rows),
+                            numpy.float64, len(rows))
+    buckets = bucket_array(timestamps, step, tz)
+    # The rows are in order, so each bucket is a run of rows, starting where
+    # the bucket changes
+    starts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(buckets)) + 1))
+    present = ~numpy.isnan(values)
+    counts = numpy.add.reduceat(present.astype(numpy.int64), starts)
+    if cf == 'min':
+        result = numpy.fmin.reduceat(values, starts)
+    elif cf == 'max':
+        result = numpy.fmax.reduceat(values, starts)
+    elif cf == 'average':
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            result = numpy.add.reduceat(numpy.where(present, values, 0.0), starts) / counts
+    elif cf == 'last':
+        last = numpy.maximum.reduceat(numpy.where(present, numpy.arange(len(values)), -1),
+                                      starts)
+        result = values[last]
+    else:
+        result = counts.astype(numpy.float64)
+    result[counts == 0] = NAN
+    return [(ts, None if value != value else value)
+            for ts, value in zip(buckets[starts].tolist(), result.tolist())]
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+import os
+import signal
+from urllib.parse import parse_qs, urlsplit
+
+from . import DEFAULT_SERIES, format_archives, parse_point
+from .output import CONTENT_TYPES, TEXT_FORMATS, render
+from .stats import timer
+
+"""A long-running server answering queries and saves over HTTP.
+
+`rrd serve` keeps one RoundRobinDb open, so requests don't pay for starting
+Python and opening the database. It listens on a Unix socket, a local TCP
+port, or both, and speaks a small subset of HTTP/1.1 (with keep-alive), so
+graph viewers can poll it directly:
+
+    GET  /query?archive=<archive>[&series=<series>][&format=<format>][&summary_only=1]
+               [&since=<timestamp>][&until=<timestamp>][&last=<n>][&step=<seconds>][&cf=<cf>]
+         The archive's entries and summary, rendered by `output.render()`
+         (format: one of `output.FORMATS`; default json), optionally only
+         those in a range (see `RoundRobinDb.query()`), and resampled to a
+         larger step (see `RoundRobinDb.resample()`; cf: default average)
+    POST /save[?series=<series>]
+         Saves the `[series] timestamp value` lines of the request body, in
+         a single transaction. Responds with the number of values saved.
+    GET  /stats[?format=<text|json|prometheus>]
+         The database's stats (see `stats`), kept since the server started,
+         including the time taken to answer each kind of request
+    GET  /metrics
+         The stats in the Prometheus text format, for scraping
+    GET  /info
+         A json object of the database served (as given to `serve()`, or
+         null), its default series and its archives, so a client can check
+         that the server answers for the database it means to query
+
+Errors are answered with a 4xx status and the error message as plain text.
+
+Requests are handled one at a time on the event loop, so the database is
+never used by two requests at once. Queries are answered from the database's
+read cache until the next save, unless they ask for a range or a step.
+"""
+STATUS_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+                  405: 'Method Not Allowed', 413: 'Payload Too Large'}
+
+# The longest request body accepted by /save
+MAX_BODY = 64 * 1024 * 1024
+
+# The endpoints, whose requests are timed under their own names
+ENDPOINTS = ('/query', '/save', '/stats', '/metrics', '/info')
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class HttpError(Exception):
+    """An error answered with the given status."""
+    def __init__(self, status, message):
+        super(HttpError, self).__init__(message)
+        self.status = status
+
+
+class RrdServer(object):
+    """Answers requests for a single RoundRobinDb.
+
+    Arguments:
+        rrd      The RoundRobinDb to serve. Other series are selected from it.
+                 Its stats are enabled.
+        database A name of the database served, e.g. its `RRD_DATABASE`,
+                 reported by /info
+    """
+    def __init__(self, rrd, database=None):
+        self.rrd = rrd
+        self.database = database
+        self.stats = rrd.enable_stats()
+        self._series = {rrd.series: rrd}
+
+    def _select(self, series):
+        if series not in self._series:
+            self._series[series] = self.rrd.select(series)
+        return self._series[series]
+
+    def query(self, params):
+        """Answer a /query request. Returns (content type, body)."""
+        if 'archive' not in params:
+            raise HttpError(400, "archive is required")
+        fmt = params.get('format', 'json')
+        summary_only = params.get('summary_only', '0') not in ('0', '', 'false')
+        start, end, limit, step = [self._int_param(params, name)
+                                   for name in ('since', 'until', 'last', 'step')]
+        db = self._select(params.get('series', DEFAULT_SERIES))
+        if fmt not in TEXT_FORMATS or (start, end, limit, step) != (None, None, None, None):
+            # The read cache only holds text of whole tables
+            return CONTENT_TYPES.get(fmt), render(db, params['archive'], fmt, summary_only,
+                                                  start, end, limit, step,
+                                                  params.get('cf', 'average'))
+        key = "output:%s:%s:%s" % (db.archive(params['archive']).name, fmt,
+                                   "summary" if summary_only else "all")
+        body = db.cached(key, lambda: render(db, params['archive'], fmt, summary_only))
+        return CONTENT_TYPES[fmt], body
+
+    @staticmethod
+    def _int_param(params, name):
+        if params.get(name, '') == '':
+            return None
+        try:
+            return int(params[name])
+        except ValueError:
+            raise HttpError(400, "%s must be an integer" % name)
+
+    def save(self, params, body):
+        """Answer a /save request. Returns (content type, body)."""
+        series = params.get('series', DEFAULT_SERIES)
+        points = {}
+        for line_no, line in enumerate(body.decode('utf-8').splitlines(), 1):
+            try:
+                point = parse_point(line, series)
+            except ValueError as e:
+                raise HttpError(400, "Line %d: %s" % (line_no, e))
+            if point is not None:
+                points.setdefault(point[0], []).append(point[1:])
+        self.rrd.save_series(points)
+        return CONTENT_TYPES['json'], json.dumps(
+                {'saved': sum(len(p) for p in points.values())}) + "\n"
+
+    def stats_report(self, params):
+        """Answer a /stats request. Returns (content type, body)."""
+        fmt = params.get('format', 'text')
+        if fmt == 'text':
+            return CONTENT_TYPES['text'], self.stats.format_text()
+        elif fmt == 'json':
+            return CONTENT_TYPES['json'], json.dumps(self.stats.as_dict()) + "\n"
+        elif fmt == 'prometheus':
+            return PROMETHEUS_CONTENT_TYPE, self.stats.format_prometheus()
+        raise HttpError(400, "format must be one of text, json, prometheus")
+
+    def info(self):
+        """Answer an /info request. Returns (content type, body)."""
+        return CONTENT_TYPES['json'], json.dumps({
+                'database': self.database, 'series': self.rrd.series,
+                'archives': format_archives(self.rrd.archives)}) + "\n"
+
+    def handle(self, method, target, body):
+        """Answer a request. Returns (status, content type, body)."""
+        url = urlsplit(target)
+        start = timer()
+        try:
+            return self._handle(method, url, body)
+        finally:
+            self.stats.observe('request_' + (url.path[1:] if url.path in ENDPOINTS
+                                             else 'other'), timer() - start)
+
+    def _handle(self, method, url, body):
+        params = dict((name, values[-1]) for name, values in
+                      parse_qs(url.query, keep_blank_values=True).items())
+        try:
+            if url.path in ('/stats', '/metrics', '/info'):
+                if method not in ('GET', 'HEAD'):
+                    raise HttpError(405, "Use GET for %s" % url.path)
+                if url.path == '/info':
+                    content_type, body = self.info()
+                else:
+                    if url.path == '/metrics':
+                        params['format'] = 'prometheus'
+                    content_type, body = self.stats_report(params)
+            elif url.path == '/query':
+                if method not in ('GET', 'HEAD'):
+                    raise HttpError(405, "Use GET for /query")
+                content_type, body = self.query(params)
+            elif url.path == '/save':
+                if method != 'POST':
+                    raise HttpError(405, "Use POST for /save")
+                content_type, body = self.save(params, body)
+            else:
+                raise HttpError(404, "No such endpoint %s" % url.path)
+        except HttpError as e:
+            return e.status, CONTENT_TYPES['text'], str(e) + "\n"
+        except ValueError as e:
+            return 400, CONTENT_TYPES['text'], str(e) + "\n"
+        return 200, content_type, body
+
+    async def handle_connection(self, reader, writer):
+        """Answer the requests made on a connection until it is closed."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length', 0))
+                if length > MAX_BODY:
+                    status, content_type, body = 413, CONTENT_TYPES['text'], "Too long\n"
+                else:
+                    status, content_type, body = self.handle(
+                            method, target, await reader.readexactly(length))
+                if not isinstance(body, bytes):
+                    body = body.encode('utf-8')
+
+                keep_alive = headers.get('connection', '').lower() != 'close' and \
+                        version == 'HTTP/1.1' and status != 413
+                writer.write(("HTTP/1.1 %d %s\r\nContent-Type: %s\r\n"
+                              "Content-Length: %d\r\nConnection: %s\r\n\r\n"
+                              % (status, STATUS_REASONS[status], content_type, len(body),
+                                 "keep-alive" if keep_alive else "close")).encode('latin-1'))
+                if method != 'HEAD':
+                    writer.write(body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            pass # a malformed request, or the client went away
+        finally:
+            writer.close()
+
+    async def start(self, socket_path=None, host='127.0.0.1', port=None):
+        """Start listening. Returns the list of asyncio servers."""
+        servers = []
+        if socket_path:
+            if os.path.exists(socket_path):
+                os.remove(socket_path) # left behind by a server that died
+            servers.append(await asyncio.start_unix_server(self.handle_connection,
+                                                           path=socket_path))
+        if port is not None:
+            servers.append(await asyncio.start_server(self.handle_connection,
+                                                      host=host, port=port))
+        return servers
+
+
+def serve(rrd, socket_path=None, host='127.0.0.1', port=None, database=None):
+    """Serve `rrd` until interrupted.
+
+    Keyword arguments:
+    rrd         -- the RoundRobinDb to serve
+    socket_path -- the path of a Unix socket to listen on
+    host, port  -- the address of a TCP port to listen on
+    database    -- a name of the database, reported by /info
+
+    At least one of `socket_path` and `port` must be given.
+    """
+    if not socket_path and port is None:
+        raise ValueError("A socket path or port is required")
+    server = RrdServer(rrd, database)
+
+    async def run():
+        # The servers accept connections in the background until we're stopped
+        stopped = asyncio.get_running_loop().create_future()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            asyncio.get_running_loop().add_signal_handler(
+                    signum, lambda: stopped.done() or stopped.set_result(None))
+        servers = await server.start(socket_path, host, port)
+        try:
+            await stopped
+        finally:
+            for s in servers:
+                s.close()
+
+    try:
+        asyncio.run(run())
+    finally:
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+import struct
+import sys
+from array import array
+
+from . import bucket, format_archives, open_database, parse_archives, range_func
+
+"""Exporting a round-robin database to a file, and importing it into any backend.
+
+`export_snapshot()` writes every series of a database to a binary stream, and
+`import_snapshot()` reads one into a new database of any engine, so `rrd export`
+and `rrd import` can back up a database or move it to another engine:
+
+    rrd export backup.rrdx
+    rrd export - | RRD_DATABASE=Redis:/localhost:6379 rrd import -
+
+A snapshot holds the archives, and the state of each series (little-endian):
+
+    magic "RRDX" (4 bytes)  version (uint16)
+    archives length (uint16)  archives (utf-8, as given to `parse_archives()`)
+    number of series (uint32)
+    for each series:
+        name length (uint16)  name (utf-8)  last_timestamp (int64, -1 if empty)
+        for each table:
+            head count (int64)
+            chunks of entries, each: length (uint32)  values (float64 * length)
+            an empty chunk (a length of 0)
+
+The entries of each table are its written entries, oldest first, with NaN for
+NULL. Since they are one step apart and the newest is in the entry of the
+last timestamp, their timestamps are not stored. Where each ring starts in the
+exporting backend isn't kept either: the importing backend writes the entries
+to the start of its rings.
+
+A table is written in chunks as it is read (see `RoundRobinDb.iter_query()`),
+so exporting doesn't hold whole tables in memory. Importing reads the whole
+snapshot before it writes anything, so a truncated or corrupt snapshot leaves
+the database as it was, and then writes each series with a single
+`save_timestamps()`, all in one transaction.
+"""
+SNAPSHOT_MAGIC = b'RRDX'
+SNAPSHOT_VERSION = 1
+HEADER = struct.Struct('<4sH')
+LENGTH = struct.Struct('<H')
+SERIES_COUNT = struct.Struct('<I')
+TIMESTAMP = struct.Struct('<q')
+HEAD_COUNT = struct.Struct('<q')
+CHUNK_LENGTH = struct.Struct('<I')
+
+# How many entries are written in each chunk
+CHUNK_ROWS = 4096
+
+NAN = float('nan')
+
+
+def _write_string(stream, string):
+    data = string.encode('utf-8')
+    stream.write(LENGTH.pack(len(data)) + data)
+
+def _write_values(stream, values):
+    stream.write(CHUNK_LENGTH.pack(len(values)))
+    if sys.byteorder != 'little':
+        values = array('d', values)
+        values.byteswap()
+    stream.write(values.tobytes())
+
+def _read(stream, size):
+    data = stream.read(size)
+    if len(data) < size:
+        raise ValueError("The snapshot is truncated")
+    return data
+
+def _read_string(stream):
+    return _read(stream, _read_struct(stream, LENGTH)).decode('utf-8')
+
+def _read_struct(stream, record):
+    return record.unpack(_read(stream, record.size))[0]
+
+
+def export_snapshot(rrd, stream, series=None):
+    """Write a snapshot of a database.
+
+    Keyword arguments:
+    rrd    -- a RoundRobinDb of the database
+    stream -- a binary file-like object to write to
+    series -- the names of the series to export (default: every series that
+              holds values)
+    """
+    names = rrd.series_names() if series is None else list(series)
+    stream.write(HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION))
+    _write_string(stream, format_archives(rrd.archives))
+    stream.write(SERIES_COUNT.pack(len(names)))
+    for name in names:
+        db = rrd if name == rrd.series else rrd.select(name)
+        with db.read_transaction():
+            last = db.last_timestamp
+            _write_string(stream, name)
+            stream.write(TIMESTAMP.pack(-1 if last is None else last))
+            for archive in db.archives:
+                stream.write(HEAD_COUNT.pack(0 if last is None else db.get_head_count(archive.name)))
+                values, expected = array('d'), None
+                for ts, value in db.iter_query(archive.name):
+                    # Entries are one step apart, so any missing entry is NULL
+                    while expected is not None and expected < ts:
+                        values.append(NAN)
+                        expected += archive.step
+                    values.append(NAN if value is None else value)
+                    expected = ts + archive.step
+                    if len(values) >= CHUNK_ROWS:
+                        _write_values(stream, values)
+                        values = array('d')
+                if values:
+                    _write_values(stream, values)
+                stream.write(CHUNK_LENGTH.pack(0))
+
+
+def read_archives(stream):
+    """Read the header of a snapshot. Returns its archives.
+
+    Throws ValueError if the stream is not a snapshot in a supported version.
+    """
+    header = stream.read(HEADER.size)
+    if len(header) < HEADER.size or HEADER.unpack(header)[0] != SNAPSHOT_MAGIC:
+        raise ValueError("Not a round-robin database snapshot")
+    version = HEADER.unpack(header)[1]
+    if version != SNAPSHOT_VERSION:
+        raise ValueError("Unsupported snapshot version %d" % version)
+    return parse_archives(_read_string(stream))
+
+
+def import_snapshot(stream, backing):
+    """Read a snapshot into a database.
+
+    Keyword arguments:
+    stream  -- a binary file-like object to read from
+    backing -- the (engine, uri) of the database, as for `open_database()`.
+               It is created with the snapshot's archives if it doesn't
+               exist.
+
+    Returns:
+    the RoundRobinDb of the database, which the caller should close
+
+    Throws ValueError if the stream is not a valid snapshot, if the database
+    has other archives, or if it already holds values in one of the
+    snapshot's series. Nothing is imported then, although a database that
+    didn't exist is left created, without values.
+    """
+    archives = read_archives(stream)
+    rrd = open_database(backing, archives)
+    try:
+        # Every series is read before anything is written, so an error leaves
+        # the database as it was
+        snapshot = []
+        for ix in range_func(_read_struct(stream, SERIES_COUNT)):
+            name = _read_string(stream)
+            db = rrd if name == rrd.series else rrd.select(name)
+            if db.last_timestamp is not None:
+                raise ValueError("Series %s already holds values" % name)
+            last = _read_struct(stream, TIMESTAMP)
+            tables = []
+            for archive in archives:
+                head_count = _read_struct(stream, HEAD_COUNT)
+                values = array('d')
+                while True:
+                    length = _read_struct(stream, CHUNK_LENGTH)
+                    if not length:
+                        break
+                    values.frombytes(_read(stream, length * 8))
+                if sys.byteorder != 'little':
+                    values.byteswap()
+                # The entries may have been exported from a larger archive
+                tables.append((head_count, values[-archive.rows:]))
+            snapshot.append((db, last, tables))
+
+        with rrd.transaction():
+            for db, last, tables in snapshot:
+                data = {'updates': {}, 'counts': {}}
+                for archive, (head_count, values) in zip(archives, tables):
+                    newest = None if last == -1 else bucket(last, archive.step, db.timezone)
+                    first = None if newest is None else newest - (len(values) - 1) * archive.step
+                    data[archive.name] = [(first + ix * archive.step,
+                                           None if value != value else value)
+                                          for ix, value in enumerate(values)]
+                    if values:
+                        data['counts'][archive.name] = head_count
+                if data[archives[0].name]:
+                    db.save_timestamps(data)
+    except:
+        rrd.close()
+        raise
+    return rrd
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+import time
+
+"""Counters and latency histograms of the operations of a RoundRobinDb.
+
+Instrumentation is off unless `RoundRobinDb.enable_stats()` is called, which
+wraps the operations in OPERATIONS of that object (and the objects `select()`
+returns from it) to time them, and has the backend count its calls:
+
+    sql_statements      SQL statements run (SQLite)
+    commits             transactions committed (SQLite)
+    meta_loads          reads of the Meta values, e.g. after another process
+                        saved (SQLite)
+    redis_round_trips   commands and pipelines sent to the server (Redis)
+    state_loads         reads of a series' state, e.g. after another client
+                        saved (Redis)
+    cache_hits          queries answered from the read cache
+    cache_misses        queries that had to read the database
+    buffer_flushes      writes of the values collected by `buffered()`
+
+Until then nothing is wrapped or counted, so there is no overhead beyond a
+check of `stats` in a few places.
+
+Stats can be read as a dict, as lines of text (`rrd stats`), or in the
+Prometheus text exposition format (`rrd serve` answers `/metrics`). Each timed
+call can also be written to a trace log, one line per call:
+
+    <unix time> <operation> <series> <duration in microseconds>
+"""
+# The operations timed, and the RoundRobinDb methods that perform them
+OPERATIONS = (('save', 'save_many'),
+              ('update', 'update_timestamp'),
+              ('query', 'query'),
+              ('read_all', 'read_all'),
+              ('index_lookup', 'get_timestamp_index'),
+              ('summary', 'summary'))
+
+# The upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+class Histogram(object):
+    """The distribution of the durations of an operation."""
+    def __init__(self):
+        # The number of durations in each bucket (not cumulative), with one
+        # more bucket for those longer than the last bound
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        for ix, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                break
+        else:
+            ix = len(BUCKETS)
+        self.buckets[ix] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def as_dict(self):
+        return {'count': self.count, 'sum': self.sum, 'max': self.max,
+                'buckets': dict(zip([str(bound) for bound in BUCKETS] + ['+Inf'],
+                                    self.buckets))}
+
+
+class Stats(object):
+    """The counters and histograms of one or more RoundRobinDbs.
+
+    Arguments:
+        trace   A text file-like object to write a line to for each timed call
+                (default: no trace)
+    """
+    def __init__(self, trace=None):
+        self.trace = trace
+        self.counters = {}
+        self.histograms = {}
+
+    def count(self, name, number=1):
+        """Add to a counter."""
+        self.counters[name] = self.counters.get(name, 0) + number
+
+    def observe(self, operation, seconds, series=None):
+        """Record the duration of a call of an operation."""
+        if operation not in self.histograms:
+            self.histograms[operation] = Histogram()
+        self.histograms[operation].observe(seconds)
+        if self.trace is not None:
+            self.trace.write("%.6f %s %s %.1f\n" % (time.time(), operation, series or '-',
+                                                    seconds * 1e6))
+
+    def timed(self, operation, function, series=None):
+        """Wrap a function so that every call is observed as `operation`."""
+        def wrapper(*args, **kwargs):
+            start = timer()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.observe(operation, timer() - start, series)
+        return wrapper
+
+    def as_dict(self):
+        """The counters and histograms, as a JSON-compatible dict."""
+        return {'counters': dict(self.counters),
+                'operations': dict((operation, histogram.as_dict()) for operation, histogram
+                                   in self.histograms.items())}
+
+    def format_text(self):
+        """The counters, and the count and mean and maximum duration of each
+        operation, as lines of text."""
+        lines = []
+        for operation in sorted(self.histograms):
+            histogram = self.histograms[operation]
+            lines.append("%-14s %8d calls  mean %10.1f us  max %10.1f us" % (
+                    operation, histogram.count, histogram.sum / histogram.count * 1e6,
+                    histogram.max * 1e6))
+        for name in sorted(self.counters):
+            lines.append("%-20s %8d" % (name, self.counters[name]))
+        return "".join(line + "\n" for line in lines)
+
+    def format_prometheus(self, prefix='rrd_'):
+        """The counters and histograms in the Prometheus text format."""
+        lines = []
+        if self.histograms:
+            lines.append("# HELP %soperation_seconds Time taken by database operations."
+                         % prefix)
+            lines.append("# TYPE %soperation_seconds histogram" % prefix)
+        for operation in sorted(self.histograms):
+            histogram = self.histograms[operation]
+            cumulative = 0
+            for bound, count in zip([repr(bound) for bound in BUCKETS] + ['+Inf'],
+                                    histogram.buckets):
+                cumulative += count
+                lines.append('%soperation_seconds_bucket{operation="%s",le="%s"} %d'
+                             % (prefix, operation, bound, cumulative))
+            lines.append('%soperation_seconds_sum{operation="%s"} %r'
+                         % (prefix, operation, histogram.sum))
+            lines.append('%soperation_seconds_count{operation="%s"} %d'
+                         % (prefix, operation, histogram.count))
+        for name in sorted(self.counters):
+            lines.append("# TYPE %s%s_total counter" % (prefix, name))
+            lines.append("%s%s_total %d" % (prefix, name, self.counters[name]))
+        return "".join(line + "\n" for line in lines)
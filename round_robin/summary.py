@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+import collections
+import math
+
+from . import range_func
+
+"""Summary statistics of a round-robin table, maintained as entries are written.
+
+A `WindowSummary` mirrors the values of one table's ring of entries, and keeps
+the count and sum of its non-NULL values along with two segment trees of their
+minimum and maximum. Writing any entry - a new entry overwriting the oldest, or
+a change to the value of an existing entry - costs O(log rows), and reading the
+summary costs O(1).
+
+A monotonic deque would also give O(1) minimum and maximum for a sliding
+window, but only if entries never change once written. The most recent entry
+of a table changes with every value consolidated into it, so the trees are
+used instead.
+"""
+Summary = collections.namedtuple('Summary', 'count total min max average')
+
+EMPTY_SUMMARY = Summary(0, 0.0, None, None, None)
+
+INF = float('inf')
+
+
+class WindowSummary(object):
+    """The summary of a ring of `rows` entries, oldest first.
+
+    Arguments:
+        rows    The number of entries in the ring
+        values  The values of the entries, oldest first, with `None` for NULL
+                (default: all NULL)
+    """
+    def __init__(self, rows, values=()):
+        self.rows = rows
+        values = list(values)[-rows:]
+        self._values = [None] * (rows - len(values)) + values
+        # The slot the next entry is written to, which holds the oldest entry
+        self._next = 0
+        # Leaves rows..2*rows-1 hold the values (inf for NULL), and every other
+        # node the minimum (maximum) of its two children, so node 1 holds the
+        # minimum (maximum) of the whole table
+        self._mins = [INF] * rows + [INF if v is None else v for v in self._values]
+        self._maxs = [-INF] * rows + [-INF if v is None else v for v in self._values]
+        for node in range_func(rows - 1, 0, -1):
+            self._mins[node] = min(self._mins[2 * node], self._mins[2 * node + 1])
+            self._maxs[node] = max(self._maxs[2 * node], self._maxs[2 * node + 1])
+        self._refresh_total()
+
+    def _refresh_total(self):
+        present = [v for v in self._values if v is not None]
+        self.count = len(present)
+        self.total = math.fsum(present)
+        # The running total picks up rounding errors as values are added and
+        # removed, so it is recomputed exactly after every `rows` writes
+        self._writes = 0
+
+    def push(self, value):
+        """Write a new entry, overwriting the oldest."""
+        self._set(self._next, value)
+        self._next = (self._next + 1) % self.rows
+
+    def replace(self, value, age=0):
+        """Change the value of an entry (by default the most recent one).
+
+        Keyword arguments:
+        value -- the new value, or `None` for NULL
+        age   -- the number of entries written after the entry
+        """
+        self._set((self._next - 1 - age) % self.rows, value)
+
+    def _set(self, slot, value):
+        old = self._values[slot]
+        if old is not None:
+            self.count -= 1
+            self.total -= old
+        if value is not None:
+            self.count += 1
+            self.total += value
+        self._values[slot] = value
+
+        node = slot + self.rows
+        self._mins[node] = INF if value is None else value
+        self._maxs[node] = -INF if value is None else value
+        node //= 2
+        while node:
+            self._mins[node] = min(self._mins[2 * node], self._mins[2 * node + 1])
+            self._maxs[node] = max(self._maxs[2 * node], self._maxs[2 * node + 1])
+            node //= 2
+
+        self._writes += 1
+        if self._writes >= self.rows:
+            self._refresh_total()
+
+    @property
+    def summary(self):
+        """The `Summary` of the non-NULL values in the table."""
+        if not self.count:
+            return EMPTY_SUMMARY
+        return Summary(self.count, self.total, self._mins[1], self._maxs[1],
+                       self.total / self.count)
+
+
+class RunningSummary(object):
+    """The summary of values seen one at a time, in constant memory, for
+    tables read as a stream (see `RoundRobinDb.iter_query()`)."""
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        """Add a value, or `None` for NULL."""
+        if value is None:
+            return
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def watch(self, rows):
+        """Generate (timestamp, value) rows, adding each value as it passes."""
+        for row in rows:
+            self.add(row[1])
+            yield row
+
+    @property
+    def summary(self):
+        """The `Summary` of the values added."""
+        if not self.count:
+            return EMPTY_SUMMARY
+        return Summary(self.count, self.total, self.min, self.max, self.total / self.count)
@@ -11,78 +11,392 @@ class Rrdtool(object):
 
     This object represents our program. It configures the `round_robin`
     module to manage the backing data store (SQLite3 database) with our
-    specific parameters - a minute database with 60 entries and an hour
-    database with 24 entries.
+    specific parameters - by default a minute database with 60 entries and an
+    hour database with 24 entries.
     """
     def __init__(self):
+        # The database is only opened once it is needed, since queries may be
+        # answered by a running `rrd serve` instead
+        self._rrd = None
+        # User can pass a file to log every database operation to (with its
+        # duration) as an environment var
+        self.trace_path = os.getenv('RRD_TRACE')
+        self._trace = None
+        # User can pass the socket of a running `rrd serve` as an environment
+        # var, or it defaults to rrd.sock in the current working directory
+        self.socket_path = os.getenv('RRD_SOCKET', os.path.join(os.getcwd(), 'rrd.sock'))
+
+    @property
+    def backing(self):
+        """The (engine, uri) of the database."""
         # User can pass in the database they want to use as an environment var
         # or it defaults to rrd-data in the current working directory
         rrd_backing = os.getenv('RRD_DATABASE',
                 ":/".join(["SQLite", os.path.join(os.getcwd(),'rrd-data.db')]))
-        rrd_backing = rrd_backing.split(":/")
-        self.rrd = round_robin.open_database(rrd_backing)
-
-    def query(self, db):
-        """Query the specified RRD and output all values and a summary."""
-        entries = self.rrd.query(db) 
-        count_values, total = 0,0
-        smallest, largest = None, None
-        for ts, value in entries:
-            if ts is not None:
-                if value is not None:
-                    count_values += 1
-                    total += value
-                    if largest is None or value > largest:
-                        largest = value
-                    if smallest is None or value < smallest:
-                        smallest = value
-
-                    # Choosing 2 decimal place precision
-                    print("%d, %.2f" %(ts, value))
-                else:
-                    print("%d, NULL" % ts)
-        if count_values == 0:
-            print("Database is empty. Please add some values.")
-        else:
-            print("%s: min: %r, avg: %.2f, max: %r" % (db, smallest,
-                (total/count_values) if count_values > 0 else float('nan'), largest))
-
-    def save(self, timestamp, value):
+        return rrd_backing.split(":/")
+
+    @property
+    def database(self):
+        """The name of the database a running `rrd serve` reports: the
+        engine and uri of `backing`, with the path of a file made absolute
+        and its options left out, so other directories name it the same."""
+        engine, uri = self.backing
+        if engine.lower() != 'redis':
+            uri = uri.split('?')[0]
+            uri = os.path.abspath(uri) if uri else uri
+        return ":/".join([engine.lower(), uri])
+
+    @property
+    def rrd(self):
+        """The RoundRobinDb, opened on first use."""
+        if self._rrd is None:
+            # The archives of a new database, e.g. "1m:1440, 1h:720:avg, 1d:365:max"
+            rrd_archives = os.getenv('RRD_ARCHIVES')
+            try:
+                if rrd_archives:
+                    rrd_archives = round_robin.parse_archives(rrd_archives)
+                self._rrd = round_robin.open_database(self.backing, rrd_archives or None)
+                if self.trace_path:
+                    self._trace = open(self.trace_path, 'a')
+                    self._rrd.enable_stats(trace=self._trace)
+            except ValueError as e:
+                print(str(e), file=sys.stderr)
+                sys.exit(1) # Error
+        return self._rrd
+
+    def _select(self, series):
+        """The RoundRobinDb for the named series."""
+        if series == self.rrd.series:
+            return self.rrd
+        return self.rrd.select(series)
+
+    def query(self, db, series=round_robin.DEFAULT_SERIES, summary_only=False,
+              fmt='text', start=None, end=None, limit=None, step=None, cf='average'):
+        """Query the specified RRD and output all values and a summary.
+
+        If `summary_only` is set, only the summary is output, which does not
+        need the values to be read. `fmt` is one of `round_robin.output.FORMATS`.
+        With a `start`, `end` or `limit`, only the values in that range are
+        read and output (see `RoundRobinDb.query()`). With a `step`, the values
+        are resampled to that step with `cf` (see `RoundRobinDb.resample()`).
+        The values are streamed from the database to stdout, so the memory
+        used doesn't depend on the size of the archive.
+        """
+        import round_robin.output
+        # Binary formats are written to stdout as they are
+        writer = round_robin.output.OutputWriter(getattr(sys.stdout, 'buffer', sys.stdout), fmt)
+        try:
+            output = self._query_server(db, series, summary_only, fmt, start, end, limit,
+                                        step, cf)
+            if output is None:
+                writer.write_query(self._select(series), db, summary_only, start, end, limit,
+                                   step, cf)
+            else:
+                writer.write(output)
+        except ValueError as e:
+            print(str(e), file=sys.stderr)
+            sys.exit(1) # Error
+        writer.flush()
+
+    def query_many(self, pattern, db, series=round_robin.DEFAULT_SERIES, combined=False,
+                   fmt='text', start=None, end=None, limit=None, processes=None):
+        """Query the same archive of many database files in parallel, and
+        output the rows of each file, or with `combined` the count, min, avg
+        and max of each timestamp across the files.
+
+        `pattern` is a glob pattern, or a directory whose `*.db` files are
+        read. The files use the engine of `RRD_DATABASE` (see
+        `round_robin.fleet`). Files that can't be read are reported, and make
+        the exit status 1.
+        """
+        import round_robin.output
+        from round_robin import fleet
+        paths = fleet.expand_paths(pattern)
+        if not paths:
+            print("No database files match %s" % pattern, file=sys.stderr)
+            sys.exit(1) # Error
+        results = fleet.query_many(paths, db, series, self.backing[0], start, end,
+                                   limit, processes)
+        writer = round_robin.output.OutputWriter(getattr(sys.stdout, 'buffer', sys.stdout), fmt)
+        fleet.write_results(writer, db, results, combined)
+        writer.flush()
+        errors = [(path, error) for path, rows, error in results if error is not None]
+        for path, error in errors:
+            print("%s: %s" % (path, error), file=sys.stderr)
+        if errors:
+            sys.exit(1) # Error
+
+    def _query_server(self, db, series, summary_only, fmt, start=None, end=None, limit=None,
+                      step=None, cf='average'):
+        """The output of the query from a running `rrd serve`, or `None` if
+        there is no server listening on our socket, or it serves another
+        database."""
+        if not os.path.exists(self.socket_path):
+            return None
+        from round_robin.client import RrdClient, ServerUnavailable
+        client = RrdClient(self.socket_path)
+        try:
+            try:
+                if client.info()['database'] != self.database:
+                    return None
+            except ValueError:
+                return None # a server that doesn't say which database it serves
+            return client.query(db, series, fmt, summary_only, start, end, limit, step, cf)
+        except ServerUnavailable:
+            return None
+        finally:
+            client.close()
+
+    def save(self, timestamp, value, series=round_robin.DEFAULT_SERIES):
         """Save the specified value in the RRD at the given timestamp."""
         try:
-            self.rrd.save(timestamp, value)
+            self._select(series).save(timestamp, value)
+        except ValueError as e:
+            print(str(e), file=sys.stderr)
+            sys.exit(1) # Error
+
+    def save_stream(self, stream, series=round_robin.DEFAULT_SERIES, batch_size=1000,
+                    coalesce=False):
+        """Save `[series] timestamp value` lines read from `stream` in batches.
+
+        Lines without a series name are saved in `series`. Each batch of up to
+        `batch_size` points is written to the RRD in a single transaction.
+
+        With `coalesce`, the values are written as each minute ends instead
+        (see `RoundRobinDb.buffered()`), which suits a collector piping many
+        values a minute to a long-running `rrd save -`.
+        """
+        if coalesce:
+            self._save_stream_coalesced(stream, series)
+            return
+        batch, batch_length = {}, 0
+        try:
+            for line_no, line in enumerate(stream, 1):
+                try:
+                    point = round_robin.parse_point(line, series)
+                except ValueError as e:
+                    raise ValueError("Line %d: %s" % (line_no, e))
+                if point is None:
+                    continue # skip blank lines
+                line_series, timestamp, value = point
+                batch.setdefault(line_series, []).append((timestamp, value))
+                batch_length += 1
+                if batch_length >= batch_size:
+                    self.rrd.save_series(batch)
+                    batch, batch_length = {}, 0
+            self.rrd.save_series(batch)
+        except ValueError as e:
+            print(str(e), file=sys.stderr)
+            sys.exit(1) # Error
+
+    def _save_stream_coalesced(self, stream, series):
+        dbs = {}
+        try:
+            with self.rrd.buffered():
+                for line_no, line in enumerate(stream, 1):
+                    try:
+                        point = round_robin.parse_point(line, series)
+                        if point is None:
+                            continue # skip blank lines
+                        line_series, timestamp, value = point
+                        if line_series not in dbs:
+                            dbs[line_series] = self._select(line_series)
+                        dbs[line_series].save(timestamp, value)
+                    except ValueError as e:
+                        raise ValueError("Line %d: %s" % (line_no, e))
         except ValueError as e:
             print(str(e), file=sys.stderr)
             sys.exit(1) # Error
 
+    def export(self, path='-'):
+        """Write a snapshot of every series to `path`, or stdout for `-` (see
+        `round_robin.snapshot`)."""
+        from round_robin.snapshot import export_snapshot
+        if path == '-':
+            export_snapshot(self.rrd, getattr(sys.stdout, 'buffer', sys.stdout))
+            sys.stdout.flush()
+            return
+        with open(path, 'wb') as f:
+            export_snapshot(self.rrd, f)
+
+    def import_(self, path='-'):
+        """Read a snapshot from `path`, or stdin for `-`, into the database.
+
+        The database is created with the snapshot's archives if it doesn't
+        exist, and must not hold values in any of the snapshot's series.
+        """
+        from round_robin.snapshot import import_snapshot
+        try:
+            if path == '-':
+                self._rrd = import_snapshot(getattr(sys.stdin, 'buffer', sys.stdin),
+                                            self.backing)
+            else:
+                with open(path, 'rb') as f:
+                    self._rrd = import_snapshot(f, self.backing)
+        except (IOError, ValueError) as e:
+            print(str(e), file=sys.stderr)
+            sys.exit(1) # Error
+
+    def serve(self, socket_path=None, port=None, host='127.0.0.1'):
+        """Answer queries and saves until interrupted (see `round_robin.server`)."""
+        from round_robin.server import serve
+        if port is None:
+            socket_path = socket_path or self.socket_path
+        addresses = [socket_path] if socket_path else []
+        if port is not None:
+            addresses.append("%s:%d" % (host, port))
+        print("Serving on %s" % " and ".join(addresses), file=sys.stderr)
+        serve(self.rrd, socket_path, host, port, self.database)
+
+    def stats(self, fmt='text'):
+        """Output the stats of the running `rrd serve` (see `round_robin.stats`)."""
+        from round_robin.client import RrdClient, ServerUnavailable
+        client = RrdClient(self.socket_path)
+        try:
+            sys.stdout.write(client.stats(fmt))
+        except ServerUnavailable as e:
+            print("%s. Stats are kept by `rrd serve`." % e, file=sys.stderr)
+            sys.exit(1) # Error
+        finally:
+            client.close()
+
     def close_db(self):
         """Close connection to the database, if necessary."""
-        self.rrd = None
+        if self._rrd is not None:
+            self._rrd.close()
+            self._rrd = None
+        if self._trace is not None:
+            self._trace.close()
+            self._trace = None
+
+def build_parser():
+    """The parser of the command line, and the parsers of its subcommands by
+    name."""
+    # Set up a parser for command-line arguments, store the command given
+    parser = argparse.ArgumentParser(description="Save and query data in an RRD",
+                                     add_help=False)
+    # Giving the prog saves argparse from formatting a usage line to work it out
+    subparsers = parser.add_subparsers(dest="command", prog=parser.prog)
+
+    # Create a parser for "save"
+    save_parser = subparsers.add_parser("save", add_help=False)
+    # A timestamp of `-` reads `timestamp value` lines from stdin instead
+    save_parser.add_argument("series", nargs="?")
+    save_parser.add_argument("timestamp")
+    save_parser.add_argument("value", nargs="?")
+    # With `-`, write once a minute rather than in batches of lines
+    save_parser.add_argument("--coalesce", action="store_true")
+
+    # Create a parser for "query"
+    query_parser = subparsers.add_parser("query", add_help=False)
+    query_parser.add_argument("series", nargs="?", default=round_robin.DEFAULT_SERIES)
+    # One of the database's archives, e.g. "minutes" or "hours"
+    query_parser.add_argument("db")
+    query_parser.add_argument("--summary-only", action="store_true")
+    # One of `round_robin.output.FORMATS`, checked by `main()`
+    query_parser.add_argument("--format", default="text")
+    # Only the entries from/until a timestamp, or the most recent N of them
+    query_parser.add_argument("--since", type=int)
+    query_parser.add_argument("--until", type=int)
+    query_parser.add_argument("--last", type=int)
+    # Resample the entries to a larger step (in seconds), combining them with --cf
+    query_parser.add_argument("--step", type=int)
+    query_parser.add_argument("--cf", default="average",
+                              choices=("min", "max", "avg", "average", "last", "count"))
+
+    # Create a parser for "query-many", of the same archive of many files
+    query_many_parser = subparsers.add_parser("query-many", add_help=False)
+    # A glob pattern, or a directory of *.db files
+    query_many_parser.add_argument("pattern")
+    query_many_parser.add_argument("db")
+    query_many_parser.add_argument("--series", default=round_robin.DEFAULT_SERIES)
+    # The min/avg/max of each timestamp across the files, rather than every row
+    query_many_parser.add_argument("--aggregate", action="store_true")
+    query_many_parser.add_argument("--format", default="text",
+                                   choices=("text", "csv", "json", "ndjson"))
+    query_many_parser.add_argument("--since", type=int)
+    query_many_parser.add_argument("--until", type=int)
+    query_many_parser.add_argument("--last", type=int)
+    # Defaults to the number of cores
+    query_many_parser.add_argument("--processes", type=int)
+
+    # Create parsers for "export" and "import", of a file or stdout/stdin (`-`)
+    export_parser = subparsers.add_parser("export", add_help=False)
+    export_parser.add_argument("file", nargs="?", default="-")
+    import_parser = subparsers.add_parser("import", add_help=False)
+    import_parser.add_argument("file", nargs="?", default="-")
 
-# Set up a parser for command-line arguments, store the command given
-parser = argparse.ArgumentParser(description="Save and query data in an RRD", 
-                                 add_help=False)
-subparsers = parser.add_subparsers(dest="command")
+    # Create a parser for "serve"
+    serve_parser = subparsers.add_parser("serve", add_help=False)
+    # Listens on RRD_SOCKET unless only a port is given
+    serve_parser.add_argument("--socket")
+    serve_parser.add_argument("--port", type=int)
+    serve_parser.add_argument("--host", default="127.0.0.1")
 
-# Create a parser for "save"
-save_parser = subparsers.add_parser("save", add_help=False)
-save_parser.add_argument("timestamp", type=int)
-save_parser.add_argument("value", type=float)
+    # Create a parser for "stats"
+    stats_parser = subparsers.add_parser("stats", add_help=False)
+    stats_parser.add_argument("--format", default="text", choices=("text", "json", "prometheus"))
 
-# Create a parser for "query"
-query_parser = subparsers.add_parser("query", add_help=False)
-query_parser.add_argument("db", choices=["minutes","hours"])
+    return parser, {'save': save_parser, 'query': query_parser}
+
+
+def main(argv=None):
+    """Run the `rrd` command with the given arguments (default: sys.argv).
+
+    Only the modules the subcommand needs are imported, e.g. a save imports
+    neither the output formats nor any other storage engine.
+    """
+    parser, subcommands = build_parser()
+    # Parse arguments and call the respective function for the command given
+    args = parser.parse_args(argv)
+    if args.command == "save" and args.value is None and args.timestamp != "-" \
+            and args.series is not None:
+        # `rrd save <timestamp> <value>` saves in the default series
+        args.series, args.timestamp, args.value = None, args.series, args.timestamp
+    if args.command == "query":
+        # The output formats are only imported by the commands that need them
+        from round_robin.output import FORMATS
+        if args.format not in FORMATS:
+            subcommands["query"].error("argument --format: invalid choice: %r (choose from %s)"
+                                       % (args.format, ", ".join(map(repr, FORMATS))))
+    if args.command == "save" and args.series is None:
+        args.series = round_robin.DEFAULT_SERIES
+    if args.command == "save" and args.timestamp != "-":
+        if args.value is None:
+            subcommands["save"].error("the following arguments are required: value")
+        try:
+            args.timestamp = int(args.timestamp)
+        except ValueError:
+            subcommands["save"].error("invalid int value: %r" % args.timestamp)
+        try:
+            args.value = float(args.value)
+        except ValueError:
+            subcommands["save"].error("invalid float value: %r" % args.value)
 
+    # Create our Rrdtool object
+    rrdtool = Rrdtool()
 
-# Parse arguments and call the respective function for the command given
-args = parser.parse_args()
+    if args.command == "query":
+        rrdtool.query(args.db, args.series, args.summary_only, args.format,
+                      args.since, args.until, args.last, args.step, args.cf)
+    elif args.command == "save" and args.timestamp == "-":
+        rrdtool.save_stream(sys.stdin, args.series, coalesce=args.coalesce)
+    elif args.command == "save":
+        rrdtool.save(args.timestamp, args.value, args.series)
+    elif args.command == "query-many":
+        rrdtool.query_many(args.pattern, args.db, args.series, args.aggregate, args.format,
+                           args.since, args.until, args.last, args.processes)
+    elif args.command == "export":
+        rrdtool.export(args.file)
+    elif args.command == "import":
+        rrdtool.import_(args.file)
+    elif args.command == "serve":
+        rrdtool.serve(args.socket, args.port, args.host)
+    elif args.command == "stats":
+        rrdtool.stats(args.format)
 
-# Create our Rrdtool object
-rrdtool = Rrdtool()
+    rrdtool.close_db()
 
-if args.command == "query":
-    rrdtool.query(args.db)
-elif args.command == "save":
-    rrdtool.save(args.timestamp, args.value)
 
-rrdtool.close_db()
+if __name__ == '__main__':
+    main()
@@ -3,13 +3,34 @@ import sys
 import os
 import unittest
 import datetime
+import io
+import json
+import multiprocessing
+import sqlite3
+import subprocess
+import time
 
 # Path hack lets us import sibling packages
 sys.path.insert(0, os.path.abspath('..'))
 import round_robin as rr
+import round_robin.bench
+import round_robin.fleet
+import round_robin.output
+import round_robin.snapshot
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
 
 TEST_DB = 'test.db'
 
+def remove_test_db():
+    # Along with any SQLite write-ahead log left by a connection not closed
+    for path in (TEST_DB, TEST_DB + '-wal', TEST_DB + '-shm'):
+        if os.path.exists(path):
+            os.remove(path)
+
 class DatabaseSetupTests(unittest.TestCase):
     def setUp(self):
         pass
@@ -47,7 +68,89 @@ class HelperFunctionsTest(unittest.TestCase):
                          rr.timestamp_hour(atimestamp),
                          "timestamp_hour() function failing.")
 
+class BucketingTests(unittest.TestCase):
+    # Three days in January, and a day either side of the 2017 US and EU
+    # daylight saving time changes
+    timestamps = list(range(1483967112, 1483967112 + 3 * 86400, 997)) + \
+                 list(range(1489230000, 1489230000 + 2 * 86400, 997)) + \
+                 list(range(1490490000, 1490490000 + 2 * 86400, 997))
+
+    def test_bucket_matches_datetime(self):
+        for t in self.timestamps:
+            local = rr.timestamp_to_time(t)
+            self.assertEqual(rr.time_to_timestamp(local.replace(second=0)),
+                             rr.bucket(t, 60))
+            self.assertEqual(rr.time_to_timestamp(local.replace(minute=0, second=0)),
+                             rr.bucket(t, 3600))
+        # Days are aligned to the offset at the timestamp, which on the day of
+        # a daylight saving time change is not the offset at midnight
+        for t in self.timestamps[:3 * 86400 // 997]:
+            local = rr.timestamp_to_time(t)
+            self.assertEqual(rr.time_to_timestamp(local.replace(hour=0, minute=0, second=0)),
+                             rr.bucket(t, 86400))
+
+    def test_alignment_policies(self):
+        t = 1483967112 # 2017-01-09 13:05:12 UTC
+        self.assertEqual(1483920000, rr.bucket(t, 86400, rr.UTC))
+        self.assertEqual(1483920000 - 5*3600, rr.bucket(t, 86400, 5*3600))
+        self.assertEqual(1483966800 - 1800, rr.bucket(t, 3600, 1800))
+        self.assertRaises(ValueError, rr.bucket, t, 3600, 'mars')
+
+    def test_bucket_array(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("NumPy is not installed")
+        for tz in (rr.LOCAL, rr.UTC, 3600):
+            for step in (60, 3600, 86400):
+                self.assertEqual([rr.bucket(t, step, tz) for t in self.timestamps],
+                                 rr.bucket_array(numpy.array(self.timestamps), step, tz).tolist())
+
+class ResampleTests(unittest.TestCase):
+    def test_arrays_match_rows(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("NumPy is not installed")
+        import random
+        rows = [(1483967100 + m*60, None if m % 5 == 0 or m < 20 else random.random())
+                for m in range(0, 3000)]
+        for cf in ('min', 'max', 'average', 'last', 'count'):
+            for step in (300, 3600, 86400):
+                expected = rr.resampling._resample_rows(rows, step, cf, rr.LOCAL)
+                actual = rr.resampling._resample_arrays(rows, step, cf, rr.LOCAL)
+                self.assertEqual([ts for ts, value in expected], [ts for ts, value in actual])
+                for (ts, value), (ts, other) in zip(expected, actual):
+                    if value is None:
+                        self.assertIsNone(other)
+                    else:
+                        self.assertAlmostEqual(value, other)
+
+class WindowSummaryTests(unittest.TestCase):
+    def test_matches_scan(self):
+        import random
+        rand = random.Random(42)
+        for rows in (1, 2, 7, 60):
+            values = [None] * rows
+            window = rr.WindowSummary(rows)
+            for op in range(500):
+                value = rand.choice([None, rand.uniform(-100, 100)])
+                if rand.random() < 0.3:
+                    age = rand.randrange(rows)
+                    window.replace(value, age)
+                    values[-1 - age] = value
+                else:
+                    window.push(value)
+                    values = values[1:] + [value]
+                present = [v for v in values if v is not None]
+                summary = window.summary
+                self.assertEqual(len(present), summary.count)
+                self.assertEqual(min(present) if present else None, summary.min)
+                self.assertEqual(max(present) if present else None, summary.max)
+                self.assertAlmostEqual(sum(present), summary.total)
+
 class RoundRobinDbSaveTests(unittest.TestCase):
+    backing = ('SQLite', TEST_DB)
     good_data = [( 60, 25.0),
                  (120, 30.0),
                  (180, 35.0),
@@ -56,10 +159,10 @@ class RoundRobinDbSaveTests(unittest.TestCase):
                  (360, 50.0)]
 
     def setUp(self):
-        self.rrd = rr.open_database(('SQLite', TEST_DB))
+        self.rrd = rr.open_database(self.backing)
 
     def tearDown(self):
-        os.remove(TEST_DB)
+        remove_test_db()
         #pass
 
     def test_save(self):
@@ -98,16 +201,17 @@ class RoundRobinDbSaveTests(unittest.TestCase):
 
 
 class RoundRobinDbUQueryTests(unittest.TestCase):
+    backing = ('SQLite', TEST_DB)
     good_data = [(min*60, min*5 + 20.0) for min in range(0,62)]
 
     def setUp(self):
-        self.rrd = rr.open_database(('SQLite', TEST_DB))
+        self.rrd = rr.open_database(self.backing)
         # Save our test data in the database
         for ts, val in self.good_data:
             self.rrd.save(ts, val)
 
     def tearDown(self):
-        os.remove(TEST_DB)
+        remove_test_db()
 
     def testMinutesQuery(self):
         # Testing minutes property
@@ -133,3 +237,1370 @@ class RoundRobinDbUQueryTests(unittest.TestCase):
         # and that our first data entry's value
         # has kept the minimum value from good_data[0]
         self.assertEqual(self.good_data[0], hours[-2])
+
+    def testReadRange(self):
+        # The ring has wrapped, so ranges are read from both ends of it
+        mins = self.rrd.minutes
+        self.assertEqual(mins[-5:], self.rrd.read_range('minutes', 0, 5))
+        self.assertEqual(mins[:3], self.rrd.read_range('minutes', 57, 3))
+        hours = self.rrd.hours
+        self.assertEqual(hours[-3:], self.rrd.read_range('hours', 0, 3))
+
+class RoundRobinDbSaveManyTests(unittest.TestCase):
+    backing = ('SQLite', TEST_DB)
+    good_data = [(min*60, (min % 7) * 5 + 20.0) for min in range(0, 1440)]
+
+    def setUp(self):
+        self.rrd = rr.open_database(self.backing)
+
+    def tearDown(self):
+        remove_test_db()
+
+    def test_save_many_matches_save(self):
+        # Save the same data point-by-point in a second database
+        other = rr.open_database(('SQLite', 'test_other.db'))
+        try:
+            for ts, val in self.good_data[:150]:
+                other.save(ts, val)
+            self.rrd.save_many(self.good_data[:150])
+            self.assertEqual(other.minutes, self.rrd.minutes)
+            self.assertEqual(other.hours, self.rrd.hours)
+        finally:
+            other.close()
+            os.remove('test_other.db')
+
+    def test_save_many_wraps_ring(self):
+        # A day of minute data in one batch leaves the most recent hour
+        self.rrd.save_many(self.good_data)
+        self.assertEqual(self.good_data[-60:], self.rrd.minutes)
+        self.assertEqual([ts for ts in range(0, 86400, 3600)],
+                         [ts for ts, val in self.rrd.hours])
+        self.assertEqual(20.0, self.rrd.hours[-1][1])
+
+    def test_save_many_gaps_and_updates(self):
+        self.rrd.save_many([(60, 30.0), (70, 25.0)])
+        # Same-minute values keep the minimum, gaps are filled with `None`
+        self.rrd.save_many([(90, 10.0), (240, 40.0), (250, 50.0)])
+        self.assertEqual([(60, 10.0), (120, None), (180, None), (240, 40.0)],
+                         self.rrd.minutes[-4:])
+        self.assertEqual([(0, 10.0)], self.rrd.hours[-1:])
+        self.assertRaises(ValueError, self.rrd.save_many, [(180, 1.0)])
+
+class SqliteMetaTests(unittest.TestCase):
+    good_data = [(min*60, min + 20.0) for min in range(0, 150)]
+
+    def setUp(self):
+        self.rrd = rr.open_database(('SQLite', TEST_DB))
+        self.rrd.save_many(self.good_data)
+
+    def tearDown(self):
+        os.remove(TEST_DB)
+
+    def test_meta_persisted(self):
+        minutes, hours = self.rrd.minutes, self.rrd.hours
+        rrd = rr.open_database(('SQLite', TEST_DB))
+        self.assertEqual(self.good_data[-1][0], rrd.last_timestamp)
+        self.assertEqual(minutes, rrd.minutes)
+        self.assertEqual(hours, rrd.hours)
+        self.assertEqual(self.good_data[-2][1],
+                         rrd.get_timestamp_value('Minutes', self.good_data[-2][0]))
+        self.assertIsNone(rrd.get_timestamp_value('Minutes', self.good_data[0][0]))
+
+    def create_legacy_db(self, with_meta):
+        # The single-series layout, with one row per entry and optional Meta
+        conn = sqlite3.connect(TEST_DB)
+        conn.executescript("""
+            DROP TABLE Rings; DROP TABLE Meta;
+            DROP TABLE IF EXISTS Archives;
+            PRAGMA user_version=0;
+            CREATE TABLE Minutes(Id INTEGER PRIMARY KEY, Timestamp INTEGER, Value REAL);
+            CREATE TABLE Hours(Id INTEGER PRIMARY KEY, Timestamp INTEGER, Value REAL);
+            """)
+        conn.executemany("INSERT INTO Minutes VALUES(?, ?, ?);",
+                         [(ts // 60 % 60, ts, val) for ts, val in self.good_data[-60:]])
+        conn.executemany("INSERT INTO Hours VALUES(?, ?, ?);",
+                         [(i, None, None) for i in range(24)])
+        conn.executemany("UPDATE Hours SET Timestamp=?, Value=? WHERE Id=?;",
+                         [(i * 3600, self.good_data[i * 60][1], i) for i in range(3)])
+        if with_meta:
+            conn.execute("CREATE TABLE Meta(Name TEXT PRIMARY KEY, Value INTEGER);")
+            conn.executemany("INSERT INTO Meta VALUES(?, ?);",
+                             [('last_timestamp', self.good_data[-1][0]),
+                              ('minutes_head', 29), ('hours_head', 2)])
+        conn.commit()
+        conn.close()
+
+    def test_meta_migration(self):
+        # Databases created without a Meta table have their ring heads found,
+        # and single-series databases become the default series
+        minutes, hours = self.rrd.minutes, self.rrd.hours
+        self.rrd.close()
+        for with_meta in (False, True):
+            self.create_legacy_db(with_meta)
+            rrd = rr.open_database(('SQLite', TEST_DB))
+            self.assertEqual(self.good_data[-1][0], rrd.last_timestamp)
+            self.assertEqual(minutes, rrd.minutes)
+            self.assertEqual(hours, rrd.hours)
+            rrd.save(self.good_data[-1][0] + 60, 1.0)
+            self.assertEqual((self.good_data[-1][0] + 60, 1.0), rrd.minutes[-1])
+            self.assertEqual(1.0, rrd.hours[-1][1])
+            rrd.close()
+
+    def test_failed_migration_changes_nothing(self):
+        self.rrd.close()
+        self.create_legacy_db(True)
+        migrate = rr.db.SqliteRoundRobinDb._migrate_to_rings
+        def fail(db):
+            raise sqlite3.OperationalError("disk I/O error")
+        rr.db.SqliteRoundRobinDb._migrate_to_rings = fail
+        try:
+            self.assertRaises(sqlite3.OperationalError, rr.open_database, ('SQLite', TEST_DB))
+        finally:
+            rr.db.SqliteRoundRobinDb._migrate_to_rings = migrate
+
+        conn = sqlite3.connect(TEST_DB)
+        self.assertEqual(['Cache', 'Hours', 'Meta', 'Minutes'], [row[0] for row in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type='table' ORDER BY name;")])
+        self.assertEqual(0, conn.execute("PRAGMA user_version;").fetchone()[0])
+        conn.close()
+        rrd = rr.open_database(('SQLite', TEST_DB))
+        self.assertEqual(self.good_data[-1][0], rrd.last_timestamp)
+        rrd.close()
+
+    def test_concurrent_migrations(self):
+        import threading
+        minutes = self.rrd.minutes
+        self.rrd.close()
+        self.create_legacy_db(False)
+        results = []
+        def open_legacy_db():
+            try:
+                rrd = rr.open_database(('SQLite', TEST_DB))
+                results.append(rrd.minutes)
+                rrd.close()
+            except Exception as e:
+                results.append(e)
+        threads = [threading.Thread(target=open_legacy_db) for ix in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([minutes] * 4, results)
+
+    def test_v1_migration(self):
+        # Version 1 databases had a table per archive, with a row per entry
+        cpu = self.rrd.select('cpu')
+        cpu.save_many(self.good_data[:10])
+        old_db = 'test_v1.db'
+        conn = sqlite3.connect(old_db)
+        for statement in rr.db.v1_schema(rr.DEFAULT_ARCHIVES):
+            conn.execute(statement)
+        conn.executemany("INSERT INTO Archives VALUES(?, ?, ?, ?, ?);",
+                         [(ix, a.name, a.step, a.rows, a.cf)
+                          for ix, a in enumerate(rr.DEFAULT_ARCHIVES)])
+        for db in (self.rrd, cpu):
+            for archive in rr.DEFAULT_ARCHIVES:
+                conn.executemany("INSERT INTO %s VALUES(?, ?, ?, ?);"
+                                 % rr.db.table_name(archive.name),
+                                 [(db.series, id, ts, value) for id, (ts, value)
+                                  in enumerate(db.read_all(archive.name)) if ts is not None])
+            conn.executemany("INSERT INTO Meta VALUES(?, ?, ?);",
+                             [(db.series, name, value) for name, value in db._meta.items()
+                              if not name.endswith('_length')])
+        conn.commit()
+        conn.close()
+
+        try:
+            with rr.open_database(('SQLite', old_db)) as rrd:
+                self.assertEqual(['cpu', 'default'], rrd.series_names())
+                for name in ('minutes', 'hours'):
+                    self.assertEqual(self.rrd.query(name), rrd.query(name))
+                    self.assertEqual(cpu.query(name), rrd.select('cpu').query(name))
+                    self.assertEqual(self.rrd.get_head_count(name), rrd.get_head_count(name))
+                rrd.save(self.good_data[-1][0] + 60, 1.0)
+                self.assertEqual((self.good_data[-1][0] + 60, 1.0), rrd.minutes[-1])
+            conn = sqlite3.connect(old_db)
+            self.assertEqual(rr.db.SCHEMA_VERSION,
+                             conn.execute("PRAGMA user_version;").fetchone()[0])
+            tables = [row[0] for row in conn.execute(
+                    "SELECT name FROM sqlite_master WHERE type='table';")]
+            self.assertNotIn('Minutes', tables)
+            conn.close()
+        finally:
+            for path in (old_db, old_db + '-wal', old_db + '-shm'):
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+def stress_writer(backing, stop, results):
+    """Save one value a minute, with the timestamp as the value."""
+    saves = 0
+    with rr.open_database(backing) as rrd:
+        while not stop.is_set():
+            rrd.save((saves + 1) * 60, float((saves + 1) * 60))
+            saves += 1
+    results.put(('writer', saves))
+
+def stress_reader(backing, stop, results):
+    """Query the minutes, and check every query sees a whole save."""
+    queries, errors = 0, []
+    with rr.open_database(backing) as rrd:
+        while not stop.is_set():
+            rows = [row for row in rrd.minutes if row[0] is not None]
+            timestamps = [ts for ts, value in rows]
+            if timestamps != list(range(timestamps[0], timestamps[0] + 60 * len(rows), 60)):
+                errors.append(timestamps)
+            if any(ts != value for ts, value in rows):
+                errors.append(rows)
+            queries += 1
+    results.put(('reader', queries, errors[:3]))
+
+class SqliteConcurrencyTests(unittest.TestCase):
+    backing = ('SQLite', TEST_DB + '?timeout=10')
+    readers = 4
+    duration = 2.0
+
+    def tearDown(self):
+        remove_test_db()
+
+    def test_reads_dont_write(self):
+        with rr.open_database(self.backing) as rrd:
+            rrd.save_many([(min * 60, float(min)) for min in range(70)])
+            stats = rrd.enable_stats()
+            with rrd.read_transaction():
+                self.assertEqual((69 * 60, 69.0), rrd.minutes[-1])
+                self.assertEqual(69.0, rrd.summary('minutes').max)
+                # The read's snapshot wasn't ended by writing the cache
+                self.assertTrue(rrd.connection.in_transaction)
+                self.assertEqual((69 * 60, 69.0), rrd.minutes[-1])
+                self.assertEqual(0, stats.counters.get('commits', 0))
+            # The cache is written once the snapshot is released
+            self.assertEqual(1, stats.counters['commits'])
+            self.assertEqual(1, stats.counters['cache_hits'])
+        connection = sqlite3.connect(TEST_DB)
+        self.assertEqual(1, connection.execute("SELECT COUNT(*) FROM Cache;").fetchone()[0])
+        connection.close()
+
+    def test_cache_shared_between_processes(self):
+        with rr.open_database(self.backing) as rrd:
+            rrd.save_many([(min * 60, float(min)) for min in range(70)])
+            self.assertEqual((69 * 60, 69.0), rrd.minutes[-1])
+        script = ("import sys; sys.path.insert(0, %r); import round_robin as rr; "
+                  "rrd = rr.open_database(%r); stats = rrd.enable_stats(); "
+                  "rrd.minutes[-1]; print(stats.counters.get('cache_hits', 0))"
+                  % (os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                     self.backing))
+        output = subprocess.check_output([sys.executable, '-c', script])
+        self.assertEqual(b'1', output.strip())
+
+    def test_one_writer_many_readers(self):
+        rr.open_database(self.backing).save(0, 0.0)
+        stop, results = multiprocessing.Event(), multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=stress_writer,
+                                             args=(self.backing, stop, results))]
+        processes += [multiprocessing.Process(target=stress_reader,
+                                              args=(self.backing, stop, results))
+                      for reader in range(self.readers)]
+        for process in processes:
+            process.start()
+        time.sleep(self.duration)
+        stop.set()
+        outcomes = [results.get(timeout=30) for process in processes]
+        for process in processes:
+            process.join()
+
+        saves = [outcome[1] for outcome in outcomes if outcome[0] == 'writer'][0]
+        readers = [outcome for outcome in outcomes if outcome[0] == 'reader']
+        self.assertEqual(self.readers, len(readers))
+        # Readers never saw a half-written save or a half-rotated ring...
+        self.assertEqual([[]] * self.readers, [errors for _, _, errors in readers])
+        # ...and neither readers nor the writer were starved
+        self.assertGreater(saves, 10 * self.duration)
+        for _, queries, _ in readers:
+            self.assertGreater(queries, 10 * self.duration)
+        with rr.open_database(self.backing) as rrd:
+            self.assertEqual(saves * 60, rrd.last_timestamp)
+            self.assertEqual(min(saves + 1, 60), len([ts for ts, v in rrd.minutes if ts is not None]))
+
+class MemoryRoundRobinDbSaveTests(RoundRobinDbSaveTests):
+    backing = ('Memory', '')
+
+class MemoryRoundRobinDbQueryTests(RoundRobinDbUQueryTests):
+    backing = ('Memory', '')
+
+class MemoryRoundRobinDbSaveManyTests(RoundRobinDbSaveManyTests):
+    backing = ('Memory', '')
+
+class MemorySnapshotTests(unittest.TestCase):
+    good_data = [(min*60, min + 20.0) for min in range(0, 150)]
+
+    def tearDown(self):
+        remove_test_db()
+
+    def test_snapshot_and_load(self):
+        with rr.open_database(('Memory', TEST_DB)) as rrd:
+            rrd.save_many(self.good_data)
+            rrd.save(self.good_data[-1][0] + 120, 1.0)
+            minutes, hours = rrd.minutes, rrd.hours
+
+        rrd = rr.open_database(('Memory', TEST_DB))
+        self.assertEqual(self.good_data[-1][0] + 120, rrd.last_timestamp)
+        self.assertEqual(minutes, rrd.minutes)
+        self.assertEqual(hours, rrd.hours)
+        self.assertIsNone(rrd.minutes[-2][1])
+
+    def test_load_rejects_other_files(self):
+        with open(TEST_DB, 'wb') as f:
+            f.write(b'not a snapshot')
+        self.assertRaises(ValueError, rr.open_database, ('Memory', TEST_DB))
+
+class MmapRoundRobinDbSaveTests(RoundRobinDbSaveTests):
+    backing = ('MMap', TEST_DB)
+
+class MmapRoundRobinDbQueryTests(RoundRobinDbUQueryTests):
+    backing = ('MMap', TEST_DB)
+
+class MmapRoundRobinDbSaveManyTests(RoundRobinDbSaveManyTests):
+    backing = ('MMap', TEST_DB)
+
+class MmapFileTests(unittest.TestCase):
+    good_data = [(min*60, min + 20.0) for min in range(0, 150)]
+
+    def tearDown(self):
+        remove_test_db()
+
+    def test_reopen_and_concurrent_reader(self):
+        writer = rr.open_database(('MMap', TEST_DB + '?flush=save'))
+        reader = rr.open_database(('MMap', TEST_DB))
+        writer.save_many(self.good_data)
+
+        # The reader sees the writer's saves without reopening the file
+        self.assertEqual(writer.minutes, reader.minutes)
+        self.assertEqual(writer.hours, reader.hours)
+        writer.close()
+        reader.close()
+
+        with rr.open_database(('MMap', TEST_DB)) as rrd:
+            self.assertEqual(self.good_data[-1][0], rrd.last_timestamp)
+            self.assertEqual(self.good_data[-60:], rrd.minutes)
+
+    def test_rejects_other_files(self):
+        with open(TEST_DB, 'wb') as f:
+            f.write(b'not an rrd file')
+        self.assertRaises(ValueError, rr.open_database, ('MMap', TEST_DB))
+
+class SeriesTests(unittest.TestCase):
+    backing = ('SQLite', TEST_DB)
+    transactional = True
+    good_data = [(min*60, min + 20.0) for min in range(0, 90)]
+
+    def setUp(self):
+        self.rrd = rr.open_database(self.backing)
+
+    def tearDown(self):
+        self.rrd.close()
+        remove_test_db()
+
+    def test_series_are_independent(self):
+        cpu = self.rrd.select('cpu')
+        self.rrd.save_many(self.good_data)
+        cpu.save_many(self.good_data[:30])
+
+        self.assertEqual(rr.DEFAULT_SERIES, self.rrd.series)
+        self.assertEqual(self.good_data[-60:], self.rrd.minutes)
+        self.assertEqual(self.good_data[29][0], cpu.last_timestamp)
+        self.assertEqual(self.good_data[:30], cpu.minutes[-30:])
+        self.assertIsNone(self.rrd.select('mem').last_timestamp)
+        self.assertEqual([(None, None)] * 24, self.rrd.select('mem').hours)
+
+    def test_save_series(self):
+        self.rrd.save_series({'cpu': self.good_data[:10],
+                              'mem': self.good_data[:20]})
+        self.assertEqual(self.good_data[9][0], self.rrd.select('cpu').last_timestamp)
+        self.assertEqual(self.good_data[:20], self.rrd.select('mem').minutes[-20:])
+        self.assertIsNone(self.rrd.last_timestamp)
+
+    def test_save_series_is_atomic(self):
+        if not self.transactional:
+            self.skipTest("Backing does not support transactions")
+        self.rrd.save_series({'cpu': self.good_data[10:20]})
+        self.assertRaises(ValueError, self.rrd.save_series,
+                          {'mem': self.good_data[:10], 'cpu': self.good_data[:10]})
+        self.assertIsNone(self.rrd.select('mem').last_timestamp)
+
+        rrd = rr.open_database(self.backing)
+        self.assertIsNone(rrd.select('mem').last_timestamp)
+        self.assertEqual(self.good_data[19][0], rrd.select('cpu').last_timestamp)
+
+    def test_writes_in_one_transaction(self):
+        # Each save is worked out from the series as the saves before it in
+        # the transaction left it, from any object of the series
+        with self.rrd.transaction():
+            self.rrd.save(60, 1.0)
+            self.rrd.save(120, 2.0)
+            self.rrd.save_many(self.good_data[3:5])
+            self.rrd.select('cpu').save(60, 1.0)
+            self.rrd.select('cpu').save(120, 2.0)
+            self.assertEqual(self.good_data[4], self.rrd.minutes[-1])
+        self.assertEqual([(60, 1.0), (120, 2.0)] + self.good_data[3:5], self.rrd.minutes[-4:])
+        self.assertEqual([(60, 1.0), (120, 2.0)], self.rrd.select('cpu').minutes[-2:])
+
+        with self.rrd.buffered():
+            self.rrd.save(300, 5.0)
+            self.rrd.save_series({rr.DEFAULT_SERIES: [(360, 6.0)]})
+        self.assertEqual([(300, 5.0), (360, 6.0)], self.rrd.minutes[-2:])
+        if not self.transactional:
+            return
+
+        rrd = rr.open_database(self.backing)
+        self.assertEqual([(300, 5.0), (360, 6.0)], rrd.minutes[-2:])
+        self.assertEqual(2.0, rrd.select('cpu').summary('minutes').max)
+        rrd.close()
+        try:
+            with self.rrd.transaction():
+                self.rrd.save(420, 7.0)
+                self.rrd.save(480, 8.0)
+                raise KeyError
+        except KeyError:
+            pass
+        self.assertEqual(360, self.rrd.last_timestamp)
+        self.assertEqual((360, 6.0), self.rrd.minutes[-1])
+
+class MemorySeriesTests(SeriesTests):
+    backing = ('Memory', TEST_DB)
+    transactional = False
+
+    def test_snapshot_series(self):
+        self.rrd.save_series({'cpu': self.good_data[:10],
+                              'default': self.good_data})
+        self.rrd.close()
+        rrd = rr.open_database(self.backing)
+        self.assertEqual(self.good_data[9][0], rrd.select('cpu').last_timestamp)
+        self.assertEqual(self.good_data[-60:], rrd.minutes)
+
+class ArchiveParsingTests(unittest.TestCase):
+    def test_parse_archives(self):
+        archives = rr.parse_archives('1m:1440, 5m:12, peak=1h:720:max, 1d:365:avg')
+        self.assertEqual(['minutes', '5m', 'peak', 'days'],
+                         [archive.name for archive in archives])
+        self.assertEqual([60, 300, 3600, 86400], [archive.step for archive in archives])
+        self.assertEqual(['min', 'min', 'max', 'average'],
+                         [archive.cf for archive in archives])
+        self.assertEqual(archives, rr.parse_archives(rr.format_archives(archives)))
+
+    def test_invalid_archives(self):
+        for spec in ['', '1m', '1x:10', '1m:10:median', '1h:10, 1m:10',
+                     '2m:10, 3m:10', '1m:10, 1m:20', '1m:0']:
+            self.assertRaises(ValueError, rr.parse_archives, spec)
+
+# A local midnight
+MIDNIGHT = rr.timestamp_bucket(1483967100, 86400)
+
+class ArchivesTests(unittest.TestCase):
+    backing = ('SQLite', TEST_DB)
+    archives = rr.parse_archives('1m:10:last, 10m:6:max, 1h:5:avg, 1d:3:count')
+    start = MIDNIGHT
+    # Three days of minutes
+    good_data = [(MIDNIGHT + min*60, float(min % 7)) for min in range(0, 3*24*60)]
+
+    def setUp(self):
+        self.rrd = rr.open_database(self.backing, self.archives)
+
+    def tearDown(self):
+        self.rrd.close()
+        remove_test_db()
+
+    def test_consolidation(self):
+        self.rrd.save_many(self.good_data[:100])
+        for ts, value in self.good_data[100:]:
+            self.rrd.save(ts, value)
+
+        self.assertEqual(self.good_data[-10:], self.rrd.query('minutes'))
+        tens = [(self.start + m*600, 6.0) for m in range(3*24*6 - 6, 3*24*6)]
+        self.assertEqual(tens, self.rrd.query('10m'))
+        for ts, value in self.rrd.query('hours'):
+            hour = [v for t, v in self.good_data if ts <= t < ts + 3600]
+            self.assertAlmostEqual(sum(hour) / 60, value)
+        days = [(self.start + d*86400, 1440.0) for d in range(0, 3)]
+        self.assertEqual(days, self.rrd.query('days'))
+
+    def test_average_and_reopen(self):
+        self.rrd.save_many(self.good_data[:30])
+        self.rrd.close()
+        self.rrd = rr.open_database(self.backing)
+        self.assertEqual(self.archives, self.rrd.archives)
+        self.rrd.save_many(self.good_data[30:60])
+
+        average = sum(value for ts, value in self.good_data[:60]) / 60
+        self.assertAlmostEqual(average, self.rrd.query('hours')[-1][1])
+        self.assertEqual((self.start, 60.0), self.rrd.query('days')[-1])
+
+    def test_resample(self):
+        self.rrd.save_many(self.good_data[:100])
+        # The last ten minutes are 90-99, with values 6, 0, 1, .. 6, 0, 1
+        fives = [(self.start + 90*60, 6.0), (self.start + 95*60, 6.0)]
+        self.assertEqual(fives, self.rrd.resample('minutes', 300, 'max'))
+        self.assertEqual([(self.start + 95*60, 5.0)], self.rrd.resample('minutes', 300, 'count',
+                                                                        start=self.start + 95*60))
+        self.assertEqual([(self.start + 95*60, 7 / 3.0)],
+                         self.rrd.resample('minutes', 300, 'avg', limit=3))
+        self.assertEqual([(self.start + 90*60, 3.0)], self.rrd.resample('minutes', 600, 'last',
+                                                                        end=self.start + 94*60))
+        self.assertRaises(ValueError, self.rrd.resample, 'minutes', 90)
+        self.assertRaises(ValueError, self.rrd.resample, 'minutes', 300, 'median')
+
+    def test_summary(self):
+        def scanned_summary(table):
+            values = [v for ts, v in self.rrd.query(table) if v is not None]
+            if not values:
+                return rr.EMPTY_SUMMARY
+            return (len(values), sum(values), min(values), max(values),
+                    sum(values) / len(values))
+
+        self.assertEqual(rr.EMPTY_SUMMARY, self.rrd.summary('hours'))
+        # Summaries kept up to date across gaps, consolidation and eviction
+        points = self.good_data[:200] + self.good_data[230:300:3] + self.good_data[2000:]
+        for ix in range(0, len(points), 97):
+            batch = points[ix:ix + 97]
+            self.rrd.save_many(batch)
+            # Consolidated into the entry already in the database
+            self.rrd.save(batch[-1][0], 0.5)
+            for archive in self.archives:
+                expected = scanned_summary(archive.name)
+                summary = self.rrd.summary(archive.name)
+                self.assertEqual(expected[0], summary.count)
+                for value, expected_value in zip(summary[1:], expected[1:]):
+                    self.assertAlmostEqual(expected_value, value)
+
+    def test_range_query(self):
+        # Wraps around the end of each ring
+        points = self.good_data[:1000] + self.good_data[1120:1500]
+        self.rrd.save_many(points)
+        for table in ('minutes', '10m', 'hours'):
+            rows = [row for row in self.rrd.query(table) if row[0] is not None]
+            last, step = rows[-1][0], self.rrd.archive(table).step
+            self.assertEqual(rows, self.rrd.query(table, start=0))
+            self.assertEqual(rows[-3:], self.rrd.query(table, limit=3))
+            self.assertEqual([row for row in rows if last - 3*step <= row[0] <= last - step],
+                             self.rrd.query(table, start=last - 3*step, end=last - step))
+            self.assertEqual([], self.rrd.query(table, start=last + 1))
+            self.assertEqual([], self.rrd.query(table, end=rows[0][0] - 1))
+        self.assertEqual(self.rrd.query('hours'), self.rrd.query('hours', limit=5))
+
+        # Streamed a few entries at a time
+        for table in ('minutes', '10m', 'hours', 'days'):
+            rows = [row for row in self.rrd.query(table) if row[0] is not None]
+            self.assertEqual(rows, list(self.rrd.iter_query(table, chunk_size=3)))
+            self.assertEqual(rows[-4:-1], list(self.rrd.iter_query(
+                    table, end=rows[-2][0], limit=3, chunk_size=2)))
+
+    def test_buffered_saves(self):
+        # A value every ten seconds
+        points = [(self.start + s*10, float(s % 13)) for s in range(0, 6*200)]
+        expected = rr.open_database(('Memory', ''), self.archives)
+        expected.save_many(points)
+        stats = self.rrd.enable_stats()
+        with self.rrd.buffered():
+            for ts, value in points:
+                self.rrd.save(ts, value)
+            self.assertRaises(ValueError, self.rrd.save, self.start, 1.0)
+            # The last minute is still held
+            self.assertEqual(points[-7][0] - 50, self.rrd.query('minutes', limit=1)[0][0])
+        # Written once a minute
+        self.assertEqual(200, stats.counters['buffer_flushes'])
+        for archive in self.archives:
+            self.assertEqual(expected.query(archive.name), self.rrd.query(archive.name))
+
+        # Also written when too many values are held, and before other saves
+        minute = self.start + 200*60
+        with self.rrd.buffered(max_points=4):
+            for ts in range(minute, minute + 60, 10):
+                self.rrd.save(ts, 100.0)
+            self.assertEqual(201, stats.counters['buffer_flushes'])
+            self.rrd.save_many([(minute + 60, 1.0)])
+            self.assertEqual(202, stats.counters['buffer_flushes'])
+        self.assertEqual(202, stats.counters['buffer_flushes'])
+        self.assertEqual([(minute, 100.0), (minute + 60, 1.0)],
+                         self.rrd.query('minutes', limit=2))
+
+    def test_buffered_idle(self):
+        # Nothing is written in the background when saves stop
+        with self.rrd.buffered(max_delay=0.01):
+            self.rrd.save(self.start, 1.0)
+            time.sleep(0.05)
+            self.assertEqual([], self.rrd.query('minutes', limit=1))
+            self.rrd.flush_buffer()
+            self.assertEqual([(self.start, 1.0)], self.rrd.query('minutes', limit=1))
+            self.rrd.save(self.start + 60, 2.0)
+            time.sleep(0.05)
+            self.assertEqual([(self.start, 1.0)], self.rrd.query('minutes', limit=1))
+            # The next save writes the values held for longer than max_delay
+            self.rrd.save(self.start + 70, 3.0)
+            self.assertEqual(self.start + 60, self.rrd.query('minutes', limit=1)[0][0])
+            self.rrd.save(self.start + 120, 4.0)
+        # And the end of the context writes the rest
+        self.assertEqual([(self.start + 120, 4.0)], self.rrd.query('minutes', limit=1))
+
+    def test_mismatched_archives(self):
+        self.rrd.close()
+        self.assertRaises(ValueError, rr.open_database, self.backing,
+                          rr.DEFAULT_ARCHIVES)
+        self.rrd = rr.open_database(self.backing)
+        self.assertRaises(ValueError, self.rrd.query, 'weeks')
+
+class MemoryArchivesTests(ArchivesTests):
+    backing = ('Memory', TEST_DB)
+
+class MmapArchivesTests(ArchivesTests):
+    backing = ('MMap', TEST_DB)
+
+    def test_summary_of_shared_file(self):
+        self.rrd.save_many(self.good_data[:100])
+        self.assertEqual(6.0, self.rrd.summary('10m').max)
+        with rr.open_database(self.backing) as writer:
+            writer.save(self.good_data[100][0], 100.0)
+        self.assertEqual(100.0, self.rrd.summary('10m').max)
+
+class ReadCacheTests(unittest.TestCase):
+    backing = ('SQLite', TEST_DB)
+    good_data = [(min*60, min + 20.0) for min in range(0, 90)]
+
+    def setUp(self):
+        self.rrd = rr.open_database(self.backing)
+
+    def tearDown(self):
+        self.rrd.close()
+        remove_test_db()
+
+    def test_cached_until_saved(self):
+        self.rrd.save_many(self.good_data[:70])
+        minutes = self.rrd.minutes
+        generation = self.rrd.generation
+
+        def read_all(table):
+            raise AssertionError("read_all() called for a cached query")
+        self.rrd.read_all = read_all
+        self.assertEqual(minutes, self.rrd.minutes)
+        self.assertEqual(generation, self.rrd.generation)
+        del self.rrd.read_all
+
+        self.rrd.save_many(self.good_data[70:])
+        self.assertNotEqual(generation, self.rrd.generation)
+        self.assertEqual(self.good_data[-60:], self.rrd.minutes)
+
+    def test_other_writers_invalidate(self):
+        self.rrd.save_many(self.good_data[:70])
+        self.assertEqual(self.good_data[10:70], self.rrd.minutes)
+        other = self.rrd.select(self.rrd.series) if self.backing[0] == 'Memory' \
+                else rr.open_database(self.backing)
+        other.save_many(self.good_data[70:])
+        other.close()
+        self.assertEqual(self.good_data[-60:], self.rrd.minutes)
+        self.assertEqual(self.good_data[-1][1], self.rrd.summary('minutes').max)
+
+    def test_other_writers_seen_by_range_queries(self):
+        self.rrd.save_many(self.good_data[:70])
+        self.assertEqual(self.good_data[68:70], self.rrd.query('minutes', limit=2))
+        other = self.rrd.select(self.rrd.series) if self.backing[0] == 'Memory' \
+                else rr.open_database(self.backing)
+        other.save_many(self.good_data[70:])
+        self.assertEqual(self.good_data[-2:], other.query('minutes', limit=2))
+        other.close()
+        self.assertEqual(self.good_data[-2:], self.rrd.query('minutes', limit=2))
+
+class MemoryReadCacheTests(ReadCacheTests):
+    backing = ('Memory', '')
+
+class MmapReadCacheTests(ReadCacheTests):
+    backing = ('MMap', TEST_DB)
+
+class RedisBacking(object):
+    """Runs a test case against a fakeredis server of its own."""
+    def setUp(self):
+        if fakeredis is None:
+            self.skipTest("fakeredis is not installed")
+        self.redis_server = fakeredis.FakeServer()
+        super(RedisBacking, self).setUp()
+
+    @property
+    def backing(self):
+        return ('Redis', fakeredis.FakeStrictRedis(server=self.redis_server))
+
+class RedisRoundRobinDbSaveTests(RedisBacking, RoundRobinDbSaveTests):
+    pass
+
+class RedisRoundRobinDbQueryTests(RedisBacking, RoundRobinDbUQueryTests):
+    pass
+
+class RedisRoundRobinDbSaveManyTests(RedisBacking, RoundRobinDbSaveManyTests):
+    pass
+
+class RedisSeriesTests(RedisBacking, SeriesTests):
+    pass
+
+class RedisArchivesTests(RedisBacking, ArchivesTests):
+    pass
+
+class RedisReadCacheTests(RedisBacking, ReadCacheTests):
+    pass
+
+class RedisLayoutTests(RedisBacking, unittest.TestCase):
+    def test_single_round_trip_reads(self):
+        rrd = rr.open_database(self.backing)
+        rrd.save_many([(min*60, min + 20.0) for min in range(0, 90) if min != 80])
+        client = rrd.db
+        # One hash of packed (timestamp, value) records per archive
+        self.assertEqual(60, client.hlen('archive:minutes'))
+        entries = sorted(map(rr.redisdb.unpack_entry, client.hvals('archive:minutes')))
+        self.assertEqual((1800, 50.0), entries[0])
+        self.assertEqual((4800, None), entries[50])
+
+        # Reading a series, and then saving to it, cost a round trip each
+        round_trips = []
+        execute_command, pipeline = client.execute_command, client.pipeline
+        def counting_command(*args, **kwargs):
+            round_trips.append(args[0])
+            return execute_command(*args, **kwargs)
+        def counting_pipeline(*args, **kwargs):
+            pipe = pipeline(*args, **kwargs)
+            execute = pipe.execute
+            def counting_execute(*args, **kwargs):
+                round_trips.append('EXEC')
+                return execute(*args, **kwargs)
+            pipe.execute = counting_execute
+            return pipe
+        client.execute_command = counting_command
+        client.pipeline = counting_pipeline
+
+        rrd = rr.open_database(('Redis', client))
+        del round_trips[:]
+        rrd.read_all('minutes'), rrd.read_all('hours')
+        rrd.last_timestamp, rrd.get_head_count('hours')
+        self.assertEqual(['EXEC'], round_trips)
+        del round_trips[:]
+        rrd.save_many([(5400, 1.0), (5460, 2.0)])
+        rrd.save(5520, 3.0)
+        self.assertEqual(['EVALSHA', 'EVALSHA'], round_trips)
+
+        # A range of a series that isn't loaded is read on its own
+        rrd = rr.open_database(('Redis', client))
+        del round_trips[:]
+        self.assertEqual([(5460, 2.0), (5520, 3.0)], rrd.query('minutes', limit=2))
+        self.assertEqual(['GET', 'MGET', 'HMGET'], round_trips)
+        self.assertIsNone(rrd._state)
+
+    def test_concurrent_saves(self):
+        data = [(min*60, min + 20.0) for min in range(0, 90)]
+        first, second = rr.open_database(self.backing), rr.open_database(self.backing)
+        first.save_many(data[:30])
+        self.assertEqual(data[29][0], second.last_timestamp)
+        first.save_many(data[30:60])
+        # The second client's copy of the series is out of date, so its save
+        # is worked out again
+        second.save_many(data[60:])
+        self.assertEqual(data[-60:], first.minutes)
+        self.assertEqual(data[-60:], second.minutes)
+        # And so is an update
+        first.update_timestamp('minutes', data[-1][0], 1.0)
+        second.update_timestamp('minutes', data[-1][0], 2.0)
+        self.assertEqual((data[-1][0], 2.0), first.minutes[-1])
+
+        # A transaction can't be worked out again, so it fails as a whole
+        def interleaved():
+            with first.transaction():
+                first.select('cpu').save_many(data[:10])
+                first.save(5400, 1.0)
+                second.save(5400, 2.0)
+        self.assertRaises(rr.redisdb.WriteConflict, interleaved)
+        self.assertEqual((5400, 2.0), first.minutes[-1])
+        self.assertIsNone(first.select('cpu').last_timestamp)
+
+    def test_stats(self):
+        rrd = rr.open_database(self.backing)
+        stats = rrd.enable_stats()
+        rrd.save_many([(min*60, min + 20.0) for min in range(0, 90)])
+        round_trips = stats.counters['redis_round_trips']
+        # Once the series' state has been read, and the script loaded, a
+        # save is a single script call
+        rrd.save(5400, 1.0)
+        self.assertEqual(round_trips + 1, stats.counters['redis_round_trips'])
+        self.assertEqual(1, stats.counters['state_loads'])
+
+    def test_convert_legacy_keys(self):
+        client = self.backing[1]
+        client.set('initialized', 'True')
+        client.set('last_timestamp', 120)
+        client.set('min0', '(60, 1.0)')
+        client.set('min1', '(120, None)')
+        client.set('hour0', '(0, 1.0)')
+        client.set('series:cpu:min5', '(60, 2.5)')
+        client.set('series:cpu:last_timestamp', 60)
+
+        rrd = rr.open_database(('Redis', client))
+        self.assertEqual([(60, 1.0), (120, None)], rrd.minutes[-2:])
+        self.assertEqual((0, 1.0), rrd.hours[-1])
+        self.assertEqual((60, 2.5), rrd.select('cpu').minutes[-1])
+        self.assertEqual(None, client.get('min0'))
+        self.assertEqual(None, client.get('series:cpu:min5'))
+
+class SnapshotTests(unittest.TestCase):
+    archives = ArchivesTests.archives
+    good_data = ArchivesTests.good_data
+
+    def tearDown(self):
+        remove_test_db()
+        if os.path.exists(TEST_DB + '.mmap'):
+            os.remove(TEST_DB + '.mmap')
+
+    def assertSameSeries(self, expected, actual):
+        self.assertEqual(expected.last_timestamp, actual.last_timestamp)
+        for archive in self.archives:
+            self.assertEqual(expected.query(archive.name), actual.query(archive.name))
+            self.assertEqual(expected.summary(archive.name), actual.summary(archive.name))
+            self.assertEqual(expected.get_head_count(archive.name),
+                             actual.get_head_count(archive.name))
+
+    def test_round_trip_between_backends(self):
+        source = rr.open_database(('Memory', ''), self.archives)
+        source.save_many(self.good_data[:2000])
+        source.save(self.good_data[2000][0] + 30, 1.0)
+        source.select('cpu').save_many(self.good_data[:5] + self.good_data[8:12])
+
+        backings = [('SQLite', TEST_DB)]
+        if fakeredis is not None:
+            backings.append(('Redis', fakeredis.FakeStrictRedis(server=fakeredis.FakeServer())))
+        for backing in backings:
+            snapshot = io.BytesIO()
+            rr.snapshot.export_snapshot(source, snapshot)
+            snapshot.seek(0)
+            rrd = rr.snapshot.import_snapshot(snapshot, backing)
+            self.assertEqual(self.archives, rrd.archives)
+            self.assertEqual(['cpu', 'default'], rrd.series_names())
+            self.assertSameSeries(source, rrd)
+            self.assertSameSeries(source.select('cpu'), rrd.select('cpu'))
+            # Writes carry on from the imported entries
+            rrd.save(self.good_data[2001][0], 2.0)
+            self.assertEqual((self.good_data[2001][0], 2.0), rrd.query('minutes')[-1])
+            source = rrd
+
+        # The MMap engine only holds the default series
+        snapshot = io.BytesIO()
+        rr.snapshot.export_snapshot(source, snapshot, ['default'])
+        snapshot.seek(0)
+        with rr.snapshot.import_snapshot(snapshot, ('MMap', TEST_DB + '.mmap')) as rrd:
+            self.assertSameSeries(source, rrd)
+        source.close()
+
+    def test_import_into_existing_series(self):
+        source = rr.open_database(('Memory', ''), self.archives)
+        source.save_many(self.good_data[:100])
+        snapshot = io.BytesIO()
+        rr.snapshot.export_snapshot(source, snapshot)
+
+        with rr.open_database(('SQLite', TEST_DB), self.archives) as rrd:
+            rrd.save_many(self.good_data[:10])
+        snapshot.seek(0)
+        self.assertRaises(ValueError, rr.snapshot.import_snapshot, snapshot, ('SQLite', TEST_DB))
+        # Or from an empty or truncated stream
+        self.assertRaises(ValueError, rr.snapshot.import_snapshot, io.BytesIO(b''),
+                          ('Memory', ''))
+        self.assertRaises(ValueError, rr.snapshot.import_snapshot,
+                          io.BytesIO(snapshot.getvalue()[:-20]), ('Memory', ''))
+
+    def test_failed_import_changes_nothing(self):
+        source = rr.open_database(('Memory', ''), self.archives)
+        source.select('cpu').save_many(self.good_data[:100])
+        source.save_many(self.good_data[:100])
+        snapshot = io.BytesIO()
+        rr.snapshot.export_snapshot(source, snapshot)
+        self.assertEqual(['cpu', 'default'], source.series_names())
+
+        # The last series is truncated, or already holds values
+        self.assertRaises(ValueError, rr.snapshot.import_snapshot,
+                          io.BytesIO(snapshot.getvalue()[:-20]), ('SQLite', TEST_DB))
+        with rr.open_database(('SQLite', TEST_DB)) as rrd:
+            self.assertEqual([], rrd.series_names())
+            rrd.save(self.good_data[0][0], 1.0)
+        self.assertRaises(ValueError, rr.snapshot.import_snapshot,
+                          io.BytesIO(snapshot.getvalue()), ('SQLite', TEST_DB))
+        with rr.open_database(('SQLite', TEST_DB)) as rrd:
+            self.assertEqual(['default'], rrd.series_names())
+            self.assertIsNone(rrd.select('cpu').last_timestamp)
+
+class FleetTests(unittest.TestCase):
+    paths = ['fleet-a.db', 'fleet-b.db', 'fleet-c.db']
+
+    def setUp(self):
+        for ix, path in enumerate(self.paths):
+            with rr.open_database(('SQLite', path)) as rrd:
+                rrd.save_many([(min*60, min + ix * 10.0) for min in range(0, 90)])
+
+    def tearDown(self):
+        for path in self.paths + ['fleet-d.db', 'fleet-e.db']:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+    def test_query_many(self):
+        self.assertEqual(self.paths, round_robin.fleet.expand_paths('fleet-*.db'))
+        with open('fleet-d.db', 'wb') as f:
+            f.write(b'not an rrd file')
+        results = round_robin.fleet.query_many(self.paths + ['fleet-d.db'], 'minutes',
+                                               limit=2, processes=2)
+        self.assertEqual([(self.paths[1], [(5280, 98.0), (5340, 99.0)], None)], results[1:2])
+        self.assertEqual('fleet-d.db', results[3][0])
+        self.assertIsNone(results[3][1])
+        self.assertTrue(results[3][2])
+
+        combined = round_robin.fleet.aggregate(results)
+        self.assertEqual([5280, 5340], [ts for ts, summary in combined])
+        self.assertEqual(rr.Summary(3, 294.0, 88.0, 108.0, 98.0), combined[0][1])
+
+        out = io.BytesIO()
+        writer = round_robin.output.OutputWriter(out, 'csv')
+        round_robin.fleet.write_results(writer, 'minutes', results, combined=True)
+        writer.flush()
+        self.assertEqual(b"timestamp,count,min,avg,max\n5280,3,88.0,98.0,108.0\n"
+                         b"5340,3,89.0,99.0,109.0\n", out.getvalue())
+
+    def test_files_opened_read_only(self):
+        # An empty file, and a database of an older schema version
+        open('fleet-d.db', 'wb').close()
+        connection = sqlite3.connect(self.paths[2])
+        connection.execute("PRAGMA user_version=1;")
+        connection.close()
+        before = [os.stat(path).st_mtime_ns for path in self.paths + ['fleet-d.db']]
+        with open(self.paths[2], 'rb') as f:
+            old = f.read()
+
+        results = round_robin.fleet.query_many(self.paths + ['fleet-d.db'], 'minutes',
+                                               limit=1, processes=1)
+        self.assertEqual([(5340, 99.0)], results[1][1])
+        self.assertIn('schema version 1', results[2][2])
+        self.assertEqual('Not a round robin database', results[3][2])
+        # Nothing was written to the files, or created
+        self.assertEqual(before, [os.stat(path).st_mtime_ns
+                                  for path in self.paths + ['fleet-d.db']])
+        self.assertEqual(0, os.path.getsize('fleet-d.db'))
+        with open(self.paths[2], 'rb') as f:
+            self.assertEqual(old, f.read())
+        self.assertFalse(os.path.exists('fleet-e.db'))
+        self.assertIsNotNone(round_robin.fleet.query_many(['fleet-e.db'], 'minutes')[0][2])
+        self.assertFalse(os.path.exists('fleet-e.db'))
+
+class StatsTests(unittest.TestCase):
+    backing = ('SQLite', TEST_DB)
+    good_data = [(min*60, min + 20.0) for min in range(0, 90)]
+
+    def setUp(self):
+        self.rrd = rr.open_database(self.backing)
+
+    def tearDown(self):
+        self.rrd.close()
+        remove_test_db()
+
+    def test_disabled(self):
+        self.rrd.save_many(self.good_data)
+        self.rrd.minutes
+        self.assertIsNone(self.rrd.stats)
+        self.assertNotIn('save_many', self.rrd.__dict__)
+        self.assertIsNone(self.rrd.select('cpu').stats)
+
+    def test_operations_and_counters(self):
+        import io
+        trace = io.StringIO()
+        stats = self.rrd.enable_stats(trace=trace)
+        self.rrd.save_many(self.good_data[:60])
+        self.rrd.save(self.good_data[60][0], 1.0)
+        cpu = self.rrd.select('cpu')
+        self.assertIs(stats, cpu.stats)
+        cpu.save_many(self.good_data)
+        self.rrd.minutes, self.rrd.minutes, self.rrd.summary('hours')
+        self.rrd.update_timestamp('minutes', self.good_data[60][0], 2.0)
+
+        histograms = stats.as_dict()['operations']
+        self.assertEqual(3, histograms['save']['count'])
+        self.assertEqual(1, histograms['update']['count'])
+        self.assertEqual(2, histograms['query']['count'])
+        # The summary reads the table in chunks rather than all at once
+        self.assertEqual(1, histograms['read_all']['count'])
+        self.assertEqual(histograms['save']['count'], sum(histograms['save']['buckets'].values()))
+        self.assertEqual(1, stats.counters['cache_hits'])
+        self.assertEqual(1, stats.counters['cache_misses'])
+        self.assertGreater(stats.counters['sql_statements'], stats.counters['commits'])
+        # Four saves, and the query result written to the Cache table
+        self.assertEqual(5, stats.counters['commits'])
+
+        trace = trace.getvalue().splitlines()
+        self.assertEqual(sum(h['count'] for h in histograms.values()), len(trace))
+        self.assertEqual(['save', 'cpu'], trace[trace.index(
+                [line for line in trace if ' cpu ' in line][0])].split()[1:3])
+
+        prometheus = stats.format_prometheus().splitlines()
+        self.assertIn('rrd_operation_seconds_bucket{operation="save",le="+Inf"} 3', prometheus)
+        self.assertIn('rrd_operation_seconds_count{operation="update"} 1', prometheus)
+        self.assertIn('# TYPE rrd_commits_total counter', prometheus)
+        self.assertIn('rrd_commits_total 5', prometheus)
+        self.assertIn('save', stats.format_text())
+
+class ServerTests(unittest.TestCase):
+    good_data = [(min*60, min + 20.0) for min in range(0, 90)]
+    socket_path = 'test.sock'
+
+    def setUp(self):
+        if sys.version_info < (3, 7):
+            self.skipTest("rrd serve needs Python 3.7")
+        import asyncio
+        import threading
+        from round_robin.server import RrdServer
+        # The server's thread uses the database, so it can't be SQLite
+        self.rrd = rr.open_database(('Memory', ''))
+        self.rrd.save_many(self.good_data)
+        self.server = RrdServer(self.rrd)
+
+        # Run the server's event loop in the background
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.start()
+        self.servers = asyncio.run_coroutine_threadsafe(
+                self.server.start(self.socket_path), self.loop).result()
+
+    def tearDown(self):
+        import asyncio
+        async def shutdown():
+            # Stop listening, and wait for the connections' handlers to finish
+            for server in self.servers:
+                server.close()
+            handlers = [task for task in asyncio.all_tasks()
+                        if task is not asyncio.current_task()]
+            for handler in handlers:
+                handler.cancel()
+            await asyncio.gather(*handlers, return_exceptions=True)
+        asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.rrd.close()
+        remove_test_db()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    def test_query_and_save(self):
+        from round_robin.client import RrdClient
+        client = RrdClient(self.socket_path)
+        try:
+            self.assertEqual(rr.output.render(self.rrd, 'minutes'),
+                             client.query('minutes', rr.DEFAULT_SERIES))
+            self.assertEqual("minutes: min: 50.0, avg: 79.50, max: 109.0\n",
+                             client.query('minutes', rr.DEFAULT_SERIES, summary_only=True))
+            self.assertEqual(2, client.save(["5400 5", "cpu 60 1.5"], rr.DEFAULT_SERIES))
+            self.assertEqual(5.0, self.rrd.summary('minutes').min)
+            self.assertEqual(1, self.rrd.select('cpu').summary('minutes').count)
+
+            self.assertRaises(ValueError, client.query, 'weeks', rr.DEFAULT_SERIES)
+            self.assertRaises(ValueError, client.save, ["60 1"], rr.DEFAULT_SERIES)
+            self.assertRaises(ValueError, client.save, ["abc"], rr.DEFAULT_SERIES)
+        finally:
+            client.close()
+
+    def test_stats(self):
+        from round_robin.client import RrdClient
+        client = RrdClient(self.socket_path)
+        try:
+            client.query('minutes', rr.DEFAULT_SERIES)
+            client.save(["5400 1.0"], 'cpu')
+            self.assertIn('request_query', client.stats())
+            stats = json.loads(client.stats('json'))
+            self.assertEqual(1, stats['operations']['request_save']['count'])
+            self.assertEqual(1, stats['operations']['save']['count'])
+            self.assertRaises(ValueError, client.stats, 'xml')
+        finally:
+            client.close()
+        status, content_type, body = self.server.handle('GET', '/metrics', b'')
+        self.assertEqual(200, status)
+        self.assertTrue(content_type.startswith('text/plain; version=0.0.4'))
+        self.assertIn('rrd_operation_seconds_count{operation="request_stats"} 3', body)
+
+    def test_formats(self):
+        status, content_type, body = self.server.handle(
+                'GET', '/query?archive=hours&format=json', b'')
+        self.assertEqual(200, status)
+        result = json.loads(body)
+        self.assertEqual([[0, 20.0], [3600, 80.0]], result['rows'])
+        self.assertEqual(20.0, result['summary']['min'])
+
+        status, content_type, body = self.server.handle(
+                'GET', '/query?archive=hours&format=csv', b'')
+        self.assertEqual("timestamp,value\n0,20.0\n3600,80.0\n", body)
+        status, content_type, body = self.server.handle(
+                'GET', '/query?archive=minutes&format=csv&since=5280&last=5', b'')
+        self.assertEqual("timestamp,value\n5280,108.0\n5340,109.0\n", body)
+        status, content_type, body = self.server.handle(
+                'GET', '/query?archive=minutes&format=csv&step=1800&cf=max', b'')
+        self.assertEqual("timestamp,value\n1800,79.0\n3600,109.0\n", body)
+        self.assertEqual(400, self.server.handle('GET', '/query?archive=minutes&last=x', b'')[0])
+        self.assertEqual(400, self.server.handle('GET', '/query?archive=minutes&step=90', b'')[0])
+        self.assertEqual(404, self.server.handle('GET', '/nope', b'')[0])
+        self.assertEqual(405, self.server.handle('GET', '/save', b'')[0])
+
+    def test_cli_checks_database(self):
+        import rrd
+        tool = rrd.Rrdtool()
+        tool.socket_path = self.socket_path
+        os.environ['RRD_DATABASE'] = 'Memory:/' + TEST_DB
+        try:
+            # A server that doesn't say which database it serves isn't asked
+            self.assertIsNone(tool._query_server('minutes', rr.DEFAULT_SERIES, False, 'text'))
+            self.server.database = tool.database
+            self.assertEqual(rr.output.render(self.rrd, 'minutes'),
+                             tool._query_server('minutes', rr.DEFAULT_SERIES, False, 'text'))
+            os.environ['RRD_DATABASE'] = 'Memory:/other.db'
+            self.assertIsNone(tool._query_server('minutes', rr.DEFAULT_SERIES, False, 'text'))
+        finally:
+            del os.environ['RRD_DATABASE']
+
+        status, content_type, body = self.server.handle('GET', '/info', b'')
+        self.assertEqual({'database': ':/'.join(['memory', os.path.abspath(TEST_DB)]),
+                          'series': rr.DEFAULT_SERIES,
+                          'archives': rr.format_archives(self.rrd.archives)},
+                         json.loads(body))
+
+    def test_client_without_server(self):
+        from round_robin.client import RrdClient, ServerUnavailable
+        client = RrdClient('no-such.sock')
+        self.assertRaises(ServerUnavailable, client.query, 'minutes', rr.DEFAULT_SERIES)
+
+class AsyncTests(unittest.TestCase):
+    backing = ('SQLite', TEST_DB)
+    good_data = [(min*60, min + 20.0) for min in range(0, 90)]
+
+    def setUp(self):
+        if sys.version_info < (3, 7):
+            self.skipTest("AsyncRoundRobinDb needs Python 3.7")
+
+    def tearDown(self):
+        remove_test_db()
+
+    def run_async(self, coroutine):
+        import asyncio
+        return asyncio.run(coroutine)
+
+    def test_saves_and_reads(self):
+        from round_robin.asyncdb import AsyncRoundRobinDb
+        async def run():
+            import asyncio
+            async with AsyncRoundRobinDb(self.backing) as rrd:
+                # Saves are made in the order they were called
+                await asyncio.gather(*[rrd.save(ts, value) for ts, value in self.good_data[:80]])
+                await rrd.save_many(self.good_data[80:])
+                await rrd.select('cpu').save_series({'cpu': [(60, 1.0)], 'disk': [(60, 2.0)]})
+
+                queries = await asyncio.gather(*[rrd.query('minutes') for ix in range(50)])
+                self.assertEqual([self.good_data[-60:]] * 50, queries)
+                self.assertEqual(self.good_data[-2:], await rrd.query('minutes', limit=2))
+                self.assertEqual(self.good_data[-1][0], await rrd.last_timestamp())
+                self.assertEqual(2.0, (await rrd.select('disk').summary('minutes')).max)
+
+                # A read called after a save sees it
+                saved, rows = await asyncio.gather(rrd.save(5400, 1.0),
+                                                   rrd.query('minutes', limit=1))
+                self.assertEqual([(5400, 1.0)], rows)
+                with self.assertRaises(ValueError):
+                    await rrd.save(60, 1.0)
+            with self.assertRaises(ValueError):
+                await rrd.query('minutes')
+        self.run_async(run())
+
+    def test_reads_see_saves(self):
+        from round_robin.asyncdb import AsyncRoundRobinDb
+        async def run():
+            async with AsyncRoundRobinDb(self.backing, readers=1) as rrd:
+                self.assertIsNone(await rrd.last_timestamp())
+                self.assertEqual([], [row for row in await rrd.read_all('minutes')
+                                      if row[0] is not None])
+                # Neither read goes through the query cache, which would
+                # catch the reader up with the saves
+                await rrd.save(60, 1.0)
+                await rrd.save(120, 2.0)
+                self.assertEqual(120, await rrd.last_timestamp())
+                self.assertEqual([(60, 1.0), (120, 2.0)], sorted(
+                        row for row in await rrd.read_all('minutes') if row[0] is not None))
+                await rrd.save(180, 3.0)
+                self.assertEqual(180, await rrd.last_timestamp())
+        self.run_async(run())
+
+class MemoryAsyncTests(AsyncTests):
+    backing = ('Memory', '')
+
+class MmapAsyncTests(AsyncTests):
+    backing = ('MMap', TEST_DB)
+
+    def test_saves_and_reads(self):
+        self.skipTest("MMap files hold only the default series")
+
+class RedisAsyncTests(RedisBacking, AsyncTests):
+    pass
+
+class OutputTests(unittest.TestCase):
+    good_data = [(min*60, min + 20.0) for min in range(0, 90) if min != 80]
+
+    def setUp(self):
+        self.rrd = rr.open_database(('Memory', ''))
+        self.rrd.save_many(self.good_data)
+        self.rows = [row for row in self.rrd.minutes if row[0] is not None]
+
+    def test_text_formats(self):
+        text = rr.output.render(self.rrd, 'minutes')
+        self.assertEqual("4800, NULL", text.splitlines()[50])
+        self.assertEqual("minutes: min: 50.0, avg: 79.15, max: 109.0", text.splitlines()[-1])
+
+        csv = rr.output.render(self.rrd, 'minutes', 'csv').splitlines()
+        self.assertEqual(["timestamp,value", "1800,50.0"], csv[:2])
+        self.assertEqual("4800,", csv[51])
+
+        self.assertEqual([list(row) for row in self.rows],
+                         json.loads(rr.output.render(self.rrd, 'minutes', 'json'))['rows'])
+        self.assertEqual(self.rows, [(r['timestamp'], r['value']) for r in map(json.loads,
+                         rr.output.render(self.rrd, 'minutes', 'ndjson').splitlines())])
+        self.assertEqual({'count': 59, 'total': 4670.0, 'min': 50.0, 'max': 109.0,
+                          'average': 4670.0 / 59},
+                         json.loads(rr.output.render(self.rrd, 'minutes', 'ndjson', True)))
+
+    def test_binary_formats(self):
+        import struct
+        raw = rr.output.render(self.rrd, 'minutes', 'raw')
+        records = list(struct.iter_unpack('<qd', raw))
+        self.assertEqual(len(self.rows), len(records))
+        self.assertEqual(self.rows[0], records[0])
+        self.assertNotEqual(records[50][1], records[50][1]) # NULL is NaN
+
+        # The streaming and bulk paths write the same records
+        import io
+        out = io.BytesIO()
+        writer = rr.output.OutputWriter(out, 'raw')
+        writer.write_rows(iter(self.rows))
+        writer.flush()
+        self.assertEqual(raw, out.getvalue())
+
+        npy = rr.output.render(self.rrd, 'minutes', 'npy')
+        self.assertEqual(b'\x93NUMPY', npy[:6])
+        self.assertEqual(raw, npy[-len(raw):])
+        self.assertEqual(0, (len(npy) - len(raw)) % 64)
+        try:
+            import numpy
+        except ImportError:
+            return
+        array = numpy.load(io.BytesIO(npy))
+        self.assertEqual([row[0] for row in self.rows], array['timestamp'].tolist())
+        self.assertEqual(numpy.dtype(rr.output.ROW_DTYPE), array.dtype)
+        summary = numpy.load(io.BytesIO(rr.output.render(self.rrd, 'minutes', 'npy', True)))
+        self.assertEqual(59, summary['count'][0])
+
+    def test_range(self):
+        self.assertEqual("5220, 107.00\n5280, 108.00\nminutes: min: 107.0, avg: 107.50, max: 108.0\n",
+                         rr.output.render(self.rrd, 'minutes', start=5100, end=5280, limit=2))
+        self.assertEqual({'count': 0, 'total': 0.0, 'min': None, 'max': None, 'average': None},
+                         json.loads(rr.output.render(self.rrd, 'minutes', 'ndjson', True,
+                                                     start=6000)))
+
+    def test_streamed_json(self):
+        # Written row by row, as `json.dumps()` would write it whole
+        summary = self.rrd.summary('minutes')
+        self.assertEqual(json.dumps({'series': 'default', 'archive': 'minutes',
+                                     'rows': [list(row) for row in self.rows],
+                                     'summary': dict(summary._asdict())}) + "\n",
+                         rr.output.render(self.rrd, 'minutes', 'json'))
+
+    def test_invalid_format(self):
+        self.assertRaises(ValueError, rr.output.render, self.rrd, 'minutes', 'xml')
+
+    def test_cli_memory_bounded(self):
+        import rrd
+        import tracemalloc
+
+        class Discard(object):
+            def write(self, data):
+                pass
+
+        def peak(rows, fmt, summary_only):
+            db = rr.open_database(('Memory', ''), rr.parse_archives("1m:%d" % rows))
+            db.save_many([(min * 60, float(min)) for min in range(rows)])
+            tool = rrd.Rrdtool()
+            tool.socket_path = 'no-such.sock'
+            tool._rrd = db
+            stdout, sys.stdout = sys.stdout, Discard()
+            tracemalloc.start()
+            try:
+                tool.query('minutes', summary_only=summary_only, fmt=fmt)
+                return tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+                sys.stdout = stdout
+
+        for fmt, summary_only in [('text', False), ('ndjson', False), ('raw', False),
+                                  ('text', True)]:
+            small, large = peak(5000, fmt, summary_only), peak(40000, fmt, summary_only)
+            # Eight times the rows don't take more memory than a few chunks
+            self.assertLess(large, small + 1024 * 1024, (fmt, summary_only, small, large))
+
+class BenchTests(unittest.TestCase):
+    def test_report(self):
+        report = rr.bench.run(['memory', 'sqlite'], ['1m:10, 1h:3'], number=3, cli_number=1)
+        json.dumps(report)
+        cases = set((result['backend'], result['case']) for result in report['results'])
+        for case in ['save', 'update', 'gap_1', 'gap_59', 'gap_61', 'hour_rollover',
+                     'query_minutes', 'cached_hours']:
+            self.assertIn(('memory', case), cases)
+        self.assertIn(('sqlite', 'cli_query'), cases)
+        self.assertNotIn(('memory', 'cli_query'), cases)
+        for result in report['results']:
+            self.assertEqual(3 if not result['case'].startswith('cli') else 1, result['number'])
+            self.assertLessEqual(result['min_us'], result['median_us'])
+
+        # Compared with itself, nothing is slower; compared with a faster
+        # baseline, everything is
+        self.assertEqual([], rr.bench.compare(report, report))
+        faster = {'results': [dict(result, median_us=result['median_us'] / 2)
+                              for result in report['results']]}
+        self.assertEqual(len(report['results']), len(rr.bench.compare(report, faster)))
+
+@unittest.skipIf(rr.bench.rrd_script() is None, "rrd.py is not installed")
+class CliStartupTests(unittest.TestCase):
+    # How much longer than a bare interpreter `rrd save` may take to start
+    COLD_START_BUDGET = 0.25
+    # Modules `rrd save` has no use for
+    LAZY_MODULES = ['asyncio', 'round_robin.output', 'round_robin.mmapdb',
+                    'round_robin.redisdb', 'round_robin.server']
+
+    def setUp(self):
+        remove_test_db()
+        self.script = rr.bench.rrd_script()
+        self.env = dict(os.environ, RRD_DATABASE=':/'.join(['SQLite', os.path.abspath(TEST_DB)]),
+                        RRD_SOCKET=os.path.join(os.getcwd(), 'rrd-test.sock'))
+
+    def tearDown(self):
+        remove_test_db()
+
+    def run_python(self, args):
+        start = time.time()
+        output = subprocess.check_output([sys.executable] + args, env=self.env)
+        return output, time.time() - start
+
+    def test_save_imports(self):
+        code = ("import sys; sys.path.insert(0, %r); import rrd; rrd.main(['save', '60', '1.0']); "
+                "print(' '.join(sorted(sys.modules)))" % os.path.dirname(self.script))
+        modules = self.run_python(['-c', code])[0].decode('utf-8').split()
+        self.assertIn('round_robin.db', modules)
+        for module in self.LAZY_MODULES:
+            self.assertNotIn(module, modules)
+        db = rr.open_database(('SQLite', TEST_DB))
+        self.assertEqual(60, db.last_timestamp)
+        db.close()
+
+    def test_cold_start(self):
+        self.run_python([self.script, 'save', '60', '1.0'])
+        # The fastest of a few runs, to leave out the noise of a busy machine
+        bare = min(self.run_python(['-c', 'pass'])[1] for ix in range(3))
+        save = min(self.run_python([self.script, 'save', str(120 + ix * 60), '1.0'])[1]
+                   for ix in range(3))
+        self.assertLess(save - bare, self.COLD_START_BUDGET)